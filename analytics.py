@@ -1,59 +1,109 @@
-import time
-import pandas as pd
-import matplotlib.pyplot as plt
-from sqlalchemy import create_engine
-
-from py_scripts.db_operations import get_conn_analytics
-from py_scripts.rds_provision import get_rds_conn_info
-
-# ----------------------------
-# A connection to the RDS instance using the analytics user
-# ----------------------------
-conn_info = get_rds_conn_info(inst_name="bikesharedb", reg_name="us-east-1")
-conn = get_conn_analytics(conn_info)
-
-# ----------------------------
-# Wrap existing psycopg2 connection for Pandas using SQLAlchemy
-# ----------------------------
-engine = create_engine("postgresql+psycopg2://", creator=lambda: conn)
-
-# ----------------------------
-# A sample analytics query
-# ----------------------------
-dbquery = """
-SELECT 
-    EXTRACT(YEAR  FROM started_at) AS year,
-    EXTRACT(MONTH FROM started_at) AS month,
-    EXTRACT(DAY   FROM started_at) AS day,
-    EXTRACT(HOUR  FROM started_at) AS hour,
-    member_casual,
-    COUNT(*) AS cnt
-FROM rides_raw
-GROUP BY year, month, day, hour, member_casual
-ORDER BY year, month, day, hour, member_casual;
+"""Example analytics query: ride counts per hour (or day, month, year) by member type, plotted as total rides per year.
+
+    python analytics.py                         # PostgreSQL on RDS, answered from rides_hourly when populated
+    python analytics.py --grain day --no-plot   # print the result instead of plotting it
+    python analytics.py --backend local         # DuckDB over the parquet files in analytics_store/
+
+Heavy modules (pandas, SQLAlchemy, matplotlib, boto3, DuckDB) are only imported by the code paths that need them, and the RDS endpoint comes from a local cache instead of an AWS lookup, see py_scripts/endpoint_cache.py.
 """
+import argparse
+import os
+import time
+from pathlib import Path
+
+from py_scripts.endpoint_cache import ENDPOINT_CACHE, ENDPOINT_TTL_S
+
+PROJECT_ROOT = Path(__file__).resolve().parent
+USE_QUERY_CACHE = True  # False always queries the database; cached results are invalidated automatically whenever new data is loaded
+# "postgres" queries the RDS instance, "local" runs the same SQL with DuckDB over the parquet files in analytics_store/ (see py_scripts/local_backend.py), no AWS credentials needed
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "postgres")
+INSTANCE_NAME = "bikesharedb"
+REGION_NAME = "us-east-1"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["postgres", "local"], default=ANALYTICS_BACKEND)
+    parser.add_argument("--grain", default="hour", help="year, month, day or hour")
+    parser.add_argument("--by", nargs="*", default=["member_casual"], help="member_casual and/or rideable_type")
+    parser.add_argument("--no-cache", action="store_true", help="always query the database instead of the local query cache")
+    parser.add_argument("--no-plot", action="store_true", help="print the result instead of plotting it")
+    parser.add_argument("--refresh-endpoint", action="store_true", help="look the RDS endpoint up on AWS instead of using the cached one")
+    parser.add_argument("--endpoint-ttl", type=float, default=ENDPOINT_TTL_S, help="seconds a cached RDS endpoint is used for")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    df = run_local(args) if args.backend == "local" else run_postgres(args)
+    elapsed = time.perf_counter() - start
+    print(f"Query returned {len(df):,} rows in {elapsed:.2f} seconds")
+
+    if args.no_plot:
+        print(df)
+    else:
+        plot_yearly(df)
+
+def run_local(args):
+    from py_scripts.local_backend import connect_local, query_local, LOCAL_STORE_DIR
+    from py_scripts.rollups import ride_counts_sql
+
+    # ----------------------------
+    # The local store; rides_raw falls back to the parquet fetch output when nothing has been exported
+    # ----------------------------
+    store_dir = PROJECT_ROOT / LOCAL_STORE_DIR
+    rides_dir = store_dir / "rides_raw" if (store_dir / "rides_raw").exists() else PROJECT_ROOT / "bikeshare_parquet"
+    local_con = connect_local(store_dir, rides_dir=rides_dir)
+
+    print("Executing the query on the local backend...")
+    return query_local(local_con, ride_counts_sql(grain=args.grain, by=args.by, source="rides_raw"))
+
+def run_postgres(args):
+    from sqlalchemy import create_engine
+    from py_scripts.db_operations import get_conn_analytics
+    from py_scripts.endpoint_cache import connect_cached
+    from py_scripts.query_cache import QueryCache
+    from py_scripts.rollups import ride_counts
+
+    # ----------------------------
+    # A connection to the RDS instance using the analytics user. The endpoint is cached in rds_endpoint.json and only looked up on AWS again when it expires or stops accepting connections.
+    # ----------------------------
+    conn, _ = connect_cached(
+        get_conn_analytics,
+        INSTANCE_NAME,
+        REGION_NAME,
+        PROJECT_ROOT / ENDPOINT_CACHE,
+        ttl=args.endpoint_ttl,
+        refresh=args.refresh_endpoint,
+    )
+
+    # ----------------------------
+    # Wrap existing psycopg2 connection for Pandas using SQLAlchemy
+    # ----------------------------
+    engine = create_engine("postgresql+psycopg2://", creator=lambda: conn)
+    cache = QueryCache(PROJECT_ROOT / "query_cache") if USE_QUERY_CACHE and not args.no_cache else None
+
+    # ----------------------------
+    # A sample analytics query: hourly ride counts by member type. ride_counts() answers it from the rides_hourly rollup when that is populated and only scans rides_raw otherwise.
+    # ----------------------------
+    # Takes about 3 minutes to run against rides_raw, just a heads up for the first time :)
+    print("Executing the database query and assigning returned results to a pandas dataframe...")
+    return ride_counts(engine, grain=args.grain, by=args.by, cache=cache)
+
+def plot_yearly(df):
+    import matplotlib.pyplot as plt
+
+    yearly = (
+        df.groupby("year", as_index=False)["cnt"]
+          .sum()
+    )
+
+    print("Plotting the results...")
+    plt.figure(figsize=(8, 5))
+    plt.bar(yearly["year"], yearly["cnt"])
+    plt.xlabel("Year")
+    plt.ylabel("Total ride count")
+    plt.title("Total bikeshare rides per year")
+    plt.xticks(yearly["year"])  # ensure every year is shown
+    plt.tight_layout()
+    plt.show()
 
-print("Executing the database query and assigning returned results to a pandas dataframe...")
-start = time.perf_counter()
-df = pd.read_sql_query(dbquery, engine)
-elapsed = time.perf_counter() - start
-print(f"Query returned {len(df):,} rows in {elapsed:.2f} seconds")
-# Takes about 3 minutes to run, just a heads up for the first time :)
-
-# ----------------------------
-# Plot
-# ----------------------------
-yearly = (
-    df.groupby("year", as_index=False)["cnt"]
-      .sum()
-)
-
-print("Plotting the results...")
-plt.figure(figsize=(8, 5))
-plt.bar(yearly["year"], yearly["cnt"])
-plt.xlabel("Year")
-plt.ylabel("Total ride count")
-plt.title("Total bikeshare rides per year")
-plt.xticks(yearly["year"])  # ensure every year is shown
-plt.tight_layout()
-plt.show()
+if __name__ == "__main__":
+    main()
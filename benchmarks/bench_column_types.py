@@ -0,0 +1,134 @@
+"""Compare table sizes and aggregation times of the original NUMERIC/TEXT column types with the v2 fixed-width layout, and check migrate_to_v2() on a loaded database.
+
+Runs against the PostgreSQL instance given by the standard libpq environment variables. The same trips and weather are loaded into one scratch schema per layout, and a third schema is loaded in the original layout and then migrated; all three are dropped afterwards.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.bench_column_types --rows 2000000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from benchmarks.synthetic import raw_trips, weather_frames
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare, copy_df_weather
+from py_scripts.prep_data import normalize_bikeshare_df, daily_weather_columns, hourly_weather_columns
+from py_scripts.schema_v2 import migrate_to_v2, schema_version
+
+SCHEMAS = {"v1": "bench_types_v1", "v2": "bench_types_v2", "migrated": "bench_types_migrated"}
+TABLES = ["rides_raw", "daily_weather", "hourly_weather"]
+QUERIES = {
+    "ride coordinates": """
+        SELECT member_casual, COUNT(*), AVG(start_lat), AVG(start_lng), AVG(end_lat), AVG(end_lng)
+        FROM rides_raw
+        GROUP BY member_casual
+        ORDER BY member_casual
+    """,
+    "ride distance": """
+        SELECT rideable_type, SUM(sqrt(power((end_lat - start_lat) * 111.0, 2) + power((end_lng - start_lng) * 86.6, 2)))
+        FROM rides_raw
+        GROUP BY rideable_type
+        ORDER BY rideable_type
+    """,
+    "hourly weather": """
+        SELECT date_trunc('month', time), AVG(temperature_2m), SUM(precipitation), MAX(wind_speed_10m), AVG(relative_humidity_2m)
+        FROM hourly_weather
+        GROUP BY 1
+        ORDER BY 1
+    """,
+    "daily weather": """
+        SELECT EXTRACT(YEAR FROM time), AVG(temperature_2m_max - temperature_2m_min), SUM(precipitation_sum), AVG(cloud_cover_mean)
+        FROM daily_weather
+        GROUP BY 1
+        ORDER BY 1
+    """,
+}
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rides = pd.concat([
+        normalize_bikeshare_df(raw_trips(args.rows // 4, "old", start="2016-01-01", days=365, seed=1)),
+        normalize_bikeshare_df(raw_trips(args.rows - args.rows // 4, "new", start="2024-01-01", days=365, seed=2)),
+    ], ignore_index=True)
+    daily, hourly = weather_frames("2014-01-01", "2024-12-31")
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    sizes = {}
+    timings = {}
+    answers = {}
+    try:
+        for layout, schema in SCHEMAS.items():
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema}")
+            create_db_tables(cur, v2=layout == "v2")
+            copy_df_bikeshare(cur, rides, binary=True)
+            copy_df_weather(cur, daily, "daily_weather", daily_weather_columns, binary=True)
+            copy_df_weather(cur, hourly, "hourly_weather", hourly_weather_columns, binary=True)
+            if layout == "migrated":
+                migrate_to_v2(cur)
+            if schema_version(cur) != (1 if layout == "v1" else 2):
+                raise RuntimeError(f"{schema} is not in the expected layout")
+            for table in TABLES:
+                cur.execute(f"VACUUM ANALYZE {table}")
+
+            sizes[layout] = {}
+            for table in TABLES:
+                cur.execute(f"SELECT pg_total_relation_size('{table}'), AVG(pg_column_size(t.*)) FROM {table} t")
+                total, row_bytes = cur.fetchone()
+                sizes[layout][table] = (total, float(row_bytes))
+
+            timings[layout] = {}
+            answers[layout] = {}
+            for name, sql in QUERIES.items():
+                def run():
+                    cur.execute(sql)
+                    return cur.fetchall()
+                timings[layout][name], answers[layout][name] = best_of(args.repeat, run)
+    finally:
+        for schema in SCHEMAS.values():
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.close()
+
+    for layout in ("v2", "migrated"):
+        for name in QUERIES:
+            check(f"{name} ({layout})", answers["v1"][name], answers[layout][name])
+
+    print(f"\n{'table':<16}{'v1 MB':>10}{'v2 MB':>10}{'v1 row B':>10}{'v2 row B':>10}{'size':>8}")
+    for table in TABLES:
+        (v1_total, v1_row), (v2_total, v2_row) = sizes["v1"][table], sizes["v2"][table]
+        print(f"{table:<16}{v1_total / 1024**2:>10.1f}{v2_total / 1024**2:>10.1f}{v1_row:>10.1f}{v2_row:>10.1f}{v2_total / v1_total:>8.0%}")
+
+    print(f"\n{'query':<20}{'v1 s':>10}{'v2 s':>10}{'migrated s':>12}{'speedup':>10}")
+    for name in QUERIES:
+        v1, v2, migrated = (timings[layout][name] for layout in SCHEMAS)
+        print(f"{name:<20}{v1:>10.3f}{v2:>10.3f}{migrated:>12.3f}{v1 / v2:>9.1f}x")
+    print("\nv2 and migrated results match v1.")
+
+def check(name, expected, actual):
+    """Same rows, with numbers equal up to what real can hold."""
+    if len(expected) != len(actual):
+        raise RuntimeError(f"{name}: {len(actual)} rows, expected {len(expected)}")
+    for want, got in zip(expected, actual):
+        for a, b in zip(want, got):
+            if isinstance(a, (int, float)) or hasattr(a, "as_integer_ratio"):
+                if not np.isclose(float(a), float(b), rtol=1e-5, atol=1e-6):
+                    raise RuntimeError(f"{name}: {got} differs from {want}")
+            elif a != b:
+                raise RuntimeError(f"{name}: {got} differs from {want}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare the raw rides_raw table with the compact dimension-keyed layout: total relation size and the analytics.py query time.
+
+Runs against the PostgreSQL instance given by the standard libpq environment variables, inside scratch schemas that are dropped afterwards.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.bench_compact_rides --rows 2000000
+"""
+import argparse
+import time
+import psycopg2
+
+from benchmarks.synthetic import raw_trips
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare
+from py_scripts.dimensions import DimensionCache
+from py_scripts.prep_data import normalize_bikeshare_df
+
+ANALYTICS_QUERY = """
+SELECT
+    EXTRACT(YEAR  FROM started_at) AS year,
+    EXTRACT(MONTH FROM started_at) AS month,
+    EXTRACT(DAY   FROM started_at) AS day,
+    EXTRACT(HOUR  FROM started_at) AS hour,
+    member_casual,
+    COUNT(*) AS cnt
+FROM rides_raw
+GROUP BY year, month, day, hour, member_casual
+ORDER BY year, month, day, hour, member_casual;
+"""
+
+LAYOUTS = {
+    "raw": ("bench_rides_raw", "rides_raw"),
+    "compact": ("bench_rides_compact", "rides_fact"),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = normalize_bikeshare_df(raw_trips(args.rows, "new"))
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    results = {}
+    try:
+        for layout, (schema, table) in LAYOUTS.items():
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema}")
+            compact = layout == "compact"
+            create_db_tables(cur, compact=compact)
+            copy_df_bikeshare(cur, df, binary=True, dims=DimensionCache(cur) if compact else None)
+            cur.execute(f"VACUUM ANALYZE {table}")
+
+            cur.execute("SELECT sum(pg_total_relation_size(c.oid)) FROM pg_class c WHERE c.relnamespace = current_schema()::regnamespace AND c.relkind = 'r'")
+            size = cur.fetchone()[0]
+
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                cur.execute(ANALYTICS_QUERY)
+                cur.fetchall()
+                timings.append(time.perf_counter() - start)
+            results[layout] = (size, min(timings))
+    finally:
+        for schema, _ in LAYOUTS.values():
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.close()
+
+    print(f"\n{'layout':<10}{'size MB':>10}{'query s':>10}")
+    for layout, (size, seconds) in results.items():
+        print(f"{layout:<10}{size / 1024**2:>10.1f}{seconds:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Compare csv and binary COPY into rides_raw and daily_weather, and check both load identical rows, including weather with more decimals than its columns' scale.
+
+Runs against the PostgreSQL instance given by the standard libpq environment variables (PGHOST, PGPORT, PGUSER, PGPASSWORD, PGDATABASE), inside a scratch schema that is dropped afterwards.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.bench_copy_formats --rows 1000000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare, copy_df_weather
+from py_scripts.prep_data import daily_weather_columns
+
+SCHEMA = "bench_copy_formats"
+
+def synthetic_rides(n, seed=0):
+    """A normalized rides frame with realistic types and a sprinkle of NULLs."""
+    rng = np.random.default_rng(seed)
+    started = pd.Timestamp("2024-05-01") + pd.to_timedelta(rng.integers(0, 31 * 86400, n), unit="s")
+    stations = rng.integers(31000, 32000, n)
+    df = pd.DataFrame({
+        "started_at": started,
+        "ended_at": started + pd.to_timedelta(rng.integers(60, 3600, n), unit="s"),
+        "start_station_id": pd.array(stations, dtype="Int64"),
+        "start_station_name": pd.array([f"Station {i}" for i in stations], dtype="string"),
+        "end_station_id": pd.array(stations[::-1], dtype="Int64"),
+        "end_station_name": pd.array([f"Station {i}" for i in stations[::-1]], dtype="string"),
+        "start_lat": (38.8 + rng.random(n) / 5).round(6),
+        "start_lng": (-77.1 + rng.random(n) / 5).round(6),
+        "end_lat": (38.8 + rng.random(n) / 5).round(6),
+        "end_lng": (-77.1 + rng.random(n) / 5).round(6),
+        "rideable_type": pd.array(rng.choice(["classic_bike", "electric_bike"], n), dtype="string"),
+        "member_casual": pd.array(rng.choice(["member", "casual"], n), dtype="string"),
+    })
+    nulls = rng.random(n) < 0.01
+    df.loc[nulls, "start_station_id"] = pd.NA
+    df.loc[nulls, "start_station_name"] = pd.NA
+    df.loc[nulls, "start_lat"] = np.nan
+    return df
+
+def synthetic_daily_weather(n, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({c: rng.uniform(0, 99, n).round(1) for c in daily_weather_columns})
+    days = pd.date_range("2010-10-20", periods=n, freq="D")
+    df["time"] = days.strftime("%Y-%m-%d")
+    df["sunrise"] = (days + pd.Timedelta("07:10:00")).strftime("%Y-%m-%dT%H:%M")
+    df["sunset"] = (days + pd.Timedelta("18:40:00")).strftime("%Y-%m-%dT%H:%M")
+    for c in ("weather_code", "wind_direction_10m_dominant", "winddirection_10m_dominant", "cloud_cover_mean", "cloud_cover_max", "cloud_cover_min", "relative_humidity_2m_mean", "relative_humidity_2m_max", "relative_humidity_2m_min"):
+        df[c] = rng.integers(0, 100, n)
+    df["pressure_msl_mean"] = rng.uniform(980, 1040, n).round(1)
+    df["surface_pressure_mean"] = rng.uniform(980, 1040, n).round(1)
+    return df
+
+def unrounded(df, seed=0):
+    """The weather with 3 decimals on its 1-decimal columns, half of them ties, plus values like 1.005 whose float sits just below the tie."""
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    for c in df.columns[df.dtypes == "float64"]:
+        df[c] = df[c] + rng.choice([0.05, -0.05, 0.005, 0.025, 0.037, 0.0], len(df))
+    df.loc[:3, "temperature_2m_mean"] = [2.25, -2.25, 1.005, 0.125]
+    return df
+
+def timed_load(cur, table, load):
+    cur.execute(f"TRUNCATE {table}")
+    start = time.perf_counter()
+    load()
+    return time.perf_counter() - start
+
+def same_rows(cur, table, other):
+    cur.execute(f"SELECT count(*) FROM ((TABLE {table} EXCEPT ALL TABLE {other}) UNION ALL (TABLE {other} EXCEPT ALL TABLE {table})) d")
+    return cur.fetchone()[0] == 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}")
+
+    try:
+        create_db_tables(cur)
+        rides = synthetic_rides(args.rows)
+        weather = synthetic_daily_weather(5500)
+        weather_unrounded = unrounded(weather)
+
+        cases = [
+            ("rides_raw", "rides_raw", lambda binary: copy_df_bikeshare(cur, rides, binary=binary)),
+            ("daily_weather", "daily_weather", lambda binary: copy_df_weather(cur, weather, "daily_weather", daily_weather_columns, binary=binary)),
+            ("unrounded", "daily_weather", lambda binary: copy_df_weather(cur, weather_unrounded, "daily_weather", daily_weather_columns, binary=binary)),
+        ]
+        results = []
+        for name, table, load in cases:
+            csv_s = timed_load(cur, table, lambda: load(False))
+            cur.execute(f"DROP TABLE IF EXISTS {table}_csv; CREATE TABLE {table}_csv AS TABLE {table}")
+            binary_s = timed_load(cur, table, lambda: load(True))
+            results.append((name, csv_s, binary_s, same_rows(cur, table, f"{table}_csv")))
+    finally:
+        cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.close()
+
+    print(f"\n{'table':<15}{'csv s':>10}{'binary s':>10}{'speedup':>10}  identical")
+    for table, csv_s, binary_s, identical in results:
+        print(f"{table:<15}{csv_s:>10.2f}{binary_s:>10.2f}{csv_s / binary_s:>9.1f}x  {identical}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compare the analytics.py sample query on PostgreSQL and on the local DuckDB backend over partitioned parquet.
+
+The PostgreSQL side runs against the instance given by the standard libpq environment variables, inside a scratch schema that is dropped afterwards. The local side reads parquet files written to a temporary directory.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.bench_local_backend --rows 2000000
+"""
+import argparse
+import tempfile
+import time
+import psycopg2
+
+from benchmarks.synthetic import raw_trips
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare
+from py_scripts.fetch_raw_data import write_rides_parquet
+from py_scripts.local_backend import connect_local, query_local
+from py_scripts.prep_data import normalize_bikeshare_df
+from py_scripts.rollups import ride_counts_sql
+
+SCHEMA = "bench_local_backend"
+ANALYTICS_QUERY = ride_counts_sql(grain="hour", by=["member_casual"], source="rides_raw")
+# a date-bounded variant, where the local backend can skip partitions
+PRUNED_QUERY = ANALYTICS_QUERY.replace("FROM rides_raw", "FROM rides_raw WHERE started_at >= '2024-03-01' AND started_at < '2024-04-01'")
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = normalize_bikeshare_df(raw_trips(args.rows, "new", start="2024-01-01", days=180))
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    results = {}
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}")
+        create_db_tables(cur)
+        copy_df_bikeshare(cur, df, binary=True)
+        cur.execute("VACUUM ANALYZE rides_raw")
+
+        def run_postgres(sql):
+            cur.execute(sql)
+            return len(cur.fetchall())
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            write_rides_parquet(df, f"{store_dir}/rides_raw", "bench")
+            local_con = connect_local(store_dir)
+
+            for name, sql in (("full scan", ANALYTICS_QUERY), ("one month", PRUNED_QUERY)):
+                pg_seconds, pg_rows = best_of(args.repeat, lambda: run_postgres(sql))
+                local_seconds, local_rows = best_of(args.repeat, lambda: len(query_local(local_con, sql)))
+                if pg_rows != local_rows:
+                    raise RuntimeError(f"{name}: PostgreSQL returned {pg_rows} rows, local backend {local_rows}")
+                results[name] = (pg_rows, pg_seconds, local_seconds)
+    finally:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+    print(f"\n{'query':<12}{'rows':>10}{'postgres s':>12}{'local s':>10}{'speedup':>10}")
+    for name, (rows, pg_seconds, local_seconds) in results.items():
+        print(f"{name:<12}{rows:>10,}{pg_seconds:>12.3f}{local_seconds:>10.3f}{pg_seconds / local_seconds:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
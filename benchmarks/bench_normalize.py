@@ -0,0 +1,54 @@
+"""Time schema-aware csv reading + normalize_bikeshare_df against the previous infer-everything path, on both csv layouts, and check both give identical frames.
+
+    python -m benchmarks.bench_normalize --rows 1000000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import pandas as pd
+
+from benchmarks.synthetic import write_raw_csv
+from py_scripts.prep_data import CANONICAL_COLS, MAP_NEW, MAP_OLD, detect_bikeshare_schema, normalize_bikeshare_df, read_bikeshare_csv
+
+def legacy_normalize(df):
+    """normalize_bikeshare_df as it was before schema detection, kept here as the baseline."""
+    df = df.rename(columns=MAP_OLD if "Start date" in df.columns else MAP_NEW).reindex(columns=CANONICAL_COLS)
+    df["started_at"] = pd.to_datetime(df["started_at"], errors="coerce")
+    df["ended_at"] = pd.to_datetime(df["ended_at"], errors="coerce")
+    for col in ("start_station_id", "end_station_id"):
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    for col in ("start_lat", "start_lng", "end_lat", "end_lng"):
+        df[col] = pd.to_numeric(df[col], errors="coerce").round(6)
+    for col in ("start_station_name", "end_station_name", "rideable_type", "member_casual"):
+        df[col] = df[col].astype("string")
+    for col in ("rideable_type", "member_casual"):
+        df[col] = df[col].str.strip().str.lower()
+    return df
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(f"{'layout':<8}{'baseline s':>12}{'schema-aware s':>16}{'speedup':>10}  identical")
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout in ("old", "new"):
+            path = write_raw_csv(Path(tmp) / f"{layout}.csv", args.rows, layout)
+
+            before, before_s = timed(lambda: legacy_normalize(pd.read_csv(path, low_memory=False)))
+
+            def schema_aware():
+                schema = detect_bikeshare_schema(path)
+                return normalize_bikeshare_df(read_bikeshare_csv(path, schema=schema), schema["timestamp_format"])
+            after, after_s = timed(schema_aware)
+
+            print(f"{layout:<8}{before_s:>12.2f}{after_s:>16.2f}{before_s / after_s:>9.1f}x  {before.equals(after)}")
+
+if __name__ == "__main__":
+    main()
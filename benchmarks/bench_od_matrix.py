@@ -0,0 +1,99 @@
+"""Compare station-to-station flow queries on rides_raw with the same queries answered from the OD store, and check both give identical counts.
+
+Runs against the PostgreSQL instance given by the standard libpq environment variables, inside a scratch schema that is dropped afterwards. The store is written to a temporary directory: it is built after a first load, then refreshed after a second load adds another month, so the incremental path is checked too.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.bench_od_matrix --rows 2000000
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from benchmarks.synthetic import raw_trips
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare
+from py_scripts.od_matrix import ODStore, od_flows_sql
+from py_scripts.prep_data import normalize_bikeshare_df
+
+SCHEMA = "bench_od_matrix"
+QUERIES = {
+    "all months": dict(),
+    "one quarter": dict(start="2024-01-01", end="2024-04-01"),
+    "one month, casual": dict(start="2024-03-01", end="2024-04-01", member_casual="casual"),
+    "2016, member": dict(start="2016-01-01", end="2017-01-01", member_casual="member"),
+}
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # old layout trips have no rideable type, new layout ones include dockless trips without stations
+    first_load = pd.concat([
+        normalize_bikeshare_df(raw_trips(args.rows // 4, "old", start="2016-01-01", days=365, seed=1)),
+        normalize_bikeshare_df(raw_trips(args.rows // 2, "new", start="2024-01-01", days=121, seed=2)),
+    ], ignore_index=True)
+    second_load = normalize_bikeshare_df(raw_trips(args.rows // 4, "new", start="2024-04-15", days=46, seed=3))
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    results = {}
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}")
+        create_db_tables(cur)
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = ODStore(store_dir)
+            copy_df_bikeshare(cur, first_load, binary=True, rollup=True)
+            build_seconds, _ = best_of(1, lambda: store.refresh(cur))
+
+            copy_df_bikeshare(cur, second_load, binary=True, rollup=True)
+            stale = store.stale_months(cur)
+            refresh_seconds, _ = best_of(1, lambda: store.refresh(cur))
+            if store.stale_months(cur):
+                raise RuntimeError(f"months still stale after refresh: {store.stale_months(cur)}")
+            cur.execute("VACUUM ANALYZE rides_raw")
+
+            def run_postgres(sql, params):
+                cur.execute(sql, params)
+                return pd.DataFrame(cur.fetchall(), columns=["start_station_id", "end_station_id", "trips"])
+
+            for name, query in QUERIES.items():
+                pg_seconds, expected = best_of(args.repeat, lambda: run_postgres(*od_flows_sql(**query)))
+                store_seconds, flows = best_of(args.repeat, lambda: store.flows(**query))
+                matrix_seconds, matrix = best_of(args.repeat, lambda: store.matrix(**query))
+                check(name, expected, flows, matrix, store.station_ids)
+                results[name] = (len(flows), int(flows["trips"].sum()), pg_seconds, store_seconds, matrix_seconds)
+    finally:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+    print(f"\nBuilt the store in {build_seconds:.2f}s, refreshed {len(stale)} stale months ({', '.join(stale)}) in {refresh_seconds:.2f}s. All results match the SQL.")
+    print(f"\n{'query':<20}{'pairs':>10}{'trips':>12}{'postgres s':>12}{'flows s':>10}{'matrix s':>10}{'speedup':>10}")
+    for name, (pairs, trips, pg_seconds, store_seconds, matrix_seconds) in results.items():
+        print(f"{name:<20}{pairs:>10,}{trips:>12,}{pg_seconds:>12.3f}{store_seconds:>10.3f}{matrix_seconds:>10.3f}{pg_seconds / store_seconds:>9.1f}x")
+
+def check(name, expected, flows, matrix, station_ids):
+    expected = expected.astype("int64")
+    if not flows.astype("int64").equals(expected):
+        raise RuntimeError(f"{name}: the OD store's flows differ from the SQL result")
+    positions = pd.Index(np.asarray(station_ids))
+    dense = matrix.toarray()
+    cells = dense[positions.get_indexer(expected["start_station_id"]), positions.get_indexer(expected["end_station_id"])]
+    if not (np.array_equal(cells, expected["trips"]) and dense.sum() == expected["trips"].sum()):
+        raise RuntimeError(f"{name}: the OD store's matrix differs from the SQL result")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""End-to-end pipeline benchmark: normalizing both csv layouts, every COPY path, the weather fetch and the analytics queries, on synthetic data. Results are written as JSON, and comparing against an earlier results file flags every step that got slower.
+
+Runs against the PostgreSQL instance given by the standard libpq environment variables, inside a scratch schema that is dropped afterwards.
+
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.run_suite --rows 1000000 --output before.json
+    PGHOST=localhost PGDATABASE=postgres python -m benchmarks.run_suite --rows 1000000 --output after.json --baseline before.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+import pandas as pd
+import psycopg2
+
+from benchmarks.synthetic import WeatherStandIn, write_raw_csv
+from py_scripts.db_operations import create_db_tables, copy_df_bikeshare, copy_df_weather
+from py_scripts.features import refresh_rides_weather_hourly
+from py_scripts.fetch_raw_data import get_weather_data
+from py_scripts.prep_data import daily_weather_columns, hourly_weather_columns, detect_bikeshare_schema, normalize_bikeshare_df, read_bikeshare_csv
+from py_scripts.rollups import rebuild_rides_hourly, ride_counts_sql
+
+SCHEMA = "bench_run_suite"
+START = date(2024, 1, 1)
+DEFAULT_TOLERANCE = 0.2
+NOISE_FLOOR_S = 0.01  # slowdowns smaller than this are timer noise on millisecond steps, never regressions
+
+QUERIES = {
+    "query/sample_rides_raw": ride_counts_sql(grain="hour", by=["member_casual"], source="rides_raw"),
+    "query/sample_rides_hourly": ride_counts_sql(grain="hour", by=["member_casual"], source="rides_hourly"),
+    "query/daily_by_type_rides_hourly": ride_counts_sql(grain="day", by=["member_casual", "rideable_type"], source="rides_hourly"),
+    "query/rides_by_temperature": """
+        SELECT round(temperature_2m) AS temperature, SUM(ride_count) AS rides, AVG(mean_duration_s) AS mean_duration_s
+        FROM rides_weather_hourly
+        WHERE has_weather
+        GROUP BY 1
+        ORDER BY 1
+    """,
+}
+
+def best_of(repeat, fn, setup=None):
+    """Shortest wall time of repeat runs of fn, and fn's last return value. setup runs untimed before each run."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def record(results, name, seconds, rows):
+    results[name] = {"seconds": round(seconds, 6), "rows": rows, "rows_per_s": round(rows / seconds) if seconds else None}
+    print(f"{name:<36}{rows:>12,}{seconds:>10.3f}s")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print every step next to its baseline and return the names of the ones more than tolerance slower. Steps timed on a different number of rows aren't comparable and are skipped."""
+    regressions = []
+    print(f"\n{'step':<36}{'baseline s':>12}{'now s':>10}{'change':>9}")
+    for name, now in results.items():
+        before = baseline["results"].get(name)
+        if before is None or before["rows"] != now["rows"]:
+            print(f"{name:<36}{'-':>12}{now['seconds']:>10.3f}{'new' if before is None else 'rows differ':>12}")
+            continue
+        change = now["seconds"] / before["seconds"] - 1
+        flag = "  REGRESSION" if change > tolerance and now["seconds"] - before["seconds"] > NOISE_FLOOR_S else ""
+        print(f"{name:<36}{before['seconds']:>12.3f}{now['seconds']:>10.3f}{change:>+9.0%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="trips per csv layout")
+    parser.add_argument("--days", type=int, default=90, help="days of trips and weather, starting at 2024-01-01")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path, help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="slowdown relative to the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    frames = {}
+
+    # ----- normalize: both csv layouts, reading with the detected schema as the load paths do
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout in ("old", "new"):
+            path = Path(tmp) / f"{layout}.csv"
+            write_raw_csv(path, args.rows, layout, start=str(START), days=args.days)
+            schema = detect_bikeshare_schema(path)
+            seconds, raw = best_of(args.repeat, lambda: read_bikeshare_csv(path, schema=schema))
+            record(results, f"read_csv/{layout}", seconds, len(raw))
+            seconds, frames[layout] = best_of(args.repeat, lambda: normalize_bikeshare_df(raw.copy(), schema["timestamp_format"]))
+            record(results, f"normalize/{layout}", seconds, len(raw))
+    rides = pd.concat(frames.values(), ignore_index=True)
+
+    # ----- weather: parsing Open-Meteo responses from a local stand-in, so only our side is timed
+    end = START + timedelta(days=args.days - 1)
+    with WeatherStandIn() as server:
+        seconds, (daily, hourly) = best_of(args.repeat, lambda: get_weather_data(START, end, workers=1, base_url=server.url))
+    record(results, "fetch_weather/parse", seconds, len(daily) + len(hourly))
+
+    conn = psycopg2.connect("")
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}")
+        create_db_tables(cur)
+
+        # ----- COPY: every format into an emptied table
+        for binary in (False, True):
+            fmt = "binary" if binary else "csv"
+            seconds, _ = best_of(args.repeat, lambda: copy_df_bikeshare(cur, rides, binary=binary), setup=lambda: cur.execute("TRUNCATE rides_raw"))
+            record(results, f"copy_bikeshare/{fmt}", seconds, len(rides))
+            for table, df, columns in (("daily_weather", daily, daily_weather_columns), ("hourly_weather", hourly, hourly_weather_columns)):
+                seconds, _ = best_of(args.repeat, lambda: copy_df_weather(cur, df, table, columns, binary=binary), setup=lambda: cur.execute(f"TRUNCATE {table}"))
+                record(results, f"copy_{table}/{fmt}", seconds, len(df))
+
+        # ----- derived tables, built from what the last COPYs left behind
+        cur.execute("VACUUM ANALYZE rides_raw")
+        seconds, _ = best_of(1, lambda: rebuild_rides_hourly(cur))
+        record(results, "rollup/rebuild_rides_hourly", seconds, len(rides))
+        seconds, _ = best_of(1, lambda: refresh_rides_weather_hourly(cur))
+        cur.execute("SELECT COUNT(*) FROM rides_weather_hourly")
+        record(results, "features/refresh_rides_weather_hourly", seconds, cur.fetchone()[0])
+        cur.execute("ANALYZE")
+
+        # ----- analytics queries
+        def run(sql):
+            cur.execute(sql)
+            return len(cur.fetchall())
+
+        for name, sql in QUERIES.items():
+            seconds, rows = best_of(args.repeat, lambda: run(sql))
+            record(results, name, seconds, rows)
+
+        cur.execute("SHOW server_version")
+        server_version = cur.fetchone()[0]
+    finally:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "rows_per_layout": args.rows,
+            "days": args.days,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "postgres": server_version,
+            "machine": platform.platform(),
+        },
+        "results": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} step(s) more than {args.tolerance:.0%} slower than {args.baseline}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
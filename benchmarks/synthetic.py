@@ -0,0 +1,166 @@
+"""Synthetic raw trip data in both Capital Bikeshare csv layouts, and Open-Meteo style weather, for benchmarks."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+
+from py_scripts.prep_data import daily_weather_columns, hourly_weather_columns
+
+N_STATIONS = 800
+
+def station_table(seed=0):
+    """Station ids, names and coordinates around downtown DC."""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(31000, 31000 + N_STATIONS)
+    return pd.DataFrame({
+        "id": ids,
+        "name": [f"{n}th St & Station Rd NW" for n in ids - 30990],
+        "lat": 38.85 + rng.random(N_STATIONS) / 8,
+        "lng": -77.10 + rng.random(N_STATIONS) / 8,
+    })
+
+def raw_trips(rows, layout="new", start="2024-05-01", days=31, seed=0):
+    """Raw trips as they appear in the source csv files. layout="old" has the pre-2020 columns (Start date, Member type...), timestamps like 5/1/2016 07:03; layout="new" has started_at, rideable_type and coordinates."""
+    rng = np.random.default_rng(seed)
+    stations = station_table(seed)
+    start_idx = rng.integers(0, N_STATIONS, rows)
+    end_idx = rng.integers(0, N_STATIONS, rows)
+    started = pd.Timestamp(start) + pd.to_timedelta(np.sort(rng.integers(0, days * 86400, rows)), unit="s")
+    ended = started + pd.to_timedelta(rng.gamma(2.0, 600.0, rows).astype(int) + 60, unit="s")
+
+    if layout == "old":
+        return pd.DataFrame({
+            "Duration": (ended - started).total_seconds().astype(int),
+            "Start date": started.strftime("%-m/%-d/%Y %H:%M"),
+            "End date": ended.strftime("%-m/%-d/%Y %H:%M"),
+            "Start station number": stations["id"].to_numpy()[start_idx],
+            "Start station": stations["name"].to_numpy()[start_idx],
+            "End station number": stations["id"].to_numpy()[end_idx],
+            "End station": stations["name"].to_numpy()[end_idx],
+            "Bike number": [f"W{n:05d}" for n in rng.integers(0, 5000, rows)],
+            "Member type": rng.choice(["Member", "Casual", "member"], rows, p=[0.75, 0.2, 0.05]),
+        })
+
+    jitter = rng.normal(0, 1e-4, (rows, 4))
+    df = pd.DataFrame({
+        "ride_id": [f"{n:016X}" for n in rng.integers(0, 2**62, rows)],
+        "rideable_type": rng.choice(["classic_bike", "electric_bike", "docked_bike"], rows, p=[0.6, 0.35, 0.05]),
+        "started_at": started.strftime("%Y-%m-%d %H:%M:%S"),
+        "ended_at": ended.strftime("%Y-%m-%d %H:%M:%S"),
+        "start_station_name": stations["name"].to_numpy()[start_idx],
+        "start_station_id": stations["id"].to_numpy()[start_idx].astype(float),
+        "end_station_name": stations["name"].to_numpy()[end_idx],
+        "end_station_id": stations["id"].to_numpy()[end_idx].astype(float),
+        "start_lat": stations["lat"].to_numpy()[start_idx] + jitter[:, 0],
+        "start_lng": stations["lng"].to_numpy()[start_idx] + jitter[:, 1],
+        "end_lat": stations["lat"].to_numpy()[end_idx] + jitter[:, 2],
+        "end_lng": stations["lng"].to_numpy()[end_idx] + jitter[:, 3],
+        "member_casual": rng.choice(["member", "casual"], rows, p=[0.7, 0.3]),
+    })
+    # dockless e-bike trips have no station
+    dockless = rng.random(rows) < 0.05
+    df.loc[dockless, ["start_station_name", "start_station_id"]] = np.nan
+    return df
+
+def write_raw_csv(path, rows, layout="new", **kwargs):
+    raw_trips(rows, layout, **kwargs).to_csv(path, index=False)
+    return path
+
+# (low, high) of each weather variable; integer variables have integer bounds
+WEATHER_RANGES = {
+    "weather_code": (0, 75),
+    "relative_humidity_2m": (20, 100),
+    "cloud_cover": (0, 100),
+    "cloud_cover_low": (0, 100),
+    "cloud_cover_mid": (0, 100),
+    "cloud_cover_high": (0, 100),
+    "is_day": (0, 1),
+    "wind_direction_10m": (0, 360),
+    "wind_direction_100m": (0, 360),
+    "wind_direction_10m_dominant": (0, 360),
+    "winddirection_10m_dominant": (0, 360),
+    "pressure_msl": (990.0, 1035.0),
+    "surface_pressure": (985.0, 1030.0),
+    "precipitation": (0.0, 4.0),
+    "rain": (0.0, 4.0),
+    "snowfall": (0.0, 1.0),
+    "snow_depth": (0.0, 0.2),
+    "sunshine_duration": (0.0, 3600.0),
+    "daylight_duration": (33000.0, 53000.0),
+    "precipitation_hours": (0.0, 12.0),
+}
+
+def weather_payload(start="2024-01-01", end="2024-12-31", seed=0):
+    """An Open-Meteo archive response for start..end (inclusive dates) with every daily and hourly variable the pipeline requests: seasonal temperatures, plausible ranges elsewhere."""
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start, end, freq="D")
+    hours = pd.date_range(start, pd.Timestamp(end) + pd.Timedelta(hours=23), freq="h")
+
+    def series(name, index):
+        # temperatures follow the season, everything else is uniform in its range
+        base = name.split("_2m")[0] if "_2m" in name else name
+        if base in ("temperature", "apparent_temperature", "dew_point"):
+            season = 14 - 12 * np.cos(2 * np.pi * (index.dayofyear.to_numpy() - 20) / 365)
+            values = season + rng.normal(0, 4, len(index)) - (6 if base == "dew_point" else 0)
+            return values.round(1).tolist()
+        low, high = next((r for key, r in WEATHER_RANGES.items() if name.startswith(key)), (0.0, 30.0))
+        if isinstance(low, int):
+            return rng.integers(low, high + 1, len(index)).tolist()
+        return rng.uniform(low, high, len(index)).round(1).tolist()
+
+    daily = {"time": days.strftime("%Y-%m-%d").tolist()}
+    for name in daily_weather_columns[1:]:
+        if name in ("sunrise", "sunset"):
+            clock = "06:45" if name == "sunrise" else "18:30"
+            daily[name] = (days.strftime("%Y-%m-%d") + f"T{clock}").tolist()
+        else:
+            daily[name] = series(name, days)
+
+    hourly = {"time": hours.strftime("%Y-%m-%dT%H:%M").tolist()}
+    for name in hourly_weather_columns[1:]:
+        hourly[name] = series(name, hours)
+
+    return {"daily": daily, "hourly": hourly}
+
+def weather_frames(start="2024-01-01", end="2024-12-31", seed=0):
+    """Daily and hourly weather frames shaped like get_weather_data()'s return value."""
+    payload = weather_payload(start, end, seed)
+    return pd.DataFrame(payload["daily"]), pd.DataFrame(payload["hourly"])
+
+class WeatherStandIn:
+    """Local HTTP server answering Open-Meteo archive requests with weather_payload() for the requested dates. Point get_weather_data(base_url=...) at .url to fetch weather without the network.
+
+        with WeatherStandIn() as server:
+            daily, hourly = get_weather_data(start, end, base_url=server.url)
+    """
+
+    def __init__(self, seed=0):
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                stand_in.requests.append(params)
+                body = json.dumps(weather_payload(params["start_date"], params["end_date"], seed)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/v1/archive"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,9 +1,22 @@
+from datetime import timedelta
 from pathlib import Path
 import pandas as pd
 from py_scripts.rds_provision import delete_rds, create_rds, get_rds_conn_info, create_inbound_rule
-from py_scripts.fetch_raw_data import get_bikeshare_data, get_weather_data
-from py_scripts.db_operations import copy_df_weather, get_conn, create_db_tables, is_table_populated, copy_df_bikeshare, copy_df_weather, create_rouser
-from py_scripts.prep_data import normalize_bikeshare_df, daily_weather_columns, hourly_weather_columns
+from py_scripts.fetch_raw_data import get_bikeshare_data, get_weather_data, WEATHER_START, WEATHER_CACHE_DIR
+from py_scripts.db_operations import copy_df_weather, get_conn, create_db_tables, is_table_populated, copy_df_bikeshare, copy_df_weather, create_rouser, copy_csv_bikeshare_streaming, COPY_CHUNK_ROWS
+from py_scripts.dedup import FingerprintStore, FINGERPRINT_DIR, dedup_source, rebuild_fingerprints
+from py_scripts.dimensions import DimensionCache
+from py_scripts.features import refresh_rides_weather_hourly
+from py_scripts.ingest import load_bikeshare_parallel
+from py_scripts.od_matrix import ODStore, OD_STORE_DIR
+from py_scripts.ledger import create_ingest_ledger, start_batch, is_ledger_populated, pending_files, record_preexisting, ledger_entry, source_name, unfingerprinted_files, mark_fingerprinted
+from py_scripts.partitions import build_partition_indexes
+from py_scripts.pipeline import run_pipeline
+from py_scripts.prep_data import normalize_bikeshare_df, daily_weather_columns, hourly_weather_columns, CANONICAL_COLS, detect_bikeshare_schema, read_bikeshare_csv, backfill_coordinates, restrict_labels
+from py_scripts.rollups import rebuild_rides_hourly
+from py_scripts.schema_v2 import schema_version, migrate_to_v2, enum_labels
+from py_scripts.stations import STATION_INDEX, load_station_index, update_station_index
+from py_scripts.telemetry import configure as configure_telemetry, stage, summarize as summarize_telemetry
 
 # ----------
 # Step 1: Provision a PostgreSQL RDS instance on AWS. This will serve as our read-only analytics database instance.
@@ -19,48 +32,176 @@ create_inbound_rule("bikesharedb", "us-east-1")
 conn_info = get_rds_conn_info(inst_name="bikesharedb", reg_name="us-east-1")
 conn = get_conn(conn_info)
 cur = conn.cursor()
+COMPACT_RIDES = False  # True stores rides in the integer-keyed rides_fact table with station/type dimensions, rides_raw becomes a view with the same columns
 
-create_db_tables(cur)
+PARTITIONED_RIDES = False  # True range-partitions rides_raw by month on started_at, so date-bounded queries only scan the months they need
+
+COLUMN_TYPES_V2 = False  # True stores coordinates as double precision, weather measures as real, whole numbers as smallint and rideable/member types as enums, in padding-free column order, see py_scripts/schema_v2.py. An existing database is migrated on the next run
+
+create_db_tables(cur, compact=COMPACT_RIDES, partitioned=PARTITIONED_RIDES, v2=COLUMN_TYPES_V2)
+if COLUMN_TYPES_V2 and schema_version(cur) == 1:
+    migrate_to_v2(cur)
+# a v2 rides_raw only takes the labels its enum types hold, others are stored as NULL with a warning; text columns keep every label
+labels = enum_labels(cur)
+create_ingest_ledger(cur)
 
 #----------
-# Step 3: Fetch the raw data from their publishing sources: I) capital bikeshare trip data from lyft will be streamed to csv files in a created 'bikeshare_csv' folder and II) historical weather data from Open-meteo. Since weather data will not be stored but will directly be written to database as soon as the API call returns, the get_weather_data() function will be called when it's time to write the data to the database
+# Step 3: Fetch the raw data from their publishing sources: I) capital bikeshare trip data from lyft will be streamed to csv files in a created 'bikeshare_csv' folder and II) historical weather data from Open-meteo. Since weather data is written to the database as soon as the API calls return, the get_weather_data() function will be called when it's time to write the data to the database; its responses are cached per yearly window in a 'weather_cache' folder. Re-running this step only fetches archives that are new or changed since the last run, as tracked in bikeshare_csv/_manifest.json
 #----------
 PROJECT_ROOT = Path(__file__).resolve().parent
 DATA_DIR = PROJECT_ROOT / "bikeshare_csv"
+PARQUET_DIR = PROJECT_ROOT / "bikeshare_parquet"
+FETCH_WORKERS = 4  # number of archives downloaded concurrently, 1 keeps the original one-by-one behaviour
+INGEST_LOADERS = 1  # > 1 normalizes files in a process pool and runs this many COPY connections concurrently
+FETCH_OUTPUT = "csv"  # "parquet" normalizes while streaming and keeps typed parquet files partitioned by year/month instead of raw csv files
+TELEMETRY_LOG = None  # e.g. PROJECT_ROOT / "telemetry.jsonl" records wall time, rows, bytes, throughput and peak RSS of every pipeline stage per source file, see py_scripts/telemetry.py
+PROFILE_STAGES = None  # e.g. ["normalize"] runs those stages under cProfile and writes .prof files next to TELEMETRY_LOG
+PIPELINED = False  # True overlaps this step with loading rides in Step 4: each csv file is normalized and copied in as soon as its archive is extracted, see py_scripts/pipeline.py. Needs FETCH_OUTPUT = "csv" and COMPACT_RIDES = False
+PARSE_WORKERS = None  # processes normalizing csv files in the pipelined and parallel loads, None uses one per CPU
+DEDUP_TRIPS = True  # drop trips already loaded from another source file before they are copied in, using the row fingerprints kept in fingerprints/, see py_scripts/dedup.py
+BACKFILL_COORDINATES = True  # fill in the coordinates old layout trips lack from where their station was, per month, in the new layout files, cached in station_index.parquet, see py_scripts/stations.py
+OD_STORE = True  # keep monthly station-to-station trip counts in od_store/, so flow queries are answered without scanning rides_raw, see py_scripts/od_matrix.py
+
+if PIPELINED and (FETCH_OUTPUT != "csv" or COMPACT_RIDES):
+    raise ValueError("PIPELINED loads raw csv files into rides_raw, it needs FETCH_OUTPUT = 'csv' and COMPACT_RIDES = False.")
 
-get_bikeshare_data(PROJECT_ROOT)
+if TELEMETRY_LOG is not None:
+    configure_telemetry(TELEMETRY_LOG, profile=PROFILE_STAGES)
+
+# the pipelined run fetches in Step 4, together with loading. Its station index can only be built from files already on disk, so while the index is still empty the fetch goes first rather than loading old layout trips without coordinates.
+fetch_while_loading = PIPELINED and not (BACKFILL_COORDINATES and load_station_index(PROJECT_ROOT / STATION_INDEX).empty)
+if not fetch_while_loading:
+    with stage("fetch_bikeshare"):
+        get_bikeshare_data(PROJECT_ROOT, workers=FETCH_WORKERS, output=FETCH_OUTPUT)
 
 #----------
 # Step 4: Populate the tables in the database with normalized trips and weather data. Before being written to rides_raw table, the trips data requires some extensive normalization which is handled by the normalize_bikeshare_df() function. The weather data is fetched via an API call and are intermittently stored in data frames, which are ultimately written to their respective daily_weather and horuly_weather tables.
 #----------
-# populate rides_raw table
+# populate rides_raw table. Every load path also keeps the rides_hourly rollup up to date batch by batch, so analytics at hour grain or coarser never scans rides_raw.
 #----------
-if is_table_populated(cur, "rides_raw"):
-    print("rides_raw table already exists and is populated. Skipping CSV loading.")
+dims = DimensionCache(cur) if COMPACT_RIDES else None
+
+# the ingest ledger records every source file in the same transaction as its rows, so a re-run (or a run after a crash) loads exactly the files that are missing
+source_dir = PARQUET_DIR if FETCH_OUTPUT == "parquet" else DATA_DIR
+source_files = list(source_dir.rglob("*.parquet")) if FETCH_OUTPUT == "parquet" else list(DATA_DIR.glob("*.csv"))
+batch_id = start_batch(cur)
+
+if not is_ledger_populated(cur) and is_table_populated(cur, "rides_raw"):
+    print("rides_raw was populated before the ingest ledger existed. Recording the current files as loaded.")
+    record_preexisting(cur, source_files, source_dir, batch_id)
+# databases loaded before rides_hourly existed get it built once from rides_raw
+if is_table_populated(cur, "rides_raw") and not is_table_populated(cur, "rides_hourly"):
+    rebuild_rides_hourly(cur)
+
+pending = pending_files(cur, source_files, source_dir)
+
+# overlapping source files repeat some trips; every load path drops rows already loaded from another file before COPY. The fingerprints of a file are stored after its rows are committed, so dedup_source() always goes outside ledger_entry(), and the ledger records when they are. Files committed without them, e.g. by a crash in between, are caught up on from rides_raw.
+dedup = FingerprintStore(PROJECT_ROOT / FINGERPRINT_DIR) if DEDUP_TRIPS else None
+if dedup is not None and dedup.is_outdated():
+    print("The stored fingerprints were computed differently by an earlier version. Fingerprinting rides_raw again.")
+    dedup.clear()
+missing_fingerprints = unfingerprinted_files(cur) if dedup is not None else []
+if missing_fingerprints:
+    print(f"{len(missing_fingerprints)} loaded files have no stored fingerprints, e.g. {', '.join(missing_fingerprints[:5])}. Fingerprinting rides_raw again.")
+if dedup is not None and (dedup.is_empty() or missing_fingerprints) and is_table_populated(cur, "rides_raw"):
+    # on its own connection without autocommit, so rides_raw is streamed out rather than materialized on the server for a WITH HOLD cursor first
+    rebuild_conn = get_conn(conn_info)
+    rebuild_conn.autocommit = False
+    try:
+        rebuild_fingerprints(rebuild_conn, dedup)
+    finally:
+        rebuild_conn.close()
+    mark_fingerprinted(cur, missing_fingerprints)
+
+# the station index is brought up to date with the new files before they are loaded. A pipelined run can only use the files already on disk, so files its fetch brings in only reach the index on the next run.
+stations = update_station_index(PROJECT_ROOT / STATION_INDEX, source_files) if BACKFILL_COORDINATES else None
+
+if PIPELINED:
+    # files already on disk go first, newly extracted ones follow as their archives come in
+    run_pipeline(PROJECT_ROOT, conn_info, pending, fetch_workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS, loaders=max(INGEST_LOADERS, 2), rollup=True, batch_id=batch_id, dedup=dedup, stations=stations, labels=labels)
+elif not pending:
+    print("All source files are already loaded into rides_raw. Skipping loading.")
+elif FETCH_OUTPUT == "parquet":
+    # parquet files are already normalized, so they go straight to the database
+    for parquet_path in pending:
+        name = source_name(parquet_path, PARQUET_DIR)
+        print(f"Loading {name}")
+        with dedup_source(dedup, name, cur) as seen, ledger_entry(cur, parquet_path, PARQUET_DIR, batch_id) as entry:
+            df = pd.read_parquet(parquet_path, columns=CANONICAL_COLS)
+            if stations is not None:
+                df = backfill_coordinates(df, stations)
+            if labels is not None:
+                df = restrict_labels(df, labels)
+            df = seen.filter(df)
+            copy_df_bikeshare(cur, df, dims=dims, rollup=True)
+            entry["rows"] = len(df)
+            entry["duplicates"] = seen.duplicates
+elif COMPACT_RIDES:
+    # rides_raw is a view in the compact layout, so each chunk is mapped to dimension keys and copied into rides_fact
+    for csv_path in pending:
+        print(f"Loading {csv_path.name}")
+        schema = detect_bikeshare_schema(csv_path)
+        with dedup_source(dedup, csv_path.name, cur) as seen, ledger_entry(cur, csv_path, DATA_DIR, batch_id) as entry:
+            entry["rows"] = 0
+            for chunk in read_bikeshare_csv(csv_path, chunksize=COPY_CHUNK_ROWS, schema=schema):
+                df = seen.filter(normalize_bikeshare_df(chunk, schema["timestamp_format"], stations))
+                copy_df_bikeshare(cur, df, dims=dims, rollup=True)
+                entry["rows"] += len(df)
+            entry["duplicates"] = seen.duplicates
+elif INGEST_LOADERS > 1:
+    load_bikeshare_parallel(conn_info, pending, parse_workers=PARSE_WORKERS, loaders=INGEST_LOADERS, rollup=True, batch_id=batch_id, dedup=dedup, stations=stations, labels=labels)
 else:
-    for csv_path in DATA_DIR.glob("*.csv"):
+    # each file is read, normalized and copied in chunks of COPY_CHUNK_ROWS rows so memory stays flat however large the file is
+    for csv_path in pending:
         print(f"Loading {csv_path.name}")
-        df = pd.read_csv(csv_path, low_memory=False)
-        df = normalize_bikeshare_df(df)
-        copy_df_bikeshare(cur, df)
+        with dedup_source(dedup, csv_path.name, cur) as seen, ledger_entry(cur, csv_path, DATA_DIR, batch_id) as entry:
+            entry["rows"] = copy_csv_bikeshare_streaming(cur, csv_path, rollup=True, dedup=seen, stations=stations, labels=labels)["rows"]
+            entry["duplicates"] = seen.duplicates
+
+# partitions are indexed once they are bulk loaded, not while rows are being copied in
+if PARTITIONED_RIDES:
+    build_partition_indexes(cur)
 #----------
 #populate daily_weather and hourly_weather table
 #----------
-if is_table_populated(cur, "daily_weather") and is_table_populated(cur, "hourly_weather"):
-    print("Weather tables already exists and is populated. Skippng data loading.")
-else:
-    weather_tuple = get_weather_data()
-    targets = [
-        ("daily_weather", daily_weather_columns),
-        ("hourly_weather", hourly_weather_columns)
-        ]
-    for df, (table, columns) in zip(weather_tuple, targets):
+# only dates past what is already in the tables are fetched and appended, in yearly windows cached under weather_cache/
+cur.execute("SELECT (SELECT MAX(time) FROM daily_weather), (SELECT MAX(time) FROM hourly_weather)")
+last_day, last_hour = cur.fetchone()
+weather_start = WEATHER_START if last_day is None or last_hour is None else min(last_day, last_hour.date()) + timedelta(days=1)
+
+with stage("fetch_weather"):
+    weather_tuple = get_weather_data(start=weather_start, cache_dir=PROJECT_ROOT / WEATHER_CACHE_DIR)
+targets = [
+    ("daily_weather", daily_weather_columns, last_day),
+    ("hourly_weather", hourly_weather_columns, last_hour)
+    ]
+for df, (table, columns, last) in zip(weather_tuple, targets):
+    if last is not None:
+        df = df[pd.to_datetime(df["time"]) > pd.Timestamp(last)]
+    if df.empty:
+        print(f"{table} is up to date. Skipping data loading.")
+        continue
+    with stage("load_weather", source=table):
         copy_df_weather(cur, df, table, columns)
 
+#----------
+# refresh the rides_weather_hourly feature table for the hours whose rides or weather just changed
+#----------
+with stage("refresh_features"):
+    refresh_rides_weather_hourly(cur)
+
+# rebuild the origin-destination matrices of the months whose ride counts just changed
+if OD_STORE:
+    with stage("refresh_od_store"):
+        ODStore(PROJECT_ROOT / OD_STORE_DIR).refresh(cur)
+
 #----------
 # Step 5: Create a read-only analytics user (rouser) on the database and set privileges and connection limits. More elegant & industry standard solutions to this requirement would be through IAM and roles but for small groups of analytics people, this looks sufficient.
 #----------
 create_rouser(cur)
 
 cur.close()
-conn.close()
\ No newline at end of file
+conn.close()
+
+if TELEMETRY_LOG is not None:
+    print(summarize_telemetry(TELEMETRY_LOG))
\ No newline at end of file
@@ -0,0 +1,155 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+from py_scripts.db_operations import get_conn, get_conn_analytics
+
+# create_rouser caps the analytics role at this many connections; also used for roles without a limit of their own
+ROLE_CONNECTION_LIMIT = 10
+IDLE_TIMEOUT = 300
+HEALTH_CHECK_AFTER = 30
+ACQUIRE_TIMEOUT = 60
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections made by connect, a zero-argument function such as lambda: get_conn(conn_info). Connections are opened lazily up to max_size and reused, so callers pay the TLS handshake and authentication once per connection instead of once per query.
+
+    max_size defaults to the role's CONNECTION LIMIT as reported by the server, or ROLE_CONNECTION_LIMIT for roles without one. Idle connections are closed after idle_timeout seconds, and a connection that has been idle longer than HEALTH_CHECK_AFTER seconds is pinged before it is handed out again. Callers that would exceed max_size wait for a connection to be returned.
+    """
+
+    def __init__(self, connect, max_size=None, idle_timeout=IDLE_TIMEOUT, acquire_timeout=ACQUIRE_TIMEOUT):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # (returned_at, conn), most recently returned last
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block. A connection that broke while borrowed is discarded instead of returned."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                self._drop_expired()
+
+                if self._idle:
+                    returned_at, conn = self._idle.pop()
+                    if self._healthy(conn, time.monotonic() - returned_at):
+                        return conn
+                    self._discard(conn)
+                    continue
+
+                # until the first connection has reported the role's limit, only one is opened
+                if self._size < (1 if self.max_size is None else self.max_size):
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection available within {self.acquire_timeout}s, all {self.max_size} are in use")
+                self._cond.wait(remaining)
+
+        # connect outside the lock so a slow handshake doesn't hold up other callers
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        if self.max_size is None:
+            self._set_max_size(conn)
+        return conn
+
+    def release(self, conn):
+        """Return a borrowed connection. Open transactions are rolled back so the next borrower starts clean."""
+        status = conn.info.transaction_status if not conn.closed else None
+        if status in (psycopg2.extensions.TRANSACTION_STATUS_INTRANS, psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                conn.rollback()
+                status = conn.info.transaction_status
+            except psycopg2.Error:
+                status = None
+
+        with self._cond:
+            if self._closed or status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self._discard(conn)
+            else:
+                self._idle.append((time.monotonic(), conn))
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle connections. Connections still borrowed are closed when they are released."""
+        with self._cond:
+            self._closed = True
+            for _, conn in self._idle:
+                self._discard(conn)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        expired = [conn for returned_at, conn in self._idle if now - returned_at > self.idle_timeout]
+        if expired:
+            self._idle = [(t, conn) for t, conn in self._idle if now - t <= self.idle_timeout]
+            for conn in expired:
+                self._discard(conn)
+
+    def _discard(self, conn):
+        self._size -= 1
+        if not conn.closed:
+            conn.close()
+
+    @staticmethod
+    def _healthy(conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _set_max_size(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT rolconnlimit FROM pg_roles WHERE rolname = current_user")
+            limit = cur.fetchone()[0]
+        if not conn.autocommit:
+            conn.rollback()
+        with self._cond:
+            if self.max_size is None:
+                self.max_size = limit if limit > 0 else ROLE_CONNECTION_LIMIT
+                self._cond.notify_all()
+
+def admin_pool(conn_info, **kwargs):
+    """Pool of autocommit connections as the postgres user, see get_conn."""
+    return ConnectionPool(lambda: get_conn(conn_info), **kwargs)
+
+def analytics_pool(conn_info, **kwargs):
+    """Pool of read-only connections as rouser, see get_conn_analytics."""
+    return ConnectionPool(lambda: get_conn_analytics(conn_info), **kwargs)
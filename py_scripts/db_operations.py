@@ -1,7 +1,70 @@
+import contextvars
 import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 import psycopg2
-from io import StringIO
+import psycopg2.extensions
+from io import BytesIO, StringIO
 import pandas as pd
+import pyarrow as pa
+
+from py_scripts.dimensions import create_compact_rides_tables, FACT_COLS
+from py_scripts.features import create_rides_weather_hourly
+from py_scripts.partitions import create_month_partitions
+from py_scripts.pg_binary import encode_binary_copy, get_column_types
+from py_scripts.prep_data import normalize_bikeshare_df, CANONICAL_COLS, detect_bikeshare_schema, read_bikeshare_csv
+from py_scripts.rollups import create_rides_hourly, hourly_rollup, merge_rollups, upsert_rides_hourly
+from py_scripts.schema_v2 import create_v2_tables
+from py_scripts.telemetry import stage, track_peak_rss
+
+COPY_CHUNK_ROWS = 250_000
+COPY_READ_SIZE = 1024 * 1024
+FETCH_SIZE = 50_000
+
+# pandas and arrow types for result columns by PostgreSQL type oid, so every chunk of a streamed query has the same dtypes even when a chunk happens to be all NULL. numeric is read as float. Every other type, including enums, whose oids differ per database, is read as a string (see result_type()).
+RESULT_TYPES = {
+    16: ("boolean", pa.bool_()),
+    20: ("Int64", pa.int64()),
+    21: ("Int16", pa.int16()),
+    23: ("Int32", pa.int32()),
+    700: ("float32", pa.float32()),
+    701: ("float64", pa.float64()),
+    1700: ("float64", pa.float64()),
+    25: ("string", pa.string()),
+    1043: ("string", pa.string()),
+    1082: ("datetime64[ns]", pa.date32()),
+    1114: ("datetime64[ns]", pa.timestamp("us")),
+    1184: ("datetime64[ns, UTC]", pa.timestamp("us", tz="UTC")),
+}
+STRING_RESULT = ("string", pa.string())
+
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    "NUMERIC_AS_FLOAT",
+    lambda value, cur: float(value) if value is not None else None,
+)
+
+RIDES_RAW_COPY_SQL = """
+    COPY rides_raw (
+        started_at,
+        ended_at,
+        start_station_id,
+        start_station_name,
+        end_station_id,
+        end_station_name,
+        start_lat,
+        start_lng,
+        end_lat,
+        end_lng,
+        rideable_type,
+        member_casual
+    )
+    FROM STDIN
+    WITH (FORMAT CSV, HEADER TRUE)
+    """
 
 def get_conn(conn_info):
     """Create a psycopg2 connection to the db with autocommit enabled"""
@@ -28,10 +91,16 @@ def get_conn_analytics(conn_info):
     )
     return conn
 
-def create_db_tables(cur):
-    """Create inital database tables"""
+def create_db_tables(cur, compact=False, partitioned=False, v2=False):
+    """Create inital database tables. With compact=True rides are stored in the integer-keyed rides_fact table plus station, rideable type and member type dimensions, and rides_raw is created as a view over them instead of a table. With partitioned=True rides_raw is range-partitioned by month on started_at. With v2=True rides_raw and the weather tables use fixed-width column types, see py_scripts/schema_v2.py."""
+    if compact and partitioned:
+        raise ValueError("The compact rides layout can't be partitioned, pick one of compact or partitioned.")
+    if compact and v2:
+        raise ValueError("The v2 column types are for the rides_raw table, the compact rides layout keeps its own. Pick one of compact or v2.")
+
     # SQL statements
-    create_rides_raw = """
+    partition_clause = "PARTITION BY RANGE (started_at)" if partitioned else ""
+    create_rides_raw = f"""
     CREATE TABLE IF NOT EXISTS rides_raw (
         started_at           TIMESTAMP,
         ended_at             TIMESTAMP,
@@ -45,7 +114,7 @@ def create_db_tables(cur):
         end_lng              NUMERIC(9,6),
         rideable_type        TEXT,
         member_casual        TEXT
-    );
+    ) {partition_clause};
     """
 
     create_daily_weather = """
@@ -114,9 +183,19 @@ def create_db_tables(cur):
     );
     """
 
-    cur.execute(create_rides_raw)
-    cur.execute(create_daily_weather)
-    cur.execute(create_hourly_weather)
+    if compact:
+        create_compact_rides_tables(cur)
+    elif v2:
+        create_v2_tables(cur, partitioned=partitioned)
+    else:
+        cur.execute(create_rides_raw)
+    if partitioned:
+        create_month_partitions(cur)
+    cur.execute(create_rides_hourly)
+    if not v2:
+        cur.execute(create_daily_weather)
+        cur.execute(create_hourly_weather)
+    create_rides_weather_hourly(cur)
 
     print("Tables created successfully.")
 
@@ -139,45 +218,198 @@ def is_table_populated(cur, table_name: str) -> bool:
         print(f"Table {table_name} does not exist.")
         return False
     
-    # Check if table has any rows
-    cur.execute(f'SELECT COUNT(*) FROM "{table_name}";')
-    row_count = cur.fetchone()[0]
-    
-    return row_count > 0
+    # Check if table has any rows, stopping at the first one instead of counting them all
+    cur.execute(f'SELECT EXISTS (SELECT 1 FROM "{table_name}");')
+    return cur.fetchone()[0]
 
-def copy_df_bikeshare(cur, df: pd.DataFrame):
-    """Copy the content of a data frame into the database using StringIO"""
+@contextmanager
+def transaction(cur):
+    """Run the enclosed statements as one transaction on an autocommit connection. On a connection that is already managing its own transaction, or inside an enclosing transaction() block, the caller decides when to commit, so nothing is done."""
+    conn = cur.connection
+    if not conn.autocommit or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        yield
+        return
 
-    buf = StringIO()
+    cur.execute("BEGIN")
+    try:
+        yield
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
 
-    print("Reading data frame into buffer...")
-    df.to_csv(buf, index=False, header=True)
-    buf.seek(0)
+def copy_df_bikeshare(cur, df: pd.DataFrame, binary=False, dims=None, rollup=False):
+    """Copy the content of a data frame into the database using StringIO. With binary=True the typed columns are encoded straight into a binary COPY buffer instead of csv text. Passing a DimensionCache as dims loads the compact layout: rows are mapped to dimension keys and copied into rides_fact. With rollup=True the frame's hourly counts are added to rides_hourly in the same transaction."""
 
-    print("Sending to database...")
-    cur.copy_expert(
-        """
-        COPY rides_raw (
-            started_at,
-            ended_at,
-            start_station_id,
-            start_station_name,
-            end_station_id,
-            end_station_name,
-            start_lat,
-            start_lng,
-            end_lat,
-            end_lng,
-            rideable_type,
-            member_casual
+    # new dimension rows are committed up front so the cache never holds keys a rolled back COPY took with it; inside a caller's transaction the cache notices a rollback itself
+    fact = dims.to_fact(cur, df) if dims is not None else None
+
+    with transaction(cur):
+        if fact is not None:
+            copy_df_binary(cur, fact, "rides_fact", FACT_COLS)
+        elif binary:
+            copy_df_binary(cur, df, "rides_raw", CANONICAL_COLS)
+        else:
+            buf = StringIO()
+
+            print("Reading data frame into buffer...")
+            with stage("render_csv", table="rides_raw", rows=len(df)) as m:
+                df.to_csv(buf, index=False, header=True)
+                m["bytes"] = buf.tell()
+            buf.seek(0)
+
+            print("Sending to database...")
+            with stage("copy", table="rides_raw", rows=len(df), bytes=m["bytes"]):
+                cur.copy_expert(RIDES_RAW_COPY_SQL, buf)
+
+        if rollup:
+            with stage("rollup_upsert", rows=len(df)):
+                upsert_rides_hourly(cur, hourly_rollup(df))
+
+def copy_df_binary(cur, df: pd.DataFrame, table: str, columns: list[str]):
+    """COPY a data frame into table using the binary format. Column types are read from the table itself, so the encoder always matches the schema."""
+
+    pg_types = get_column_types(cur, table, columns)
+
+    print(f"Encoding binary COPY buffer for table '{table}'...")
+    with stage("encode_binary", table=table, rows=len(df)) as m:
+        buf = BytesIO(encode_binary_copy(df.reindex(columns=columns), pg_types))
+        m["bytes"] = buf.getbuffer().nbytes
+
+    print(f"Copying data into '{table}'...")
+    with stage("copy", table=table, rows=len(df), bytes=m["bytes"]):
+        cur.copy_expert(
+            f"""
+            COPY {table} (
+                {", ".join(columns)}
+            )
+            FROM STDIN
+            WITH (FORMAT BINARY)
+            """,
+            buf,
+            size=COPY_READ_SIZE,
         )
-        FROM STDIN
-        WITH (FORMAT CSV, HEADER TRUE)
-        """,
-        buf,
-    )
 
-def copy_df_weather(cur, df: pd.DataFrame, table: str, columns: list[str]):
+class DataFrameCSVStream:
+    """Read-only file-like object that renders an iterator of data frames as one continuous csv stream with a single header, so copy_expert can consume frames as they are produced. Only the frame currently being sent is held as csv text."""
+
+    def __init__(self, frames):
+        self._frames = iter(frames)
+        self._buf = b""
+        self._pos = 0
+        self._header = True
+        self.rows = 0
+
+    def read(self, size=-1):
+        # an empty frame renders to nothing once the header is out, and returning b"" would end the COPY early
+        while self._pos >= len(self._buf):
+            df = next(self._frames, None)
+            if df is None:
+                return b""
+            with stage("render_csv", table="rides_raw", rows=len(df)) as m:
+                self._buf = df.to_csv(index=False, header=self._header).encode()
+                m["bytes"] = len(self._buf)
+            self._pos = 0
+            self._header = False
+            self.rows += len(df)
+
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        out = self._buf[self._pos:end]
+        self._pos += len(out)
+        return out
+
+def prefetch(iterable, depth=2):
+    """Run an iterator in a background thread, keeping at most depth items ready. Lets parsing continue while the consumer is busy sending the previous item; exceptions are re-raised in the consumer. Closing the generator early, e.g. when the COPY fails, stops the producer and closes iterable, so it doesn't keep its items and open files alive."""
+    q = queue.Queue(maxsize=depth)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        # nobody takes items off the queue once the consumer has stopped
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+        else:
+            put(done)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    # the producer runs in the caller's context, so telemetry stages inside it keep their source tag
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+def copy_csv_bikeshare_streaming(cur, csv_path, chunk_rows=COPY_CHUNK_ROWS, rollup=False, dedup=None, stations=None, labels=None):
+    """Read a raw bikeshare csv in chunks of chunk_rows, normalize each chunk and feed them all into one open COPY into rides_raw. Memory is bounded by a few chunks instead of the whole file, and the next chunk is parsed while the current one is being sent. With rollup=True each chunk is also aggregated by hour as it passes, and the file's totals are added to rides_hourly in the same transaction as the COPY. Passing the file's SourceDedup (see py_scripts/dedup.py) as dedup drops rows already loaded from other files, and a station index as stations fills in missing coordinates (see py_scripts/stations.py); labels restricts the label columns to a v2 rides_raw's enum labels. Returns and prints rows/s and peak RSS so chunk_rows can be tuned."""
+
+    start = time.perf_counter()
+
+    schema = detect_bikeshare_schema(csv_path)
+    chunks = read_bikeshare_csv(csv_path, chunksize=chunk_rows, schema=schema)
+    rollups = []
+
+    def normalized():
+        try:
+            for chunk in chunks:
+                df = normalize_bikeshare_df(chunk, schema["timestamp_format"], stations, labels)
+                if dedup is not None:
+                    df = dedup.filter(df)
+                if rollup:
+                    rollups.append(hourly_rollup(df))
+                yield df
+        finally:
+            # closes the csv reader too when loading stops early
+            chunks.close()
+
+    frames = prefetch(normalized())
+    stream = DataFrameCSVStream(frames)
+    try:
+        # the peak of this file alone: the process peak stays at the largest file loaded so far
+        with track_peak_rss() as peak, stage("copy_csv_streaming", source=csv_path.name, table="rides_raw", bytes=os.path.getsize(csv_path)) as m, transaction(cur):
+            cur.copy_expert(RIDES_RAW_COPY_SQL, stream, size=COPY_READ_SIZE)
+            m["rows"] = stream.rows
+            if rollup:
+                with stage("rollup_upsert", rows=stream.rows):
+                    upsert_rides_hourly(cur, merge_rollups(rollups))
+    finally:
+        # stops the parser thread if the COPY failed half way
+        frames.close()
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "file": csv_path.name,
+        "rows": stream.rows,
+        "duplicates": dedup.duplicates if dedup is not None else 0,
+        "seconds": elapsed,
+        "rows_per_s": stream.rows / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak.mb,
+    }
+    print(f"{stats['file']}: {stats['rows']:,} rows in {elapsed:.1f}s ({stats['rows_per_s']:,.0f} rows/s), peak RSS {stats['peak_rss_mb']:,.0f} MB")
+    return stats
+
+def copy_df_weather(cur, df: pd.DataFrame, table: str, columns: list[str], binary=False):
     """
     Stream a weather DataFrame directly into PostgreSQL using COPY FROM STDIN.
 
@@ -185,33 +417,47 @@ def copy_df_weather(cur, df: pd.DataFrame, table: str, columns: list[str]):
       - df comes directly from get_weather_data()
       - target table already exists
       - column names and types are compatible
+
+    With binary=True values are converted to the table's column types on the client and sent in binary COPY format.
     """
 
-    # Enforce column presence + order (NO type normalization)
+    # Enforce column presence + order
     df = df.reindex(columns=columns)
 
+    if binary:
+        copy_df_binary(cur, df, table, columns)
+        return
+
+    # whole-number columns are rendered without a decimal point: a column with gaps arrives as float, and "23.0" is not valid input for smallint or integer
+    for col, (data_type, _) in zip(columns, get_column_types(cur, table, columns)):
+        if data_type in ("smallint", "integer", "bigint"):
+            df[col] = pd.to_numeric(df[col], errors="coerce").round().astype("Int64")
+
     buf = StringIO()
 
     print(f"Streaming data into buffer for table '{table}'...")
-    df.to_csv(
-        buf,
-        index=False,
-        header=True,
-        na_rep="",   # empty fields -> NULL in Postgres
-    )
+    with stage("render_csv", table=table, rows=len(df)) as m:
+        df.to_csv(
+            buf,
+            index=False,
+            header=True,
+            na_rep="",   # empty fields -> NULL in Postgres
+        )
+        m["bytes"] = buf.tell()
     buf.seek(0)
 
     print(f"Copying data into '{table}'...")
-    cur.copy_expert(
-        f"""
-        COPY {table} (
-            {", ".join(columns)}
+    with stage("copy", table=table, rows=len(df), bytes=m["bytes"]):
+        cur.copy_expert(
+            f"""
+            COPY {table} (
+                {", ".join(columns)}
+            )
+            FROM STDIN
+            WITH (FORMAT CSV, HEADER TRUE)
+            """,
+            buf,
         )
-        FROM STDIN
-        WITH (FORMAT CSV, HEADER TRUE)
-        """,
-        buf,
-    )
 
 def create_rouser(cur):
     """Create a read-only analytics role with limited connections and SELECT-only privileges on all current and future tables in the public schema."""
@@ -240,3 +486,65 @@ def create_rouser(cur):
 
     print("Creating / updating read-only analytics role 'rouser'...")
     cur.execute(sql)
+
+def stream_query(conn, sql, params=None, fetch_size=FETCH_SIZE, arrow=False):
+    """Run a query through a named server-side cursor and yield the result in chunks of at most fetch_size rows, as typed data frames or, with arrow=True, as pyarrow RecordBatches. Only one chunk is held in memory at a time, so large row-level results can be aggregated or written out incrementally.
+
+    conn is a psycopg2 connection. On an autocommit connection the cursor is declared WITH HOLD so it outlives the implicit transaction. Otherwise the query runs in the connection's transaction, which is ended again afterwards if the stream started it.
+    """
+
+    started_tx = not conn.autocommit and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}", withhold=conn.autocommit)
+    psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, cur)
+    try:
+        cur.itersize = fetch_size
+        cur.execute(sql, params)
+
+        schema = None
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            # a named cursor only has a description once the first rows are fetched
+            if schema is None:
+                schema = [(d.name, result_type(d.type_code)) for d in cur.description]
+                batch_schema = arrow_schema(schema)
+
+            df = result_frame(rows, schema)
+            if arrow:
+                yield pa.RecordBatch.from_pandas(df, schema=batch_schema, preserve_index=False)
+            else:
+                yield df
+    finally:
+        cur.close()
+        if started_tx:
+            conn.rollback()
+
+def empty_result(conn, sql, params=None) -> pd.DataFrame:
+    """A data frame with the columns sql returns, typed like the chunks of stream_query(), but no rows. stream_query() yields nothing for an empty result, so this stands in when the columns are still needed."""
+    started_tx = not conn.autocommit and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM ({sql}) AS q LIMIT 0", params)
+            return result_frame([], [(d.name, result_type(d.type_code)) for d in cur.description])
+    finally:
+        if started_tx:
+            conn.rollback()
+
+def result_type(type_code):
+    """pandas and arrow type of a result column: RESULT_TYPES for its oid, a string for any other type. Inferring them per chunk would give an all-NULL chunk a different type from the rest."""
+    return RESULT_TYPES.get(type_code, STRING_RESULT)
+
+def result_frame(rows, schema):
+    """Build a data frame from fetched rows, casting each column to its result_type() dtype."""
+    df = pd.DataFrame.from_records(rows, columns=[name for name, _ in schema], coerce_float=True)
+    for name, (dtype, _) in schema:
+        if dtype.startswith("datetime64"):
+            df[name] = pd.to_datetime(df[name], utc=dtype.endswith("UTC]")).astype(dtype)
+        else:
+            df[name] = df[name].astype(dtype)
+    return df
+
+def arrow_schema(schema):
+    """Arrow schema of a streamed query's chunks."""
+    return pa.schema([pa.field(name, arrow_type) for name, (_, arrow_type) in schema])
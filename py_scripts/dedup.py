@@ -0,0 +1,215 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from py_scripts.db_operations import stream_query
+from py_scripts.ledger import mark_fingerprinted
+from py_scripts.prep_data import CANONICAL_COLS
+
+FINGERPRINT_DIR = "fingerprints"
+FINGERPRINT_BUCKETS = 256
+# bumped whenever row_fingerprints() changes what it hashes; a store written by another version is rebuilt from rides_raw
+FINGERPRINT_VERSION = 2
+VERSION_FILE = "version"
+NA_INT = np.iinfo(np.int64).min
+NA_STR = "\x00"
+
+# Trips that show up in more than one source file are dropped before COPY. Every row is reduced to a 64-bit fingerprint of its canonical columns, and the fingerprints of everything loaded so far are kept on disk, split by their top bits into buckets:
+#
+#   fingerprints/
+#     bucket-000/000000000012.npy   sorted, unique uint64 segments
+#     bucket-000/000000000015.npy
+#     ...
+#
+# Each commit adds one small segment per bucket, and a bucket's newest segments are merged whenever the newest is at least half the size of the one before it, so a bucket holds O(log n) segments and every fingerprint is rewritten O(log n) times. Lookups binary search memory-mapped segments and merges only ever load one bucket, so memory stays flat however many rows have been loaded.
+#
+# Fingerprints only cover what the source file itself says. Old layout rows carry no coordinates (and no rideable type), whatever backfill_coordinates() fills in from the station index at load time is left out, so the same trip gets the same fingerprint however the index changed between the loads of two overlapping files.
+#
+# Only rows seen in *other* files are duplicates. Identical rows within one file are kept: old layout timestamps are to the minute, so two people riding together can produce identical canonical rows. A fingerprint collision (around 1 in 400 at 300 million rows) drops one trip.
+
+def row_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    """64-bit hash of every row's CANONICAL_COLS. Values are brought to fixed types first, so the same trip gets the same fingerprint whether it comes from normalize_bikeshare_df(), a parquet file or rides_raw. The coordinates of rows without a rideable type, the old layout ones, are hashed as missing: they only ever come from the station index."""
+    canonical = {}
+    old_layout = df["rideable_type"].isna().to_numpy()
+    for col in CANONICAL_COLS:
+        values = df[col]
+        if col in ("started_at", "ended_at"):
+            canonical[col] = values.astype("datetime64[ns]").to_numpy().view("i8")
+        elif col.endswith("_id"):
+            canonical[col] = pd.to_numeric(values).astype("Int64").to_numpy(dtype="int64", na_value=NA_INT)
+        elif col.endswith(("_lat", "_lng")):
+            micro = np.round(values.to_numpy(dtype="float64", na_value=np.nan) * 1e6)
+            canonical[col] = np.where(np.isnan(micro) | old_layout, NA_INT, micro).astype("int64")
+        else:
+            canonical[col] = values.astype("string").fillna(NA_STR).to_numpy(dtype=object)
+    return pd.util.hash_pandas_object(pd.DataFrame(canonical), index=False).to_numpy()
+
+class FingerprintStore:
+    """On-disk set of the fingerprints of every trip loaded so far. Use source() around each file's load; it can be shared by the loader threads of a parallel load."""
+
+    def __init__(self, store_dir, buckets=FINGERPRINT_BUCKETS):
+        if buckets & (buckets - 1) or not 2 <= buckets <= 65536:
+            raise ValueError(f"buckets must be a power of two up to 65536, got {buckets}")
+        self.store_dir = Path(store_dir)
+        self.buckets = buckets
+        self._shift = np.uint64(64 - buckets.bit_length() + 1)
+        self._lock = threading.Lock()
+        # fingerprints of files being loaded right now, by source, so concurrent loads of overlapping files don't both go through
+        self._in_flight = {}
+
+    def is_empty(self) -> bool:
+        return not any(self.store_dir.glob("bucket-*/*.npy"))
+
+    def is_outdated(self) -> bool:
+        """True if the stored fingerprints were computed by another FINGERPRINT_VERSION of row_fingerprints(), so they no longer match the rows they came from. clear() it and rebuild_fingerprints()."""
+        version_path = self.store_dir / VERSION_FILE
+        return not self.is_empty() and (not version_path.exists() or version_path.read_text().strip() != str(FINGERPRINT_VERSION))
+
+    def clear(self):
+        """Remove every stored fingerprint."""
+        with self._lock:
+            for bucket_dir in self.store_dir.glob("bucket-*"):
+                shutil.rmtree(bucket_dir)
+            (self.store_dir / VERSION_FILE).unlink(missing_ok=True)
+
+    @contextmanager
+    def source(self, name):
+        """Deduplicate one source file inside a with block. Pass each normalized chunk through the yielded SourceDedup's filter() before copying it. The file's fingerprints are stored when the block exits cleanly, so put it outside the block that commits the rows, e.g. `with store.source(name) as seen, ledger_entry(...)`. On error nothing is stored."""
+        seen = SourceDedup(self, name)
+        try:
+            yield seen
+            self.add(seen.fingerprints())
+        finally:
+            with self._lock:
+                self._in_flight.pop(name, None)
+        if seen.duplicates:
+            print(f"{name}: dropped {seen.duplicates:,} rows already loaded from other files")
+
+    def contains(self, fingerprints: np.ndarray, exclude=None) -> np.ndarray:
+        """Boolean mask of the fingerprints that are stored or being loaded by a source other than exclude."""
+        with self._lock:
+            return self._contains(fingerprints, exclude)
+
+    def _contains(self, fingerprints, exclude=None):
+        found = np.zeros(len(fingerprints), dtype=bool)
+        for bucket, idx in self._by_bucket(fingerprints):
+            values = fingerprints[idx]
+            for segment in self._segments(bucket):
+                found[idx] |= _isin_sorted(values, np.load(segment, mmap_mode="r"))
+        for name, pending in self._in_flight.items():
+            if name != exclude:
+                found |= _isin_sorted(fingerprints, pending)
+        return found
+
+    def _claim(self, name, fingerprints):
+        """Duplicates mask for a chunk of source name, registering the chunk as in flight in the same step."""
+        with self._lock:
+            found = self._contains(fingerprints, exclude=name)
+            pending = self._in_flight.get(name, np.empty(0, dtype=np.uint64))
+            self._in_flight[name] = np.union1d(pending, fingerprints[~found])
+            return found
+
+    def add(self, fingerprints: np.ndarray):
+        """Store fingerprints: one new segment per bucket they fall in, then each of those buckets is compacted."""
+        fingerprints = np.unique(fingerprints)
+        with self._lock:
+            # only a store started by this version is marked with it; an outdated one stays outdated until cleared
+            if len(fingerprints) and self.is_empty():
+                self.store_dir.mkdir(parents=True, exist_ok=True)
+                (self.store_dir / VERSION_FILE).write_text(f"{FINGERPRINT_VERSION}\n")
+            for bucket, idx in self._by_bucket(fingerprints):
+                bucket_dir = self.store_dir / f"bucket-{bucket:03d}"
+                bucket_dir.mkdir(parents=True, exist_ok=True)
+                segments = self._segments(bucket)
+                seq = int(segments[-1].stem) + 1 if segments else 0
+                _save(bucket_dir / f"{seq:012d}.npy", fingerprints[idx])
+                self._compact(bucket)
+
+    def _compact(self, bucket):
+        segments = self._segments(bucket)
+        sizes = [_length(s) for s in segments]
+        while len(segments) >= 2 and 2 * sizes[-1] >= sizes[-2]:
+            merged = np.union1d(np.load(segments[-2]), np.load(segments[-1]))
+            # the merged segment takes the newer name; a crash before the older one is removed only leaves values stored twice
+            _save(segments[-1], merged)
+            segments[-2].unlink()
+            del segments[-2], sizes[-2]
+            sizes[-1] = len(merged)
+
+    def _segments(self, bucket):
+        return sorted((self.store_dir / f"bucket-{bucket:03d}").glob("*.npy"))
+
+    def _by_bucket(self, fingerprints):
+        buckets = (fingerprints >> self._shift).astype(np.int64)
+        order = np.argsort(buckets, kind="stable")
+        present, starts = np.unique(buckets[order], return_index=True)
+        return zip(present, np.split(order, starts[1:]))
+
+@contextmanager
+def dedup_source(store, name, cur=None):
+    """store.source(name), or a SourceDedup that lets every row through when store is None, so load paths can deduplicate unconditionally. Given cur, name is the file's ingest ledger key and its ledger row is marked as fingerprinted once the fingerprints are stored."""
+    if store is None:
+        yield SourceDedup(None, name)
+        return
+    with store.source(name) as seen:
+        yield seen
+    if cur is not None:
+        mark_fingerprinted(cur, [name])
+
+class SourceDedup:
+    """Duplicate filter for the rows of one source file, from FingerprintStore.source()."""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.rows = 0
+        self.duplicates = 0
+
+    def duplicated(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Mask of the rows, given by their fingerprints, that were already loaded from another file."""
+        if self.store is None:
+            return np.zeros(len(fingerprints), dtype=bool)
+        found = self.store._claim(self.name, fingerprints)
+        self.rows += len(fingerprints)
+        self.duplicates += int(found.sum())
+        return found
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """df without the rows already loaded from another file."""
+        if self.store is None:
+            return df
+        found = self.duplicated(row_fingerprints(df))
+        return df[~found] if found.any() else df
+
+    def fingerprints(self):
+        with self.store._lock:
+            return self.store._in_flight.get(self.name, np.empty(0, dtype=np.uint64))
+
+def rebuild_fingerprints(conn, store: FingerprintStore, fetch_size=500_000):
+    """Add the fingerprints of every trip in rides_raw to store: to fill an empty store for a database loaded before deduplication was turned on, or to catch up on files whose rows were committed but whose fingerprints were never stored (see unfingerprinted_files() in py_scripts/ledger.py). Fingerprints already stored are simply stored again. Use a connection without autocommit, such as get_conn_analytics()."""
+    print("Fingerprinting the trips already in rides_raw...")
+    rows = 0
+    for df in stream_query(conn, f"SELECT {', '.join(CANONICAL_COLS)} FROM rides_raw", fetch_size=fetch_size):
+        store.add(row_fingerprints(df))
+        rows += len(df)
+    print(f"Fingerprinted {rows:,} trips.")
+
+def _isin_sorted(values, sorted_unique):
+    if not len(sorted_unique):
+        return np.zeros(len(values), dtype=bool)
+    pos = np.searchsorted(sorted_unique, values)
+    pos[pos == len(sorted_unique)] = 0
+    return sorted_unique[pos] == values
+
+def _length(path):
+    return np.load(path, mmap_mode="r").shape[0]
+
+def _save(path, values):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp, path)
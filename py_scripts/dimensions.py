@@ -0,0 +1,187 @@
+import pandas as pd
+
+# Compact rides layout: rides_fact keeps small integer keys instead of repeating station names, rideable types and member types as TEXT on every row. The rides_raw view joins them back, so queries written against the raw layout keep working.
+create_dimension_tables = """
+CREATE TABLE IF NOT EXISTS stations (
+    station_key   SERIAL PRIMARY KEY,
+    station_id    INTEGER,
+    station_name  TEXT,
+    UNIQUE NULLS NOT DISTINCT (station_id, station_name)
+);
+
+CREATE TABLE IF NOT EXISTS rideable_types (
+    rideable_type_id  SMALLSERIAL PRIMARY KEY,
+    rideable_type     TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS member_types (
+    member_type_id  SMALLSERIAL PRIMARY KEY,
+    member_casual   TEXT NOT NULL UNIQUE
+);
+"""
+
+create_rides_fact = """
+CREATE TABLE IF NOT EXISTS rides_fact (
+    started_at         TIMESTAMP,
+    ended_at           TIMESTAMP,
+    start_station_key  INTEGER REFERENCES stations,
+    end_station_key    INTEGER REFERENCES stations,
+    rideable_type_id   SMALLINT REFERENCES rideable_types,
+    member_type_id     SMALLINT REFERENCES member_types,
+    start_lat          NUMERIC(9,6),
+    start_lng          NUMERIC(9,6),
+    end_lat            NUMERIC(9,6),
+    end_lng            NUMERIC(9,6)
+);
+"""
+
+# LEFT JOINs on unique keys let the planner drop every join a query doesn't reference
+create_rides_raw_view = """
+CREATE OR REPLACE VIEW rides_raw AS
+SELECT
+    f.started_at,
+    f.ended_at,
+    ss.station_id    AS start_station_id,
+    ss.station_name  AS start_station_name,
+    es.station_id    AS end_station_id,
+    es.station_name  AS end_station_name,
+    f.start_lat,
+    f.start_lng,
+    f.end_lat,
+    f.end_lng,
+    rt.rideable_type,
+    mt.member_casual
+FROM rides_fact f
+LEFT JOIN stations ss ON ss.station_key = f.start_station_key
+LEFT JOIN stations es ON es.station_key = f.end_station_key
+LEFT JOIN rideable_types rt ON rt.rideable_type_id = f.rideable_type_id
+LEFT JOIN member_types mt ON mt.member_type_id = f.member_type_id;
+"""
+
+FACT_COLS = [
+    "started_at",
+    "ended_at",
+    "start_station_key",
+    "end_station_key",
+    "rideable_type_id",
+    "member_type_id",
+    "start_lat",
+    "start_lng",
+    "end_lat",
+    "end_lng",
+]
+
+def create_compact_rides_tables(cur):
+    """Create the dimension tables, the integer-keyed rides_fact table and the rides_raw compatibility view."""
+    cur.execute("SELECT to_regclass('rides_raw'), (SELECT relkind FROM pg_class WHERE oid = to_regclass('rides_raw'))")
+    existing, relkind = cur.fetchone()
+    if existing is not None and relkind != "v":
+        raise RuntimeError("rides_raw already exists as a table. Drop it, or keep the raw layout, before creating the compact layout.")
+
+    cur.execute(create_dimension_tables)
+    cur.execute(create_rides_fact)
+    cur.execute(create_rides_raw_view)
+
+class DimensionCache:
+    """In-memory copy of the dimension tables used to turn normalized rides into rides_fact rows. Values not seen before are inserted on the fly; the tables are small enough to reload whole after each insert.
+
+    Inserted inside a caller's transaction, e.g. ledger_entry(), new dimension rows only exist once it commits. The cache remembers that transaction and reloads itself on the next to_fact() if it was rolled back, so it never hands out keys the rollback took with it.
+    """
+
+    def __init__(self, cur):
+        self.reload(cur)
+
+    def reload(self, cur):
+        """Read the dimension tables again."""
+        self.stations = self._load(cur, "SELECT station_key, station_id, station_name FROM stations")
+        self.rideable_types = self._load(cur, "SELECT rideable_type_id, rideable_type FROM rideable_types")
+        self.member_types = self._load(cur, "SELECT member_type_id, member_casual FROM member_types")
+        self._insert_txid = None
+
+    def to_fact(self, cur, df: pd.DataFrame) -> pd.DataFrame:
+        """Map a frame from normalize_bikeshare_df onto FACT_COLS."""
+        self._check_inserts(cur)
+        fact = df[["started_at", "ended_at", "start_lat", "start_lng", "end_lat", "end_lng"]].copy()
+
+        for side in ("start", "end"):
+            pairs = pd.DataFrame({
+                "station_id": df[f"{side}_station_id"],
+                "station_name": df[f"{side}_station_name"],
+            })
+            fact[f"{side}_station_key"] = self._station_keys(cur, pairs)
+
+        fact["rideable_type_id"] = self._label_keys(cur, df["rideable_type"], "rideable_types", "rideable_type_id", "rideable_type")
+        fact["member_type_id"] = self._label_keys(cur, df["member_casual"], "member_types", "member_type_id", "member_casual")
+
+        return fact[FACT_COLS]
+
+    def _station_keys(self, cur, pairs):
+        new = self._unknown(pairs.drop_duplicates().dropna(how="all"), self.stations, ["station_id", "station_name"])
+        if len(new):
+            cur.execute(
+                """
+                INSERT INTO stations (station_id, station_name)
+                SELECT * FROM unnest(%s::integer[], %s::text[])
+                ON CONFLICT DO NOTHING
+                """,
+                (
+                    [None if pd.isna(v) else int(v) for v in new["station_id"]],
+                    [None if pd.isna(v) else v for v in new["station_name"]],
+                ),
+            )
+            self.stations = self._load(cur, "SELECT station_key, station_id, station_name FROM stations")
+            self._track_inserts(cur)
+
+        # pandas matches missing values to each other in merge keys, the same as the NULLS NOT DISTINCT constraint
+        keys = pairs.merge(self.stations, on=["station_id", "station_name"], how="left")["station_key"]
+        keys[pairs.isna().all(axis=1).to_numpy()] = pd.NA
+        return keys.array
+
+    def _label_keys(self, cur, labels, table, key_col, label_col):
+        known = getattr(self, table)
+        new = self._unknown(labels.dropna().drop_duplicates().to_frame(label_col), known, [label_col])
+        if len(new):
+            cur.execute(
+                f"INSERT INTO {table} ({label_col}) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING",
+                (list(new[label_col]),),
+            )
+            known = self._load(cur, f"SELECT {key_col}, {label_col} FROM {table}")
+            setattr(self, table, known)
+            self._track_inserts(cur)
+
+        lookup = pd.Series(known[key_col].to_numpy(), index=known[label_col].to_numpy())
+        return labels.map(lookup).astype("Int16")
+
+    def _track_inserts(self, cur):
+        # NULL when the insert committed on its own, on an autocommit connection outside a transaction
+        cur.execute("SELECT txid_current_if_assigned()")
+        self._insert_txid = cur.fetchone()[0] or self._insert_txid
+
+    def _check_inserts(self, cur):
+        if self._insert_txid is None:
+            return
+        cur.execute("SELECT txid_current_if_assigned() = %(txid)s, txid_status(%(txid)s)", {"txid": self._insert_txid})
+        same_transaction, status = cur.fetchone()
+        if same_transaction:
+            return
+        if status != "committed":
+            print("Reloading the dimension tables, new rows were rolled back.")
+            self.reload(cur)
+        self._insert_txid = None
+
+    @staticmethod
+    def _unknown(values, known, on):
+        merged = values.merge(known[on].assign(_known=True), on=on, how="left")
+        return merged.loc[merged["_known"].isna(), on]
+
+    @staticmethod
+    def _load(cur, sql):
+        cur.execute(sql)
+        columns = [d[0] for d in cur.description]
+        df = pd.DataFrame(cur.fetchall(), columns=columns)
+        for col in columns:
+            if col.endswith("_key") or col.endswith("_id"):
+                df[col] = df[col].astype("Int64")
+            else:
+                df[col] = df[col].astype("string")
+        return df
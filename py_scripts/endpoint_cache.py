@@ -0,0 +1,58 @@
+import json
+import os
+import time
+from pathlib import Path
+import psycopg2
+
+ENDPOINT_CACHE = "rds_endpoint.json"
+ENDPOINT_TTL_S = 7 * 24 * 3600
+HOST_ENV = "BIKESHARE_DB_HOST"
+PORT_ENV = "BIKESHARE_DB_PORT"
+DBNAME_ENV = "BIKESHARE_DB_NAME"
+
+# Finding the RDS endpoint takes an AWS describe_db_instances round trip, and importing boto3, for a hostname that only changes when the instance is recreated. Lookups are cached in a small JSON file per region and instance and reused for ENDPOINT_TTL_S. BIKESHARE_DB_HOST (with optional BIKESHARE_DB_PORT and BIKESHARE_DB_NAME) skips discovery altogether, e.g. for a tunnel or a local copy of the database.
+#
+# A cached endpoint that stopped working is looked up again when a connection to it fails, see connect_cached(). libpq's PGCONNECT_TIMEOUT bounds how long such a failure takes to show up.
+
+def get_conn_info(inst_name, reg_name, cache_path, ttl=ENDPOINT_TTL_S, refresh=False) -> dict:
+    """Connection info for an RDS instance in the shape of get_rds_conn_info(): from the environment override when set, else from the cache at cache_path while it is younger than ttl seconds, else looked up on AWS and cached. refresh=True ignores the cache."""
+    return _lookup(inst_name, reg_name, cache_path, ttl, refresh)[0]
+
+def connect_cached(connect, inst_name, reg_name, cache_path, ttl=ENDPOINT_TTL_S, refresh=False):
+    """connect(conn_info), e.g. get_conn_analytics, with the connection info from get_conn_info(). When connecting to a cached endpoint fails, the endpoint is looked up again and the connection retried once. Returns the connection and the connection info it used."""
+    conn_info, source = _lookup(inst_name, reg_name, cache_path, ttl, refresh)
+    try:
+        return connect(conn_info), conn_info
+    except psycopg2.OperationalError as e:
+        if source != "cache":
+            raise
+        print(f"Connecting to the cached endpoint {conn_info['host']} failed, looking it up again: {str(e).strip()}")
+    conn_info, _ = _lookup(inst_name, reg_name, cache_path, ttl, refresh=True)
+    return connect(conn_info), conn_info
+
+def _lookup(inst_name, reg_name, cache_path, ttl, refresh):
+    """The connection info and where it came from: "env", "cache" or "aws"."""
+    if os.environ.get(HOST_ENV):
+        return {
+            "host": os.environ[HOST_ENV],
+            "port": int(os.environ.get(PORT_ENV, 5432)),
+            "dbname": os.environ.get(DBNAME_ENV, inst_name),
+        }, "env"
+
+    cache_path = Path(cache_path)
+    key = f"{reg_name}/{inst_name}"
+    entries = json.loads(cache_path.read_text()) if cache_path.exists() else {}
+    entry = entries.get(key)
+    if not refresh and entry is not None and time.time() - entry["fetched_at"] < ttl:
+        return entry["conn_info"], "cache"
+
+    # boto3 is only imported when the cache can't answer
+    from py_scripts.rds_provision import get_rds_conn_info
+
+    conn_info = get_rds_conn_info(inst_name, reg_name)
+    entries[key] = {"conn_info": conn_info, "fetched_at": time.time()}
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(entries, indent=1))
+    os.replace(tmp_path, cache_path)
+    return conn_info, "aws"
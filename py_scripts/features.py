@@ -0,0 +1,163 @@
+from datetime import timedelta
+import pandas as pd
+
+from py_scripts.prep_data import hourly_weather_columns
+
+DAILY_FEATURE_COLS = [
+    "temperature_2m_max",
+    "temperature_2m_min",
+    "precipitation_sum",
+    "snowfall_sum",
+    "precipitation_hours",
+    "daylight_duration",
+]
+
+# at most this many started_at ranges bound the rides a refresh reads, so partitions outside them are skipped; stale days further apart than that are read with the days in between
+MAX_REFRESH_RANGES = 32
+
+# One row per hour with its ridership next to that hour's weather and the day's weather (prefixed day_). Hours come from both sides of the join, so hours without a single ride are kept, as are rides from before the weather history starts. {rides_where} and {weather_where} pick the hours, see _rides_weather_sql().
+_rides_weather_select = f"""
+WITH rides AS (
+    SELECT
+        date_trunc('hour', started_at) AS hour,
+        COUNT(*) AS ride_count,
+        COUNT(*) FILTER (WHERE member_casual = 'member') AS member_rides,
+        COUNT(*) FILTER (WHERE member_casual = 'casual') AS casual_rides,
+        COUNT(*) FILTER (WHERE rideable_type = 'classic_bike') AS classic_bike_rides,
+        COUNT(*) FILTER (WHERE rideable_type = 'electric_bike') AS electric_bike_rides,
+        COUNT(*) FILTER (WHERE rideable_type = 'docked_bike') AS docked_bike_rides,
+        AVG(EXTRACT(EPOCH FROM ended_at - started_at)) AS mean_duration_s,
+        AVG(EXTRACT(EPOCH FROM ended_at - started_at)) FILTER (WHERE member_casual = 'member') AS member_mean_duration_s,
+        AVG(EXTRACT(EPOCH FROM ended_at - started_at)) FILTER (WHERE member_casual = 'casual') AS casual_mean_duration_s,
+        COUNT(DISTINCT start_station_id) AS start_stations,
+        COUNT(DISTINCT end_station_id) AS end_stations
+    FROM rides_raw
+    WHERE {{rides_where}}
+    GROUP BY 1
+),
+weather AS (
+    -- the local-time series repeats an hour when daylight saving time ends
+    SELECT DISTINCT ON (time) *
+    FROM hourly_weather
+    WHERE {{weather_where}}
+    ORDER BY time
+)
+SELECT
+    COALESCE(w.time, r.hour) AS hour,
+    COALESCE(r.ride_count, 0) AS ride_count,
+    COALESCE(r.member_rides, 0) AS member_rides,
+    COALESCE(r.casual_rides, 0) AS casual_rides,
+    COALESCE(r.classic_bike_rides, 0) AS classic_bike_rides,
+    COALESCE(r.electric_bike_rides, 0) AS electric_bike_rides,
+    COALESCE(r.docked_bike_rides, 0) AS docked_bike_rides,
+    r.mean_duration_s,
+    r.member_mean_duration_s,
+    r.casual_mean_duration_s,
+    COALESCE(r.start_stations, 0) AS start_stations,
+    COALESCE(r.end_stations, 0) AS end_stations,
+    w.time IS NOT NULL AS has_weather,
+    {", ".join(f"w.{c}" for c in hourly_weather_columns[1:])},
+    {", ".join(f"d.{c} AS day_{c}" for c in DAILY_FEATURE_COLS)}
+FROM rides r
+FULL JOIN weather w ON w.time = r.hour
+LEFT JOIN daily_weather d ON d.time = COALESCE(w.time, r.hour)::date
+"""
+
+# the table takes its column types from the query itself, so it follows the source tables
+create_rides_weather_hourly_sql = f"""
+CREATE TABLE IF NOT EXISTS rides_weather_hourly AS
+{_rides_weather_select.format(rides_where="false", weather_where="false")}
+WITH NO DATA;
+
+CREATE UNIQUE INDEX IF NOT EXISTS rides_weather_hourly_hour ON rides_weather_hourly (hour);
+"""
+
+# hours whose feature row is missing or out of date: no feature row yet, a ride count that differs from the rides_hourly rollup, or weather that arrived after the rides, which covers both newly loaded rides and newly appended weather
+_stale_hours_sql = """
+WITH rides AS (
+    SELECT hour, SUM(ride_count) AS ride_count
+    FROM rides_hourly
+    WHERE hour IS NOT NULL
+    GROUP BY hour
+),
+expected AS (
+    SELECT COALESCE(r.hour, w.time) AS hour, COALESCE(r.ride_count, 0) AS ride_count, w.time IS NOT NULL AS has_weather
+    FROM rides r
+    FULL JOIN (SELECT DISTINCT time FROM hourly_weather) w ON w.time = r.hour
+)
+SELECT e.hour
+FROM expected e
+LEFT JOIN rides_weather_hourly f ON f.hour = e.hour
+WHERE f.hour IS NULL OR f.ride_count <> e.ride_count OR f.has_weather <> e.has_weather
+"""
+
+def create_rides_weather_hourly(cur):
+    cur.execute(create_rides_weather_hourly_sql)
+
+def _rides_weather_sql(ranges, hours_table=None):
+    """_rides_weather_select over the rides started in any of ranges, a list of (start, end) pairs, and, given hours_table, only the hours it lists. Returns the SQL and its parameters."""
+    params = {}
+    for i, (start, end) in enumerate(ranges):
+        params[f"start_{i}"], params[f"end_{i}"] = start, end
+    rides_where, weather_where = (
+        "(" + " OR ".join(f"({col} >= %(start_{i})s AND {col} < %(end_{i})s)" for i in range(len(ranges))) + ")"
+        for col in ("started_at", "time")
+    )
+    if hours_table is not None:
+        rides_where += f" AND date_trunc('hour', started_at) IN (SELECT hour FROM {hours_table})"
+        weather_where += f" AND time IN (SELECT hour FROM {hours_table})"
+    return _rides_weather_select.format(rides_where=rides_where, weather_where=weather_where), params
+
+def refresh_ranges(hours, max_ranges=MAX_REFRESH_RANGES):
+    """Cover hours with at most max_ranges (start, end) ranges of whole days: runs of consecutive days become one range, and when there are too many, the runs closest together are joined."""
+    days = sorted({pd.Timestamp(h).normalize() for h in hours})
+    if not days:
+        return []
+    ranges = [[days[0], days[0] + timedelta(days=1)]]
+    for day in days[1:]:
+        if day == ranges[-1][1]:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+
+    if len(ranges) > max_ranges:
+        # keep the widest gaps as the splits between ranges
+        gaps = sorted(range(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1], reverse=True)
+        splits = sorted(gaps[:max_ranges - 1])
+        joined, first = [], 0
+        for i in splits + [len(ranges) - 1]:
+            joined.append([ranges[first][0], ranges[i][1]])
+            first = i + 1
+        ranges = joined
+    return [(start.to_pydatetime(), end.to_pydatetime()) for start, end in ranges]
+
+def stale_hours(cur) -> list:
+    """Hours whose rides_weather_hourly row is missing or out of date, oldest first. An hour is stale when it has no feature row yet, its ride count differs from the rides_hourly rollup, or its weather arrived after its rides, which covers both newly loaded rides and newly appended weather."""
+    cur.execute(_stale_hours_sql + " ORDER BY 1")
+    return [hour for (hour,) in cur.fetchall()]
+
+def refresh_rides_weather_hourly(cur, start=None, end=None):
+    """Recompute rides_weather_hourly for hours from start up to (not including) end, in one transaction, or in the caller's (see db_operations.transaction()). Without bounds only the stale_hours() are recomputed, so this can run after every load and only touches the hours that load changed: the rides are read from the days around them (see refresh_ranges()), and a late correction to old weather doesn't recompute every hour since."""
+    # db_operations imports this module, so transaction() is imported when it's needed
+    from py_scripts.db_operations import transaction
+
+    with transaction(cur):
+        if start is not None and end is not None:
+            print(f"Refreshing rides_weather_hourly from {start} to {end}...")
+            cur.execute("DELETE FROM rides_weather_hourly WHERE hour >= %(start)s AND hour < %(end)s", {"start": start, "end": end})
+            sql, params = _rides_weather_sql([(start, end)])
+        else:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS stale_feature_hours (hour TIMESTAMP PRIMARY KEY)")
+            cur.execute("TRUNCATE stale_feature_hours")
+            cur.execute("INSERT INTO stale_feature_hours " + _stale_hours_sql)
+            cur.execute("SELECT hour FROM stale_feature_hours ORDER BY hour")
+            hours = [hour for (hour,) in cur.fetchall()]
+            if not hours:
+                print("rides_weather_hourly is up to date.")
+                return
+            ranges = refresh_ranges(hours)
+            print(f"Refreshing {len(hours):,} stale hours of rides_weather_hourly between {hours[0]} and {hours[-1]}, read from {len(ranges)} date ranges...")
+            cur.execute("ANALYZE stale_feature_hours")
+            cur.execute("DELETE FROM rides_weather_hourly WHERE hour IN (SELECT hour FROM stale_feature_hours)")
+            sql, params = _rides_weather_sql(ranges, "stale_feature_hours")
+        cur.execute(f"INSERT INTO rides_weather_hourly {sql}", params)
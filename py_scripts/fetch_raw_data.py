@@ -1,122 +1,353 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from pathlib import Path
 import boto3
 from botocore import UNSIGNED
 from botocore.config import Config
-from io import BytesIO
 from tqdm import tqdm
 import sys
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import requests
 
-def get_bikeshare_data(root_dir):
-    """Stream bikeshare data into local csv files without downloading the individual zip files"""
+from py_scripts.prep_data import normalize_bikeshare_df, daily_weather_columns, hourly_weather_columns
+from py_scripts.telemetry import stage
 
-    BUCKET_NAME = "capitalbikeshare-data"
-    CSV_DIR = root_dir / "bikeshare_csv"
+BUCKET_NAME = "capitalbikeshare-data"
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_NAME = "_manifest.json"  # leading underscore keeps parquet readers from treating it as data
+PARQUET_CHUNK_ROWS = 250_000
+OUTPUT_DIRS = {"csv": "bikeshare_csv", "parquet": "bikeshare_parquet"}
+PARQUET_PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8())]), flavor="hive")
 
-    # Create the directory where the csv files will be kept after streaming and extracting the zip files in the s3 bucket.
-    if CSV_DIR.exists():
-        sys.exit(f"Directory {CSV_DIR} exists.\nExiting to avoid duplication.\nManually clear directory and re-run the script if needed.")
-    else:
-        CSV_DIR.mkdir()
-        print(f"Created {CSV_DIR}")
+WEATHER_URL = "https://archive-api.open-meteo.com/v1/archive"
+WEATHER_LOCATION = {"latitude": 38.8951, "longitude": -77.0364, "timezone": "America/New_York"}
+WEATHER_START = date(2010, 10, 20)
+WEATHER_SETTLE_DAYS = 5  # the archive lags a few days behind and revises recent days, so fetches stop this many days before today
+WEATHER_CACHE_DIR = "weather_cache"
+WEATHER_RETRIES = 4
 
-    # Initiate an s3 client to get data
-    s3 = boto3.client(
-        "s3",
-        config=Config(signature_version=UNSIGNED)
-    )
+def get_bikeshare_data(root_dir, workers=1, s3=None, output="csv", on_fetched=None):
+    """Incrementally sync bikeshare data from the s3 bucket without keeping the individual zip files. Archives whose ETag and size match the manifest are skipped, new or changed ones are streamed and extracted, several at a time when workers > 1.
+
+    output="csv" writes the raw csv members into bikeshare_csv/. output="parquet" normalizes each member while it streams in and writes zstd compressed parquet files into bikeshare_parquet/, partitioned as year=YYYY/month=M by started_at.
+
+    on_fetched is called with the paths of each archive's files as soon as that archive is extracted and recorded in the manifest, e.g. to start loading them while the rest is still downloading. It runs on the worker thread that fetched the archive.
+    """
+
+    if output not in OUTPUT_DIRS:
+        raise ValueError(f"output must be one of {sorted(OUTPUT_DIRS)}, got {output!r}")
+
+    OUT_DIR = root_dir / OUTPUT_DIRS[output]
+    manifest_path = OUT_DIR / MANIFEST_NAME
+
+    # Create the directory where the files will be kept after streaming and extracting the zip files in the s3 bucket. A directory filled before the manifest existed can't be synced safely since we don't know which archive each file came from.
+    if not OUT_DIR.exists():
+        OUT_DIR.mkdir()
+        print(f"Created {OUT_DIR}")
+    elif not manifest_path.exists() and any(OUT_DIR.glob("*.csv")):
+        sys.exit(f"Directory {OUT_DIR} has csv files but no {MANIFEST_NAME}.\nExiting to avoid duplication.\nManually clear directory once and re-run the script to switch to incremental fetching.")
+
+    manifest = load_manifest(manifest_path)
+
+    # Initiate an s3 client to get data. A client can be passed in instead, e.g. one pointed at a local S3 stand-in. boto3 clients are thread-safe so the workers share it.
+    if s3 is None:
+        s3 = boto3.client(
+            "s3",
+            config=Config(signature_version=UNSIGNED, max_pool_connections=max(10, workers))
+        )
+
+    archives = list_archives(s3)
+    pending = sorted((a for a in archives if not is_archive_current(manifest, a, OUT_DIR)), key=lambda a: a["key"])
+    print(f"{len(archives) - len(pending)} of {len(archives)} archives up to date, fetching {len(pending)}.")
+    if not pending:
+        return
+
+    # Every file name extracted so far, mapped to the archive it came from, and the csv members of every pending archive downloaded so far. Shared by the workers and guarded by the lock together with the manifest; the lock is a condition so an archive can wait for the member lists of the archives before it.
+    claims = {name: key for key, entry in manifest.items() for name in entry["files"]}
+    contents = {}
+    lock = threading.Condition()
+    order = [a["key"] for a in pending]
+
+    def fetch(archive, progress):
+        try:
+            files = fetch_archive(s3, archive, OUT_DIR, claims, lock, progress, output, contents, order)
+        finally:
+            # an archive that failed or wrote parquet claims no names, the ones after it must not wait for it
+            with lock:
+                contents.setdefault(archive["key"], [])
+                lock.notify_all()
+        with lock:
+            stale = set(manifest.get(archive["key"], {}).get("files", [])) - set(files)
+            for name in stale:
+                (OUT_DIR / name).unlink(missing_ok=True)
+                claims.pop(name, None)
+            manifest[archive["key"]] = {
+                "etag": archive["etag"],
+                "size": archive["size"],
+                "files": files,
+            }
+            save_manifest(manifest_path, manifest)
+        if on_fetched is not None:
+            on_fetched([OUT_DIR / name for name in files])
+
+    if workers <= 1:
+        for archive in pending:
+            fetch(archive, True)
+        return
 
+    print(f"Fetching {len(pending)} archives with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, archive, False) for archive in pending]
+        for future in tqdm(as_completed(futures), total=len(futures), unit="zip", desc="Archives"):
+            future.result()
+
+def list_archives(s3):
+    """Return key, size and ETag of every zip archive in the bikeshare bucket. This is a listing-only pass, no object is downloaded."""
     paginator = s3.get_paginator("list_objects_v2")
 
+    archives = []
     for page in paginator.paginate(Bucket=BUCKET_NAME):
         for obj in page.get("Contents", []):
-            key = obj["Key"]
-
-            if not key.lower().endswith(".zip"):
-                continue
-
-            size = obj["Size"]
-            print(f"Streaming + extracting {key}")
-
-            response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
-
-            # zip files are streamed into memory instead of downloaded into storage with progress bars.
-            buffer = BytesIO()
-            with tqdm(
-                total=size,
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                desc=key,
-            ) as pbar:
-                for chunk in response["Body"].iter_chunks(1024 * 1024):
-                    buffer.write(chunk)
-                    pbar.update(len(chunk))
-
-            buffer.seek(0)
-
-            # skipping all except the fist level csv files in the zipped folder
-            with zipfile.ZipFile(buffer) as z:
-                members = [
-                    m for m in z.namelist()
-                    if m.lower().endswith(".csv")
-                    and not m.startswith("__MACOSX/")
-                    and "/" not in m.strip("/")
-                ]
-
-                # Extracting and writing into csv files, extra logic to avoid file name collisions, which do exist based on inital manual investigation
-                for member in tqdm(members, desc="Extracting CSVs", leave=False):
-                    base = CSV_DIR / member
-
-                    if base.exists():
-                        stem = base.stem
-                        suffix = base.suffix
-                        i = 1
-                        while True:
-                            target = CSV_DIR / f"{stem}_{i}{suffix}"
-                            if not target.exists():
-                                break
-                            i += 1
-                    else:
-                        target = base
-
-                    with z.open(member) as src, open(target, "wb") as dst:
-                        dst.write(src.read())
-
-def get_weather_data():
-    """Fetch weather data and return daily and hourly dataframes."""
-
-    url = (
-        "https://archive-api.open-meteo.com/v1/archive"
-        "?latitude=38.8951&longitude=-77.0364"
-        "&start_date=2010-10-20&end_date=2025-11-30"
-        "&daily=weather_code,temperature_2m_mean,temperature_2m_max,temperature_2m_min,"
-        "apparent_temperature_mean,apparent_temperature_max,apparent_temperature_min,"
-        "sunrise,sunset,daylight_duration,sunshine_duration,precipitation_sum,rain_sum,"
-        "snowfall_sum,precipitation_hours,wind_speed_10m_max,wind_gusts_10m_max,"
-        "wind_direction_10m_dominant,wind_gusts_10m_mean,wind_speed_10m_mean,"
-        "wind_gusts_10m_min,wind_speed_10m_min,winddirection_10m_dominant,"
-        "dew_point_2m_mean,cloud_cover_mean,cloud_cover_max,cloud_cover_min,"
-        "relative_humidity_2m_mean,relative_humidity_2m_max,relative_humidity_2m_min,"
-        "pressure_msl_mean,surface_pressure_mean"
-        "&hourly=temperature_2m,weather_code,relative_humidity_2m,apparent_temperature,"
-        "precipitation,rain,snowfall,snow_depth,pressure_msl,surface_pressure,cloud_cover,"
-        "wind_speed_10m,wind_direction_10m,wind_direction_100m,wind_gusts_10m,"
-        "wind_speed_100m,is_day,dew_point_2m,cloud_cover_low,cloud_cover_mid,"
-        "cloud_cover_high,sunshine_duration"
-        "&timezone=America%2FNew_York"
+            if obj["Key"].lower().endswith(".zip"):
+                archives.append({"key": obj["Key"], "size": obj["Size"], "etag": obj["ETag"]})
+    return archives
+
+def load_manifest(path):
+    """Read the fetch manifest, an empty one if it does not exist yet."""
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    """Write the fetch manifest atomically so an interrupted run never leaves it half written."""
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def is_archive_current(manifest, archive, out_dir):
+    """True if the archive was already extracted with the same ETag and size and all of its files are still on disk."""
+    entry = manifest.get(archive["key"])
+    return (
+        entry is not None
+        and entry["etag"] == archive["etag"]
+        and entry["size"] == archive["size"]
+        and all((out_dir / name).exists() for name in entry["files"])
     )
 
-    print("Fetching weather data from Open-Meteo API...")
+def fetch_archive(s3, archive, out_dir, claims, lock, progress=True, output="csv", contents=None, order=()):
+    """Download one zip archive into a temporary file and extract its first level csv files into out_dir, either as they are or as normalized parquet. Returns the file names written, relative to out_dir.
+
+    csv members are named by claim_file_name() once the archives listed before this one in order, the sorted keys of the pending archives, have recorded their members in contents, so which archive keeps a contested name doesn't depend on which download finishes first."""
+
+    key = archive["key"]
+    if progress:
+        print(f"Streaming + extracting {key}")
+
+    response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+
+    # zip files are spooled to an anonymous temp file rather than held in memory, so peak memory does not depend on the archive size.
+    with tempfile.TemporaryFile() as buffer:
+        with stage("s3_download", source=key, bytes=archive["size"]), tqdm(
+            total=archive["size"],
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            desc=key,
+            disable=not progress,
+        ) as pbar:
+            for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+                buffer.write(chunk)
+                pbar.update(len(chunk))
+
+        buffer.seek(0)
+
+        # skipping all except the fist level csv files in the zipped folder
+        with zipfile.ZipFile(buffer) as z:
+            members = [
+                m for m in z.namelist()
+                if m.lower().endswith(".csv")
+                and not m.startswith("__MACOSX/")
+                and "/" not in m.strip("/")
+            ]
+
+            names = {}
+            if output != "parquet":
+                contents = {} if contents is None else contents
+                earlier = order[:order.index(key)] if key in order else []
+                with lock:
+                    contents[key] = members
+                    lock.notify_all()
+                    # the archives before this one were submitted first, so they are running or done
+                    lock.wait_for(lambda: all(k in contents for k in earlier))
+                    names = {member: claim_file_name(claims, key, member, contents) for member in members}
 
-    resp = requests.get(url, timeout=60)
-    resp.raise_for_status()
+            written = []
+            # Extracting and writing into csv files in chunks. Members are written to a temp name first and renamed when complete, so a crash never leaves a truncated csv behind.
+            for member in tqdm(members, desc="Extracting CSVs", leave=False, disable=not progress):
+                if output == "parquet":
+                    with stage("extract_parquet", source=member, bytes=z.getinfo(member).file_size), z.open(member) as src:
+                        stems = dict.fromkeys([Path(key).stem, Path(member).stem])
+                        written += write_member_parquet(src, out_dir, "-".join(stems))
+                    continue
 
-    data = resp.json()
+                name = names[member]
+                target = out_dir / name
+                partial = target.with_suffix(".part")
+                with stage("zip_extract", source=member, bytes=z.getinfo(member).file_size), z.open(member) as src, open(partial, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.replace(partial, target)
+                written.append(name)
 
-    daily_weather = pd.DataFrame(data["daily"])
-    hourly_weather = pd.DataFrame(data["hourly"])
+    return written
+
+def claim_file_name(claims, key, member, contents=None):
+    """Pick the local file name for a csv member of the given archive. File name collisions do exist across archives based on inital manual investigation; a name claimed in the manifest stays with its archive, otherwise the archive with the lowest key among those in contents ({key: csv members}) that have the member keeps it, and any other archive gets its own stem appended, e.g. 2017Q1.csv from 2017.zip becomes 2017Q1_2017.csv. The result only depends on the archives and the claims recorded in the manifest, so re-runs and other machines get the same names."""
+    owner = claims.get(member)
+    if owner is None:
+        owner = min((k for k, members in (contents or {}).items() if member in members), default=key)
+        claims[member] = owner
+    if owner == key:
+        return member
+    member_path = Path(member)
+    name = f"{member_path.stem}_{Path(key).stem}{member_path.suffix}"
+    claims[name] = key
+    return name
+
+def write_member_parquet(src, out_dir, file_stem):
+    """Normalize a csv stream chunk by chunk and write it as a parquet dataset partitioned by year and month of started_at. File names derive from file_stem, so re-extracting the same member overwrites its own files. Returns the paths written, relative to out_dir."""
+
+    written = []
+    with pd.read_csv(src, chunksize=PARQUET_CHUNK_ROWS, low_memory=False) as reader:
+        for i, chunk in enumerate(reader):
+            written += write_rides_parquet(normalize_bikeshare_df(chunk), out_dir, f"{file_stem}-{i}")
+
+    return written
+
+def write_rides_parquet(df, out_dir, file_stem):
+    """Write normalized rides into the parquet dataset at out_dir, partitioned by year and month of started_at, as files named after file_stem. Returns the paths written, relative to out_dir."""
+
+    # partition keys are added on the arrow side so they stay out of the pandas metadata; they live in the directory names, not in the files.
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.append_column("year", pa.array(df["started_at"].dt.year, type=pa.int16(), from_pandas=True))
+    table = table.append_column("month", pa.array(df["started_at"].dt.month, type=pa.int8(), from_pandas=True))
+
+    written = []
+    with stage("write_parquet", rows=len(df)) as m:
+        pq.write_to_dataset(
+            table,
+            root_path=out_dir,
+            partition_cols=["year", "month"],
+            basename_template=f"{file_stem}-{{i}}.parquet",
+            compression="zstd",
+            existing_data_behavior="overwrite_or_ignore",
+            file_visitor=lambda f: written.append(Path(f.path).relative_to(out_dir).as_posix()),
+        )
+        m["bytes"] = sum((Path(out_dir) / name).stat().st_size for name in written)
+    return written
+
+def read_bikeshare_parquet(path, filters=None, columns=None):
+    """Read normalized rides back from the parquet output. filters prune partitions before anything is read, e.g. [("year", "=", 2024), ("month", "<=", 6)]. Rows without a started_at sit in the null partition."""
+    return pd.read_parquet(path, partitioning=PARQUET_PARTITIONING, filters=filters, columns=columns)
+
+def get_weather_data(start=WEATHER_START, end=None, window_months=12, workers=4, cache_dir=None, base_url=WEATHER_URL):
+    """Fetch weather data from start through end (default: WEATHER_SETTLE_DAYS before today) and return daily and hourly dataframes.
+
+    The range is split into windows of window_months months, aligned to the calendar year so the same windows come up on every run, and the windows are fetched concurrently by workers threads with retries. Given a cache_dir, every complete window's response is kept there, keyed by window, location and variables, and later runs read it from disk instead of the API. base_url can point at any server that speaks the Open-Meteo archive API.
+    """
+
+    end = end or date.today() - timedelta(days=WEATHER_SETTLE_DAYS)
+    windows = weather_windows(start, end, window_months)
+    if not windows:
+        return pd.DataFrame(columns=daily_weather_columns), pd.DataFrame(columns=hourly_weather_columns)
+
+    print(f"Fetching weather data from {start} to {end} in {len(windows)} windows...")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        responses = list(pool.map(lambda w: fetch_weather_window(base_url, *w, cache_dir), windows))
+
+    with stage("weather_frames") as m:
+        daily_weather = pd.concat([pd.DataFrame(r["daily"]) for r in responses], ignore_index=True)
+        hourly_weather = pd.concat([pd.DataFrame(r["hourly"]) for r in responses], ignore_index=True)
+        m["rows"] = len(daily_weather) + len(hourly_weather)
 
     print("SUCCESS: Historical weather data fetched.")
     return (daily_weather, hourly_weather)
+
+def weather_windows(start, end, months=12):
+    """Split start..end into (window_start, window_end, complete) tuples. Window boundaries fall every months months counted from January, and complete is False for a window cut short by end."""
+    windows = []
+    period = (start.year * 12 + start.month - 1) // months
+    while True:
+        first_month = period * months
+        natural_start = date(first_month // 12, first_month % 12 + 1, 1)
+        next_month = first_month + months
+        natural_end = date(next_month // 12, next_month % 12 + 1, 1) - timedelta(days=1)
+        if natural_start > end:
+            return windows
+        windows.append((max(start, natural_start), min(end, natural_end), natural_end <= end))
+        period += 1
+
+def fetch_weather_window(base_url, start, end, complete, cache_dir=None):
+    """Fetch one window, from cache_dir when it has been fetched before. Windows that aren't complete yet are never cached."""
+    params = {
+        **WEATHER_LOCATION,
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "daily": ",".join(daily_weather_columns[1:]),
+        "hourly": ",".join(hourly_weather_columns[1:]),
+    }
+
+    cache_path = None
+    if cache_dir is not None and complete:
+        key = hashlib.sha256(json.dumps({"url": base_url, **params}, sort_keys=True).encode()).hexdigest()[:16]
+        cache_path = Path(cache_dir) / f"{start}_{end}_{key}.json"
+        if cache_path.exists():
+            with stage("weather_fetch", source=f"{start}..{end}", cached=True, bytes=cache_path.stat().st_size) as m, open(cache_path) as f:
+                data = json.load(f)
+                m["rows"] = len(data["hourly"]["time"])
+            return data
+
+    with stage("weather_fetch", source=f"{start}..{end}", cached=False) as m:
+        data = get_json_with_retries(base_url, params)
+        m["rows"] = len(data["hourly"]["time"])
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, cache_path)
+
+    print(f"Fetched weather for {start} to {end}")
+    return data
+
+def get_json_with_retries(url, params, retries=WEATHER_RETRIES):
+    """GET a JSON response, retrying connection errors, 429s and 5xx responses with exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            resp = requests.get(url, params=params, timeout=60)
+            if resp.status_code != 429 and resp.status_code < 500:
+                resp.raise_for_status()
+                return resp.json()
+            error = requests.HTTPError(f"{resp.status_code} {resp.reason}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt == retries:
+            raise error
+        wait = 2 ** attempt
+        print(f"Weather request failed ({error}), retrying in {wait}s...")
+        time.sleep(wait)
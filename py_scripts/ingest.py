@@ -0,0 +1,226 @@
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from py_scripts.conn_pool import admin_pool
+from py_scripts.db_operations import transaction, RIDES_RAW_COPY_SQL, COPY_CHUNK_ROWS, COPY_READ_SIZE
+from py_scripts.dedup import dedup_source, row_fingerprints
+from py_scripts.ledger import file_checksum, ledger_entry
+from py_scripts.prep_data import normalize_bikeshare_df, detect_bikeshare_schema, read_bikeshare_csv
+from py_scripts.rollups import hourly_rollup, merge_rollups, upsert_rides_hourly
+from py_scripts.telemetry import stage
+
+# how often a producer waiting for a free slot checks that the loaders are still running
+SLOT_POLL_S = 1.0
+
+def normalize_csv_file(csv_path, out_dir, chunk_rows=COPY_CHUNK_ROWS, rollup=False, fingerprints=False, stations=None, labels=None):
+    """Normalize a raw bikeshare csv chunk by chunk into a csv file in out_dir that can be copied into rides_raw as is. With rollup=True the file's hourly rollup is computed along the way and returned too, with fingerprints=True every row's fingerprint for deduplication. stations is a station index that fills in missing coordinates, labels restricts the label columns to a v2 rides_raw's enum labels. The raw file's checksum for the ingest ledger is computed here as well, so hashing runs in parallel. Runs inside a worker process."""
+
+    start = time.perf_counter()
+    out_path = Path(out_dir) / f"{csv_path.stem}.normalized.csv"
+    rows = 0
+    rollups = []
+    hashes = []
+    schema = detect_bikeshare_schema(csv_path)
+
+    with stage("normalize_file", source=csv_path.name, bytes=csv_path.stat().st_size) as m, open(out_path, "w", newline="") as out:
+        for i, chunk in enumerate(read_bikeshare_csv(csv_path, chunksize=chunk_rows, schema=schema)):
+            df = normalize_bikeshare_df(chunk, schema["timestamp_format"], stations, labels)
+            with stage("render_csv", rows=len(df)):
+                df.to_csv(out, index=False, header=(i == 0))
+            rows += len(df)
+            if rollup:
+                rollups.append(hourly_rollup(df))
+            if fingerprints:
+                hashes.append(row_fingerprints(df))
+        m["rows"] = rows
+
+    return {
+        "file": csv_path.name,
+        "out_path": out_path,
+        "rows": rows,
+        "checksum": file_checksum(csv_path),
+        "rollup": merge_rollups(rollups) if rollup else None,
+        "fingerprints": np.concatenate(hashes) if hashes else (np.empty(0, dtype=np.uint64) if fingerprints else None),
+        "seconds": time.perf_counter() - start,
+        "worker": os.getpid(),
+    }
+
+def drop_rows(csv_path, drop, rollup=False, chunk_rows=COPY_CHUNK_ROWS):
+    """Rewrite a csv written by normalize_csv_file() without the rows flagged in drop, a boolean array with one entry per row. Values are passed through as text, untouched. Returns the number of rows left and, with rollup=True, their hourly rollup."""
+    tmp_path = csv_path.with_suffix(".tmp")
+    rows = 0
+    offset = 0
+    rollups = []
+    with open(tmp_path, "w", newline="") as out:
+        for i, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunk_rows, dtype=str, na_filter=False)):
+            keep = chunk[~drop[offset:offset + len(chunk)]]
+            offset += len(chunk)
+            keep.to_csv(out, index=False, header=(i == 0))
+            rows += len(keep)
+            if rollup:
+                rollups.append(hourly_rollup(pd.DataFrame({
+                    "started_at": pd.to_datetime(keep["started_at"], errors="coerce"),
+                    "ended_at": pd.to_datetime(keep["ended_at"], errors="coerce"),
+                    "member_casual": keep["member_casual"].replace("", pd.NA).astype("string"),
+                    "rideable_type": keep["rideable_type"].replace("", pd.NA).astype("string"),
+                })))
+    os.replace(tmp_path, csv_path)
+    return rows, merge_rollups(rollups) if rollup else None
+
+def load_bikeshare_parallel(conn_info, csv_paths, parse_workers=None, loaders=4, max_pending=None, chunk_rows=COPY_CHUNK_ROWS, rollup=False, pool=None, batch_id=None, dedup=None, stations=None, labels=None):
+    """Load raw bikeshare csv files into rides_raw using a process pool for normalization and several database connections running COPY concurrently.
+
+    csv_paths can be any iterable, including one that yields files while they are still being downloaded: each file is handed to a parser as soon as it comes up. Parsers write normalized csv to a temp directory and loaders copy it in. At most max_pending files (default 2 per loader) are parsed but not yet loaded at any time, so fast parsers can't run too far ahead of the loaders or fill the disk. With rollup=True each file's hourly counts are added to rides_hourly in the same transaction as its COPY. Loaders borrow their connections from pool, an admin ConnectionPool, so repeated loads reuse them; without one a pool is opened for this load only. Given a batch_id, each file is recorded in the ingest ledger in the same transaction as its COPY. Given a FingerprintStore as dedup, parsers fingerprint every row and loaders drop the rows already loaded from other files before the COPY. Parsers fill in missing coordinates from stations, a station index, when one is given, and null labels outside labels, see normalize_bikeshare_df(). Prints per-worker and aggregate throughput and returns them.
+    """
+
+    parse_workers = parse_workers or os.cpu_count()
+    max_pending = max_pending or 2 * loaders
+    submitted = 0
+
+    slots = threading.Semaphore(max_pending)
+    ready = queue.Queue()
+    loaded = []
+    failed = []
+    lock = threading.Lock()
+    aborted = threading.Event()
+
+    own_pool = pool is None
+    if own_pool:
+        pool = admin_pool(conn_info, max_size=loaders)
+
+    def load(loader_id):
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                while True:
+                    future = ready.get()
+                    if future is None:
+                        return
+                    try:
+                        parsed = future.result()
+                        file_rollup = parsed.pop("rollup")
+                        fingerprints = parsed.pop("fingerprints")
+                        start = time.perf_counter()
+                        if batch_id is not None:
+                            tx = ledger_entry(cur, future.csv_path, future.csv_path.parent, batch_id, parsed["checksum"])
+                        else:
+                            tx = transaction(cur)
+                        # fingerprints are stored once the transaction has committed
+                        with dedup_source(dedup, parsed["file"], cur if batch_id is not None else None) as seen, tx as entry:
+                            if fingerprints is not None:
+                                duplicated = seen.duplicated(fingerprints)
+                                if duplicated.any():
+                                    parsed["rows"], file_rollup = drop_rows(parsed["out_path"], duplicated, rollup=file_rollup is not None, chunk_rows=chunk_rows)
+                            with open(parsed["out_path"], "rb") as f, stage("copy", source=parsed["file"], table="rides_raw", rows=parsed["rows"], bytes=os.path.getsize(parsed["out_path"])):
+                                cur.copy_expert(RIDES_RAW_COPY_SQL, f, size=COPY_READ_SIZE)
+                            if file_rollup is not None:
+                                with stage("rollup_upsert", source=parsed["file"], rows=parsed["rows"]):
+                                    upsert_rides_hourly(cur, file_rollup)
+                            if entry is not None:
+                                entry["rows"] = parsed["rows"]
+                                entry["duplicates"] = seen.duplicates
+                        os.remove(parsed["out_path"])
+                        with lock:
+                            loaded.append({**parsed, "load_seconds": time.perf_counter() - start, "loader": loader_id})
+                        print(f"Loaded {parsed['file']} ({parsed['rows']:,} rows)")
+                    except Exception as e:
+                        with lock:
+                            failed.append((future.csv_path, e))
+                        print(f"ERROR: loading {future.csv_path.name} failed: {e}")
+                    finally:
+                        slots.release()
+        except Exception as e:
+            # no connection for this loader, e.g. the pool timed out: the producer stops handing out files instead of waiting for slots nobody frees
+            with lock:
+                failed.append((None, e))
+            aborted.set()
+            print(f"ERROR: loader {loader_id} stopped: {e}")
+
+    def acquire_slot():
+        while not aborted.is_set():
+            if slots.acquire(timeout=SLOT_POLL_S):
+                return True
+            if not any(t.is_alive() for t in threads):
+                return False
+        return False
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="rides_raw_") as tmp_dir:
+        # fork explicitly: spawn would re-import main.py in every worker, which runs the whole setup at import time.
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            # the first submit forks every worker, so it runs before the loader threads, or whatever produces csv_paths, start any threads of their own
+            executor.submit(os.getpid).result()
+            threads = [threading.Thread(target=load, args=(n,)) for n in range(loaders)]
+            for t in threads:
+                t.start()
+
+            try:
+                for csv_path in csv_paths:
+                    if not acquire_slot():
+                        break
+                    future = executor.submit(normalize_csv_file, csv_path, tmp_dir, chunk_rows, rollup, dedup is not None, stations, labels)
+                    future.csv_path = csv_path
+                    ready.put(future)
+                    submitted += 1
+            finally:
+                # loaders finish what was submitted even if producing csv_paths failed
+                for _ in threads:
+                    ready.put(None)
+                for t in threads:
+                    t.join()
+
+    if own_pool:
+        pool.close()
+    elapsed = time.perf_counter() - start
+    stats = summarize_throughput(loaded, elapsed)
+
+    if failed:
+        files = [p.name for p, _ in failed if p is not None]
+        loader_errors = [str(e) for p, e in failed if p is None]
+        if loader_errors:
+            raise RuntimeError(f"Loading stopped after {len(loaded)} of {submitted} files, loaders failed: {'; '.join(loader_errors)}" + (f"; files that failed to load: {', '.join(files)}" if files else ""))
+        raise RuntimeError(f"{len(files)} of {submitted} files failed to load: {', '.join(files)}")
+    return stats
+
+def summarize_throughput(loaded, elapsed):
+    """Print rows/s per parse worker, per loader and overall for a parallel load."""
+
+    per_parser = defaultdict(lambda: {"files": 0, "rows": 0, "seconds": 0.0})
+    per_loader = defaultdict(lambda: {"files": 0, "rows": 0, "seconds": 0.0})
+    for item in loaded:
+        for bucket, key, seconds in (
+            (per_parser, item["worker"], item["seconds"]),
+            (per_loader, item["loader"], item["load_seconds"]),
+        ):
+            bucket[key]["files"] += 1
+            bucket[key]["rows"] += item["rows"]
+            bucket[key]["seconds"] += seconds
+
+    total_rows = sum(item["rows"] for item in loaded)
+    print("Parse workers:")
+    for pid, s in sorted(per_parser.items()):
+        print(f"  pid {pid}: {s['files']} files, {s['rows']:,} rows, {rate(s['rows'], s['seconds']):,.0f} rows/s")
+    print("Loaders:")
+    for loader_id, s in sorted(per_loader.items()):
+        print(f"  loader {loader_id}: {s['files']} files, {s['rows']:,} rows, {rate(s['rows'], s['seconds']):,.0f} rows/s")
+    print(f"Total: {len(loaded)} files, {total_rows:,} rows in {elapsed:.1f}s ({rate(total_rows, elapsed):,.0f} rows/s)")
+
+    return {
+        "files": len(loaded),
+        "rows": total_rows,
+        "seconds": elapsed,
+        "rows_per_s": rate(total_rows, elapsed),
+        "parse_workers": dict(per_parser),
+        "loaders": dict(per_loader),
+    }
+
+def rate(rows, seconds):
+    return rows / seconds if seconds else 0.0
@@ -0,0 +1,143 @@
+import hashlib
+import os
+from contextlib import contextmanager
+from pathlib import Path
+import psycopg2
+
+from py_scripts.db_operations import transaction
+from py_scripts.telemetry import stage
+
+CHECKSUM_CHUNK = 1024 * 1024
+
+# One row per source file. A file's ledger row is written in the same transaction as its rows, so "loaded" in the ledger always means the file's rows are in the database, and an interrupted run leaves the file to be loaded again. Rows loaded before the ledger existed are marked "preexisting".
+create_ingest_ledger_sql = """
+CREATE SEQUENCE IF NOT EXISTS ingest_batch_seq;
+
+CREATE TABLE IF NOT EXISTS ingest_ledger (
+    source_file  TEXT PRIMARY KEY,
+    checksum     TEXT,
+    size_bytes   BIGINT,
+    row_count    BIGINT,
+    loaded_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    status       TEXT NOT NULL CHECK (status IN ('loaded', 'failed', 'preexisting')),
+    batch_id     BIGINT NOT NULL,
+    error        TEXT
+);
+
+-- rows dropped as already loaded from another file, see py_scripts/dedup.py
+ALTER TABLE ingest_ledger ADD COLUMN IF NOT EXISTS duplicate_rows BIGINT;
+
+-- false from the commit of a file's rows until its fingerprints are stored, so a crash in between is noticed; NULL for files loaded before this was tracked
+ALTER TABLE ingest_ledger ADD COLUMN IF NOT EXISTS fingerprinted BOOLEAN;
+"""
+
+DONE_STATUSES = ("loaded", "preexisting")
+
+def create_ingest_ledger(cur):
+    cur.execute(create_ingest_ledger_sql)
+
+def start_batch(cur) -> int:
+    """New batch id, shared by every file loaded in one run."""
+    cur.execute("SELECT nextval('ingest_batch_seq')")
+    return cur.fetchone()[0]
+
+def file_checksum(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHECKSUM_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+def source_name(path, root) -> str:
+    """Ledger key of a source file: its path relative to the data directory."""
+    return Path(path).relative_to(root).as_posix()
+
+def is_ledger_populated(cur) -> bool:
+    cur.execute("SELECT EXISTS (SELECT 1 FROM ingest_ledger WHERE status IN %s)", (DONE_STATUSES,))
+    return cur.fetchone()[0]
+
+def loaded_files(cur) -> dict:
+    """Size of every file the ledger records as loaded, by ledger key."""
+    cur.execute("SELECT source_file, size_bytes FROM ingest_ledger WHERE status IN %s", (DONE_STATUSES,))
+    return dict(cur.fetchall())
+
+def pending_files(cur, paths, root):
+    """The paths, in sorted order, that the ledger doesn't record as loaded. Files that were loaded but have changed size since are reported and left alone, since their old rows can't be told apart from the rest."""
+    done = loaded_files(cur)
+    pending = filter_pending(paths, root, done)
+    print(f"{len(pending)} of {len(done) + len(pending)} source files to load.")
+    return pending
+
+def filter_pending(paths, root, done):
+    """pending_files() against a loaded_files() snapshot taken earlier, for callers that check files as they arrive."""
+    pending = []
+    for path in sorted(paths):
+        name = source_name(path, root)
+        if name not in done:
+            pending.append(path)
+        elif done[name] is not None and done[name] != os.path.getsize(path):
+            print(f"WARNING: {name} changed since it was loaded, not reloading it.")
+    return pending
+
+def unfingerprinted_files(cur) -> list:
+    """Ledger keys of the loaded files whose fingerprints were never stored, see py_scripts/dedup.py."""
+    cur.execute("SELECT source_file FROM ingest_ledger WHERE status = 'loaded' AND fingerprinted = false ORDER BY source_file")
+    return [name for (name,) in cur.fetchall()]
+
+def mark_fingerprinted(cur, names):
+    """Record that the fingerprints of the files with the given ledger keys are stored."""
+    cur.execute("UPDATE ingest_ledger SET fingerprinted = true WHERE source_file = ANY(%s)", (list(names),))
+
+def record_preexisting(cur, paths, root, batch_id):
+    """Mark files as loaded without loading them, for a database populated before the ledger existed."""
+    for path in paths:
+        cur.execute(
+            """
+            INSERT INTO ingest_ledger (source_file, size_bytes, status, batch_id)
+            VALUES (%s, %s, 'preexisting', %s)
+            ON CONFLICT (source_file) DO NOTHING
+            """,
+            (source_name(path, root), os.path.getsize(path), batch_id),
+        )
+
+@contextmanager
+def ledger_entry(cur, path, root, batch_id, checksum=None):
+    """Load one source file inside a with block. Everything run on cur in the block and the file's ledger row commit together. The block sets entry["rows"] to the number of rows it loaded, and entry["duplicates"] to the number it dropped as duplicates. If the block raises, its rows are rolled back and the file is recorded as failed."""
+    entry = {"rows": None, "duplicates": None}
+    name = source_name(path, root)
+    checksum = checksum or file_checksum(path)
+    size = os.path.getsize(path)
+
+    try:
+        with stage("load_file", source=name, bytes=size) as m, transaction(cur):
+            yield entry
+            _record(cur, name, checksum, size, entry["rows"], "loaded", batch_id, duplicates=entry["duplicates"])
+            m["rows"] = entry["rows"]
+    except Exception as e:
+        # only an autocommit connection is usable here, anything else is still inside the caller's failed transaction
+        if cur.connection.autocommit:
+            try:
+                _record(cur, name, checksum, size, None, "failed", batch_id, str(e))
+            except psycopg2.Error as record_error:
+                print(f"WARNING: could not record {name} as failed: {record_error}")
+        raise
+
+def _record(cur, name, checksum, size, rows, status, batch_id, error=None, duplicates=None):
+    cur.execute(
+        """
+        INSERT INTO ingest_ledger (source_file, checksum, size_bytes, row_count, status, batch_id, error, duplicate_rows, fingerprinted)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (source_file) DO UPDATE SET
+            checksum       = EXCLUDED.checksum,
+            size_bytes     = EXCLUDED.size_bytes,
+            row_count      = EXCLUDED.row_count,
+            loaded_at      = now(),
+            status         = EXCLUDED.status,
+            batch_id       = EXCLUDED.batch_id,
+            error          = EXCLUDED.error,
+            duplicate_rows = EXCLUDED.duplicate_rows,
+            fingerprinted  = EXCLUDED.fingerprinted
+        """,
+        # a loaded file's fingerprints are stored after this commits
+        (name, checksum, size, rows, status, batch_id, error, duplicates, False if status == "loaded" else None),
+    )
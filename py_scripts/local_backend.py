@@ -0,0 +1,76 @@
+import shutil
+from pathlib import Path
+import duckdb
+import pandas as pd
+
+from py_scripts.db_operations import stream_query, empty_result
+from py_scripts.fetch_raw_data import write_rides_parquet
+
+LOCAL_STORE_DIR = "analytics_store"
+EXPORT_FETCH_SIZE = 250_000
+WEATHER_TIME_COLS = {"daily_weather": ["time", "sunrise", "sunset"], "hourly_weather": ["time"]}
+
+# Local alternative to the RDS instance for analytics: rides_raw, daily_weather and hourly_weather as parquet files, queried in process by DuckDB with the same SQL. rides_raw is partitioned as year=YYYY/month=M. The partition keys show up as partition_year and partition_month, so they can't shadow the year/month aliases that queries like the analytics.py sample group by. Filters on them skip whole directories, and filters on any other column are pushed down to the parquet row group statistics.
+#
+# analytics_store/
+#   rides_raw/year=2024/month=5/*.parquet
+#   daily_weather.parquet
+#   hourly_weather.parquet
+
+def export_postgres_to_local(conn, store_dir, fetch_size=EXPORT_FETCH_SIZE):
+    """Rebuild the local store from the database behind conn, streaming each table out in chunks of fetch_size rows. Use a connection without autocommit, such as get_conn_analytics(), so the server streams rows straight from the query instead of materializing a WITH HOLD cursor first."""
+    store_dir = Path(store_dir)
+    shutil.rmtree(store_dir / "rides_raw", ignore_errors=True)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = 0
+    for i, df in enumerate(stream_query(conn, "SELECT * FROM rides_raw", fetch_size=fetch_size)):
+        write_rides_parquet(df, store_dir / "rides_raw", f"rides_raw-{i}")
+        rows += len(df)
+    print(f"Exported {rows:,} rides to {store_dir / 'rides_raw'}")
+
+    for table in WEATHER_TIME_COLS:
+        sql = f"SELECT * FROM {table} ORDER BY time"
+        chunks = list(stream_query(conn, sql, fetch_size=fetch_size))
+        # an empty table still gets a file with its columns, so the local views and queries work the same
+        df = pd.concat(chunks, ignore_index=True) if chunks else empty_result(conn, sql)
+        df.to_parquet(store_dir / f"{table}.parquet", index=False)
+        print(f"Exported {len(df):,} rows of {table}")
+
+def write_local_weather(daily_weather, hourly_weather, store_dir):
+    """Store weather frames as returned by get_weather_data() in the local store, so it can be built without a database: rides from the parquet fetch output, weather straight from the API."""
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for table, df in (("daily_weather", daily_weather), ("hourly_weather", hourly_weather)):
+        df = df.copy()
+        for col in WEATHER_TIME_COLS[table]:
+            df[col] = pd.to_datetime(df[col])
+        df.to_parquet(store_dir / f"{table}.parquet", index=False)
+
+def connect_local(store_dir, rides_dir=None):
+    """An in-memory DuckDB connection with rides_raw, daily_weather and hourly_weather views over the local store. rides_dir points rides_raw at another dataset with the same layout, e.g. bikeshare_parquet/ from get_bikeshare_data(output="parquet"). Tables without files are left out."""
+    store_dir = Path(store_dir)
+    rides_dir = Path(rides_dir) if rides_dir is not None else store_dir / "rides_raw"
+    con = duckdb.connect()
+
+    if any(rides_dir.rglob("*.parquet")):
+        con.execute(
+            f"""
+            CREATE VIEW rides_raw AS
+            SELECT * EXCLUDE (year, month), year AS partition_year, month AS partition_month
+            FROM read_parquet(
+                '{rides_dir.as_posix()}/**/*.parquet',
+                hive_partitioning = true,
+                hive_types = {{'year': SMALLINT, 'month': TINYINT}}
+            )
+            """
+        )
+    for table in WEATHER_TIME_COLS:
+        path = store_dir / f"{table}.parquet"
+        if path.exists():
+            con.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{path.as_posix()}')")
+
+    return con
+
+def query_local(con, sql, params=None) -> pd.DataFrame:
+    return con.execute(sql, params).df()
@@ -0,0 +1,220 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+OD_STORE_DIR = "od_store"
+OD_DTYPE = np.dtype([("origin", "<i4"), ("dest", "<i4"), ("trips", "<i4")])
+NULL_MEMBER = "_null"
+
+# Station-to-station trip counts per month and member type, kept as files next to the project so flow queries never have to run the GROUP BY start_station_id, end_station_id over rides_raw:
+#
+#   od_store/
+#     stations.npy          station ids; a station's position is its row and column in every matrix
+#     months.json           rides per month (from rides_hourly) when each month was built, to tell which are out of date
+#     2024-05/member.npy    sparse month slice: (origin, dest, trips) records sorted by origin then dest
+#     2024-05/casual.npy
+#     2024-05/_null.npy     rides without a member type
+#
+# Slices are memory-mapped when read, so a query only touches the months it covers. stations.npy is append-only, so positions stay valid as new stations show up and older slices never need rewriting. Trips without a start or end station (dockless e-bikes) or without a start time are not part of any slice.
+
+class ODStore:
+    """Monthly origin-destination matrices in store_dir. Keep it up to date with refresh() after loading rides, then query any range of whole months with flows() or matrix()."""
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+
+    @property
+    def station_ids(self) -> np.ndarray:
+        """Station id of every row and column of the matrices."""
+        path = self.store_dir / "stations.npy"
+        return np.load(path, mmap_mode="r") if path.exists() else np.empty(0, dtype=np.int64)
+
+    def months(self) -> dict:
+        """Rides per month ("YYYY-MM") at the time each stored month was built."""
+        path = self.store_dir / "months.json"
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def stale_months(self, cur) -> list:
+        """Months whose ride count in rides_hourly differs from when they were stored, including months not stored yet and months that no longer have rides."""
+        cur.execute(
+            """
+            SELECT to_char(date_trunc('month', hour), 'YYYY-MM'), SUM(ride_count)
+            FROM rides_hourly
+            WHERE hour IS NOT NULL
+            GROUP BY 1
+            """
+        )
+        expected = {month: int(rides) for month, rides in cur.fetchall()}
+        stored = self.months()
+        return sorted(m for m in expected.keys() | stored.keys() if expected.get(m, 0) != stored.get(m, 0))
+
+    def refresh(self, cur, months=None):
+        """Rebuild the given months ("YYYY-MM"), by default the stale_months(), with one scan of rides_raw, so this can run after every load and only touches the months that load changed."""
+        if months is None:
+            months = self.stale_months(cur)
+        if not months:
+            print("The OD store is up to date.")
+            return
+
+        print(f"Refreshing the OD store for {len(months)} months from {months[0]} to {months[-1]}...")
+        first = pd.Timestamp(months[0])
+        end = pd.Timestamp(months[-1]) + pd.offsets.MonthBegin()
+        cur.execute(
+            """
+            SELECT to_char(date_trunc('month', started_at), 'YYYY-MM') AS month, member_casual, start_station_id, end_station_id, COUNT(*) AS trips
+            FROM rides_raw
+            WHERE started_at >= %(start)s AND started_at < %(end)s
+              AND to_char(date_trunc('month', started_at), 'YYYY-MM') = ANY(%(months)s)
+              AND start_station_id IS NOT NULL AND end_station_id IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+            """,
+            {"start": first.to_pydatetime(), "end": end.to_pydatetime(), "months": list(months)},
+        )
+        counts = pd.DataFrame(cur.fetchall(), columns=["month", "member_casual", "start_station_id", "end_station_id", "trips"])
+
+        cur.execute(
+            """
+            SELECT to_char(date_trunc('month', hour), 'YYYY-MM'), SUM(ride_count)
+            FROM rides_hourly
+            WHERE hour >= %(start)s AND hour < %(end)s
+            GROUP BY 1
+            """,
+            {"start": first.to_pydatetime(), "end": end.to_pydatetime()},
+        )
+        rides = {month: int(n) for month, n in cur.fetchall()}
+
+        positions = self._add_stations(np.union1d(counts["start_station_id"].unique(), counts["end_station_id"].unique()))
+        by_month = dict(tuple(counts.groupby("month")))
+        stored = self.months()
+        for month in months:
+            self._write_month(month, by_month.get(month, counts.iloc[:0]), positions)
+            if rides.get(month):
+                stored[month] = rides[month]
+            else:
+                stored.pop(month, None)
+        _write_json(self.store_dir / "months.json", dict(sorted(stored.items())))
+
+    def flows(self, start=None, end=None, member_casual=None) -> pd.DataFrame:
+        """Trips per start and end station in the months from start up to (not including) end, as start_station_id, end_station_id and trips columns. start and end must fall on month boundaries; None leaves that side open. member_casual picks one member type or a list of them, None counts all rides."""
+        origin, dest, trips = self._sum(start, end, member_casual)
+        ids = np.asarray(self.station_ids)
+        return pd.DataFrame({
+            "start_station_id": ids[origin],
+            "end_station_id": ids[dest],
+            "trips": trips,
+        }).sort_values(["start_station_id", "end_station_id"], ignore_index=True)
+
+    def matrix(self, start=None, end=None, member_casual=None):
+        """The same counts as flows() as a scipy.sparse CSR matrix, rows being start stations and columns end stations in station_ids order."""
+        from scipy.sparse import csr_matrix
+
+        origin, dest, trips = self._sum(start, end, member_casual)
+        n = len(self.station_ids)
+        return csr_matrix((trips, (origin, dest)), shape=(n, n))
+
+    def _sum(self, start, end, member_casual):
+        n = len(self.station_ids)
+        slices = [np.load(path, mmap_mode="r") for path in self._slice_paths(start, end, member_casual)]
+        slices = [s for s in slices if len(s)]
+        if not slices:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        keys = np.concatenate([s["origin"].astype(np.int64) * n + s["dest"] for s in slices])
+        trips = np.concatenate([s["trips"] for s in slices])
+        # unique keys come out sorted, i.e. by origin then dest
+        unique, inverse = np.unique(keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=trips, minlength=len(unique)).astype(np.int64)
+        return unique // n, unique % n, totals
+
+    def _slice_paths(self, start, end, member_casual):
+        start, end = _month_bound(start, "start"), _month_bound(end, "end")
+        if isinstance(member_casual, str):
+            member_casual = [member_casual]
+        files = None if member_casual is None else {f"{NULL_MEMBER if m is None else m}.npy" for m in member_casual}
+        for month in sorted(self.months()):
+            if (start is not None and month < start) or (end is not None and month >= end):
+                continue
+            for path in sorted((self.store_dir / month).glob("*.npy")):
+                if files is None or path.name in files:
+                    yield path
+
+    def _add_stations(self, new_ids):
+        """Append the ids in new_ids not stored yet to stations.npy and return all station ids as an Index, whose positions are the matrix positions."""
+        ids = np.asarray(self.station_ids, dtype=np.int64)
+        new_ids = np.setdiff1d(np.asarray(new_ids, dtype=np.int64), ids)
+        if len(new_ids):
+            ids = np.concatenate([ids, new_ids])
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            _save(self.store_dir / "stations.npy", ids)
+        return pd.Index(ids)
+
+    def _write_month(self, month, counts, positions):
+        month_dir = self.store_dir / month
+        month_dir.mkdir(parents=True, exist_ok=True)
+        written = set()
+        for member, group in counts.groupby("member_casual", dropna=False):
+            records = np.empty(len(group), dtype=OD_DTYPE)
+            records["origin"] = positions.get_indexer(group["start_station_id"])
+            records["dest"] = positions.get_indexer(group["end_station_id"])
+            records["trips"] = group["trips"].to_numpy()
+            records.sort(order=["origin", "dest"])
+            path = month_dir / f"{NULL_MEMBER if pd.isna(member) else member}.npy"
+            _save(path, records)
+            written.add(path)
+        # member types that had rides before this refresh but none now
+        for path in month_dir.glob("*.npy"):
+            if path not in written:
+                path.unlink()
+        if not written:
+            month_dir.rmdir()
+
+def od_flows_sql(start=None, end=None, member_casual=None):
+    """The query ODStore.flows() answers, to run against rides_raw directly, e.g. to check the store: returns (sql, params) for cur.execute(). Takes the same arguments and returns the same columns in the same order."""
+    where = ["start_station_id IS NOT NULL", "end_station_id IS NOT NULL", "started_at IS NOT NULL"]
+    params = {}
+    start, end = _month_bound(start, "start"), _month_bound(end, "end")
+    if start is not None:
+        where.append("started_at >= %(start)s")
+        params["start"] = f"{start}-01"
+    if end is not None:
+        where.append("started_at < %(end)s")
+        params["end"] = f"{end}-01"
+    if isinstance(member_casual, str):
+        member_casual = [member_casual]
+    if member_casual is not None:
+        members = tuple(m for m in member_casual if m is not None)
+        # a tuple goes in as an untyped list, so it compares with the text and the enum member_casual column alike
+        conditions = ["member_casual IN %(members)s"] if members else []
+        if members:
+            params["members"] = members
+        if None in member_casual:
+            conditions.append("member_casual IS NULL")
+        where.append(f"({' OR '.join(conditions)})")
+    return f"""
+        SELECT start_station_id, end_station_id, COUNT(*) AS trips
+        FROM rides_raw
+        WHERE {' AND '.join(where)}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, params
+
+def _month_bound(value, side):
+    if value is None:
+        return None
+    ts = pd.Timestamp(value)
+    if ts != ts.normalize().replace(day=1):
+        raise ValueError(f"{side} must fall on a month boundary, got {value!r}")
+    return ts.strftime("%Y-%m")
+
+def _save(path, values):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp, path)
+
+def _write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, indent=1))
+    os.replace(tmp, path)
@@ -0,0 +1,151 @@
+from datetime import date
+from io import BytesIO, StringIO
+import pandas as pd
+
+from py_scripts.pg_binary import encode_binary_copy, get_column_types
+from py_scripts.prep_data import CANONICAL_COLS
+from py_scripts.rollups import recompute_rides_hourly
+
+# Capital Bikeshare's first trips are from September 2010
+FIRST_MONTH = date(2010, 9, 1)
+
+def partition_name(month_start: date) -> str:
+    return f"rides_raw_y{month_start.year}m{month_start.month:02d}"
+
+def next_month(month_start: date) -> date:
+    return date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+
+def create_month_partitions(cur, first=FIRST_MONTH, last=None):
+    """Create one rides_raw partition per month from first through last (default: next month) plus a default partition for the rows no month partition takes: those without a started_at or dated outside the range, e.g. bad future timestamps. Existing partitions are left alone, so this can run on every setup to extend the range; rows of a new month that were waiting in the default partition are moved into it."""
+
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rides_raw')")
+    row = cur.fetchone()
+    if row is None or row[0] != "p":
+        raise RuntimeError("rides_raw is not a partitioned table. Drop it and re-create it with create_db_tables(cur, partitioned=True) to switch layouts.")
+
+    # db_operations imports this module, so transaction() is imported when it's needed
+    from py_scripts.db_operations import transaction
+
+    has_default = _exists(cur, "rides_raw_default")
+    last = last or next_month(date.today().replace(day=1))
+    month = first.replace(day=1)
+    while month <= last:
+        create = f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(month)}
+            PARTITION OF rides_raw
+            FOR VALUES FROM ('{month}') TO ('{next_month(month)}');
+            """
+        if not has_default or _exists(cur, partition_name(month)):
+            cur.execute(create)
+        else:
+            # the new partition can't be created while the default one holds rows of its month, so they are set aside and routed to it once it exists
+            with transaction(cur):
+                cur.execute("CREATE TEMP TABLE IF NOT EXISTS rides_raw_moved (LIKE rides_raw)")
+                cur.execute("TRUNCATE rides_raw_moved")
+                cur.execute(
+                    "WITH moved AS (DELETE FROM rides_raw_default WHERE started_at >= %s AND started_at < %s RETURNING *) INSERT INTO rides_raw_moved SELECT * FROM moved",
+                    (month, next_month(month)),
+                )
+                moved = cur.rowcount
+                cur.execute(create)
+                cur.execute("INSERT INTO rides_raw SELECT * FROM rides_raw_moved")
+            if moved:
+                print(f"Moved {moved:,} rows from rides_raw_default into {partition_name(month)}.")
+        month = next_month(month)
+
+    cur.execute("CREATE TABLE IF NOT EXISTS rides_raw_default PARTITION OF rides_raw DEFAULT;")
+    print(f"rides_raw partitions ready from {first:%Y-%m} through {last:%Y-%m}.")
+
+def _exists(cur, table):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cur.fetchone()[0]
+
+def list_partitions(cur):
+    """Names of all rides_raw partitions, oldest month first, the default partition last."""
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'rides_raw'::regclass
+        ORDER BY c.relname = 'rides_raw_default', c.relname
+        """
+    )
+    return [r[0] for r in cur.fetchall()]
+
+def build_partition_indexes(cur, partitions=None, station_btree=False):
+    """Index partitions after they have been bulk loaded rather than maintaining indexes during COPY: a BRIN index on started_at, which is tiny because files are loaded in time order, and optionally B-tree indexes on the station ids. Indexes that already exist are skipped."""
+
+    for name in partitions or list_partitions(cur):
+        statements = [f"CREATE INDEX IF NOT EXISTS {name}_started_at_brin ON {name} USING brin (started_at)"]
+        if station_btree:
+            statements += [
+                f"CREATE INDEX IF NOT EXISTS {name}_start_station_idx ON {name} (start_station_id)",
+                f"CREATE INDEX IF NOT EXISTS {name}_end_station_idx ON {name} (end_station_id)",
+            ]
+        for sql in statements:
+            cur.execute(sql)
+        cur.execute(f"ANALYZE {name}")
+
+    print("Partition indexes built.")
+
+def replace_month_partition(cur, month_start: date, df: pd.DataFrame, binary=True, station_btree=False):
+    """Reload one month as a partition swap. The normalized rides are loaded and indexed in a standalone staging table, which then replaces the month's partition in a single short transaction, so readers never see a half-loaded month. Rows outside the month are skipped.
+
+    Rows of the month in the default partition, there because the month had no partition yet, are replaced along with it. The month's rides_hourly rows are recomputed from the new partition in the same transaction, and its rides_weather_hourly rows are dropped so the next refresh_rides_weather_hourly() rebuilds them. The OD store notices the month through its changed ride count; when the count stays the same, refresh it with ODStore.refresh(cur, ["YYYY-MM"]).
+    """
+
+    month_start = month_start.replace(day=1)
+    name = partition_name(month_start)
+    staging = f"{name}_new"
+    lower, upper = pd.Timestamp(month_start), pd.Timestamp(next_month(month_start))
+
+    in_month = df["started_at"].ge(lower) & df["started_at"].lt(upper)
+    if not in_month.all():
+        print(f"Skipping {(~in_month).sum():,} rows outside {month_start:%Y-%m}.")
+    df = df.loc[in_month, CANONICAL_COLS]
+
+    cur.execute(f"DROP TABLE IF EXISTS {staging}")
+    cur.execute(f"CREATE TABLE {staging} (LIKE rides_raw INCLUDING DEFAULTS)")
+    # a matching CHECK constraint lets ATTACH PARTITION skip its validation scan
+    cur.execute(
+        f"""
+        ALTER TABLE {staging} ADD CONSTRAINT {staging}_bounds
+        CHECK (started_at IS NOT NULL AND started_at >= '{lower}' AND started_at < '{upper}')
+        """
+    )
+
+    columns = ", ".join(CANONICAL_COLS)
+    if binary:
+        buf = BytesIO(encode_binary_copy(df, get_column_types(cur, "rides_raw", CANONICAL_COLS)))
+        cur.copy_expert(f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT BINARY)", buf)
+    else:
+        buf = StringIO()
+        df.to_csv(buf, index=False, header=True)
+        buf.seek(0)
+        cur.copy_expert(f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT CSV, HEADER TRUE)", buf)
+
+    build_partition_indexes(cur, [staging], station_btree)
+
+    index_renames = [
+        f"ALTER INDEX IF EXISTS {staging}{suffix} RENAME TO {name}{suffix}"
+        for suffix in ("_started_at_brin", "_start_station_idx", "_end_station_idx")
+    ]
+    # db_operations imports this module, so transaction() is imported when it's needed
+    from py_scripts.db_operations import transaction
+
+    with transaction(cur):
+        cur.execute(f"DROP TABLE IF EXISTS {name}")
+        if _exists(cur, "rides_raw_default"):
+            # ATTACH PARTITION fails while the default partition holds rows of the month
+            cur.execute("DELETE FROM rides_raw_default WHERE started_at >= %s AND started_at < %s", (lower.to_pydatetime(), upper.to_pydatetime()))
+        cur.execute(f"ALTER TABLE {staging} RENAME TO {name}")
+        for sql in index_renames:
+            cur.execute(sql)
+        cur.execute(f"ALTER TABLE rides_raw ATTACH PARTITION {name} FOR VALUES FROM ('{month_start}') TO ('{next_month(month_start)}')")
+        cur.execute(f"ALTER TABLE {name} DROP CONSTRAINT {staging}_bounds")
+        # the rollup and feature rows derived from the old partition go with it
+        recompute_rides_hourly(cur, lower.to_pydatetime(), upper.to_pydatetime(), source=name)
+        cur.execute("DELETE FROM rides_weather_hourly WHERE hour >= %s AND hour < %s", (lower.to_pydatetime(), upper.to_pydatetime()))
+
+    print(f"Swapped in {name} with {len(df):,} rows.")
@@ -0,0 +1,157 @@
+from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
+import pandas as pd
+
+# PostgreSQL binary COPY format: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+# Every value is sent as its type's binary wire representation, big-endian, so nothing is formatted as text on the client or parsed again on the server.
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + (0).to_bytes(4, "big") + (0).to_bytes(4, "big")
+COPY_TRAILER = (-1).to_bytes(2, "big", signed=True)
+
+PG_EPOCH = pd.Timestamp("2000-01-01")
+NUMERIC_NEG = 0x4000
+NBASE = 10000
+
+FIXED_WIDTH = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+}
+
+def get_column_types(cur, table, columns):
+    """Look up (data_type, numeric_scale) for the given columns of a table in the current schema, in the order given."""
+    cur.execute(
+        """
+        SELECT column_name, data_type, numeric_scale
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND table_name = %s
+        """,
+        (table,)
+    )
+    types = {name: (data_type, scale) for name, data_type, scale in cur.fetchall()}
+
+    missing = [c for c in columns if c not in types]
+    if missing:
+        raise ValueError(f"Table {table} has no column(s) {', '.join(missing)}")
+    return [types[c] for c in columns]
+
+def encode_binary_copy(df: pd.DataFrame, pg_types) -> bytes:
+    """Encode a data frame as a complete COPY ... WITH (FORMAT BINARY) payload. pg_types is one (data_type, numeric_scale) per column, as returned by get_column_types. All work is done per column with numpy, never per row."""
+
+    n = len(df)
+    fields = [encode_column(df.iloc[:, i], data_type, scale) for i, (data_type, scale) in enumerate(pg_types)]
+
+    # each row is an int16 field count followed by, per field, an int32 length (-1 for NULL) and the value bytes
+    row_sizes = np.full(n, 2, dtype=np.int64)
+    for sizes, _ in fields:
+        row_sizes += 4 + np.maximum(sizes, 0)
+    row_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(row_sizes[:-1], out=row_starts[1:])
+
+    body = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+    _scatter_fixed(body, row_starts, np.full(n, len(fields), dtype=">i2"))
+
+    offsets = row_starts + 2
+    for sizes, data in fields:
+        _scatter_fixed(body, offsets, sizes.astype(">i4"))
+        offsets += 4
+        _scatter_varlen(body, offsets, sizes, data)
+        offsets += np.maximum(sizes, 0)
+
+    return COPY_HEADER + body.tobytes() + COPY_TRAILER
+
+def encode_column(s: pd.Series, data_type, scale=None):
+    """Encode one column into (sizes, data): the field length of every row, -1 for NULL, and the concatenated value bytes of the non-null rows as uint8."""
+
+    if data_type in ("text", "character varying", "USER-DEFINED"):
+        return _encode_text(s)
+
+    if data_type in ("timestamp without time zone", "date"):
+        ts = s if pd.api.types.is_datetime64_any_dtype(s) else pd.to_datetime(s, errors="coerce")
+        mask = ts.isna().to_numpy()
+        if data_type == "date":
+            values = (ts[~mask].dt.normalize() - PG_EPOCH).dt.days.to_numpy().astype(">i4")
+        else:
+            values = ((ts[~mask] - PG_EPOCH) // pd.Timedelta(microseconds=1)).to_numpy().astype(">i8")
+        return _fixed_sizes(mask, values.itemsize), values.view(np.uint8)
+
+    numbers = pd.to_numeric(s, errors="coerce").astype("Float64")
+    mask = ~np.isfinite(numbers.to_numpy(dtype=np.float64, na_value=np.nan))
+    values = numbers.to_numpy(dtype=np.float64, na_value=0.0)[~mask]
+
+    if data_type == "numeric":
+        return _encode_numeric(values, mask, 6 if scale is None else int(scale))
+    if data_type in FIXED_WIDTH:
+        dtype = np.dtype(FIXED_WIDTH[data_type])
+        if dtype.kind == "i":
+            values = np.rint(values)
+        values = values.astype(dtype)
+        return _fixed_sizes(mask, dtype.itemsize), values.view(np.uint8)
+
+    raise ValueError(f"No binary encoder for PostgreSQL type {data_type!r}")
+
+def _fixed_sizes(mask, width):
+    return np.where(mask, -1, width).astype(np.int64)
+
+def _encode_text(s):
+    s = s.astype("string")
+    # empty strings become NULL, the same as an empty field in the csv COPY path
+    mask = (s.isna() | (s == "")).to_numpy()
+    encoded = s[~mask].str.encode("utf-8").to_numpy(dtype=object)
+    sizes = np.full(len(s), -1, dtype=np.int64)
+    sizes[~mask] = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    return sizes, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+def _encode_numeric(values, mask, scale):
+    """numeric is sent as ndigits, weight, sign, dscale followed by base-10000 digits. Every row gets the same number of digits; the server strips leading and trailing zero digits on receipt."""
+
+    scaled = _scale_half_up(np.abs(values), scale)
+    int_part, frac_part = np.divmod(scaled, 10**scale)
+
+    frac_groups = -(-scale // 4)
+    int_groups = max(1, -(-len(str(int(int_part.max(initial=0)))) // 4))
+    ndigits = int_groups + frac_groups
+
+    # shift the fraction left so its digits fill whole base-10000 groups
+    frac_part = frac_part * 10 ** (4 * frac_groups - scale)
+    digits = [(int_part // NBASE**p) % NBASE for p in range(int_groups - 1, -1, -1)]
+    digits += [(frac_part // NBASE**p) % NBASE for p in range(frac_groups - 1, -1, -1)]
+
+    words = np.empty((len(values), 4 + ndigits), dtype=">i2")
+    words[:, 0] = ndigits
+    words[:, 1] = int_groups - 1
+    words[:, 2] = np.where((values < 0) & (scaled > 0), NUMERIC_NEG, 0)
+    words[:, 3] = scale
+    for i, d in enumerate(digits):
+        words[:, 4 + i] = d
+
+    return _fixed_sizes(mask, words.shape[1] * 2), words.view(np.uint8).reshape(-1)
+
+def _scale_half_up(values, scale):
+    """Non-negative values times 10**scale as int64, rounded the way PostgreSQL rounds the csv path's text: half away from zero on each value's shortest decimal repr. Only values within float error of a tie are rounded through Decimal, e.g. 1.005 * 100 is 100.49999999999999 as a float but 1.005 rounds to 1.01."""
+    x = values * 10.0**scale
+    scaled = np.floor(x + 0.5)
+    ties = np.flatnonzero(np.abs(x - np.floor(x) - 0.5) <= np.maximum(x, 1.0) * 1e-12)
+    if len(ties):
+        quantum = Decimal(1).scaleb(-scale)
+        uniques, inverse = np.unique(values[ties], return_inverse=True)
+        exact = [Decimal(repr(float(v))).quantize(quantum, rounding=ROUND_HALF_UP).scaleb(scale) for v in uniques]
+        scaled[ties] = np.array(exact, dtype=np.float64)[inverse]
+    return scaled.astype(np.int64)
+
+def _scatter_fixed(out, offsets, values):
+    """Write one fixed-width big-endian value per row at the given byte offsets."""
+    width = values.dtype.itemsize
+    out[offsets[:, None] + np.arange(width)] = values.view(np.uint8).reshape(-1, width)
+
+def _scatter_varlen(out, offsets, sizes, data):
+    """Copy each non-null row's value bytes from the packed data buffer to its offset in the output."""
+    present = sizes > 0
+    lengths = sizes[present]
+    if not len(lengths):
+        return
+    src_starts = np.cumsum(lengths) - lengths
+    shift = np.repeat(offsets[present] - src_starts, lengths)
+    out[shift + np.arange(len(data))] = data
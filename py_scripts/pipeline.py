@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+from pathlib import Path
+
+from py_scripts.conn_pool import admin_pool
+from py_scripts.db_operations import COPY_CHUNK_ROWS
+from py_scripts.fetch_raw_data import get_bikeshare_data, OUTPUT_DIRS
+from py_scripts.ingest import load_bikeshare_parallel
+from py_scripts.ledger import loaded_files, filter_pending
+from py_scripts.telemetry import stage
+
+EXTRACTED_QUEUE_SIZE = 8
+
+# Fetch, normalize and load as one pipeline instead of three steps run one after the other:
+#
+#   fetch threads ──(extracted files, bounded queue)──> parse processes ──(normalized files, bounded)──> COPY connections
+#
+# Every csv file moves on as soon as its archive is extracted, so downloading, parsing and COPY all run at the same time and a full rebuild takes about as long as its slowest stage. Both queues are bounded: when loading falls behind, parsing and then downloading wait for it instead of filling the disk.
+
+def run_pipeline(root_dir, conn_info, pending=(), fetch_workers=4, parse_workers=None, loaders=2, queue_size=EXTRACTED_QUEUE_SIZE, max_pending=None, chunk_rows=COPY_CHUNK_ROWS, rollup=False, batch_id=None, dedup=None, stations=None, labels=None, s3=None, pool=None):
+    """Sync the raw csv files from S3 into bikeshare_csv/ and load them into rides_raw as they arrive.
+
+    pending are files already on disk that still have to be loaded, e.g. from pending_files(); they go first while the fetch starts. Newly extracted files that the ingest ledger records as loaded are skipped. fetch_workers archives are downloaded at a time, at most queue_size extracted files wait for a parser, parse_workers processes normalize and loaders connections run COPY; max_pending, chunk_rows, rollup, batch_id, dedup, stations and labels are passed on to load_bikeshare_parallel(). Loaders borrow connections from pool, an admin ConnectionPool; without one a pool is opened for this run only. Returns the load statistics.
+    """
+
+    data_dir = Path(root_dir) / OUTPUT_DIRS["csv"]
+    own_pool = pool is None
+    if own_pool:
+        pool = admin_pool(conn_info, max_size=loaders)
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        done = loaded_files(cur)
+
+    extracted = queue.Queue(maxsize=queue_size)
+    finished = object()
+    fetch_errors = []
+    stopped = threading.Event()
+
+    def put(item):
+        # once loading has stopped nobody takes files off the queue, so fetch threads must not block on it
+        while not stopped.is_set():
+            try:
+                extracted.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def fetch():
+        try:
+            get_bikeshare_data(
+                root_dir,
+                workers=fetch_workers,
+                s3=s3,
+                on_fetched=lambda paths: [put(p) for p in filter_pending(paths, data_dir, done)],
+            )
+        except BaseException as e:
+            # including the SystemExit get_bikeshare_data uses for a directory it can't sync
+            fetch_errors.append(e)
+        finally:
+            put(finished)
+
+    def csv_paths():
+        # started from inside the iteration, so the parse processes are forked before the fetch threads exist
+        threading.Thread(target=fetch, name="fetch", daemon=True).start()
+
+        # a file left over from an earlier run can be extracted again in this one
+        seen = set()
+        for path in pending:
+            seen.add(path)
+            yield path
+        while (path := extracted.get()) is not finished:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+    start = time.perf_counter()
+    try:
+        with stage("pipeline"):
+            stats = load_bikeshare_parallel(
+                conn_info,
+                csv_paths(),
+                parse_workers=parse_workers,
+                loaders=loaders,
+                max_pending=max_pending,
+                chunk_rows=chunk_rows,
+                rollup=rollup,
+                pool=pool,
+                batch_id=batch_id,
+                dedup=dedup,
+                stations=stations,
+                labels=labels,
+            )
+    finally:
+        stopped.set()
+        if own_pool:
+            pool.close()
+
+    if fetch_errors:
+        raise fetch_errors[0]
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s")
+    return stats
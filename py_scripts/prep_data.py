@@ -1,4 +1,9 @@
+import os
+import numpy as np
 import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+from py_scripts.telemetry import instrumented, stage
 
 CANONICAL_COLS = [
     "started_at",
@@ -89,7 +94,55 @@ hourly_weather_columns = [
     "sunshine_duration"
 ]
 
-def normalize_bikeshare_df(df: pd.DataFrame) -> pd.DataFrame:
+STRING_COLS = ("start_station_name", "end_station_name", "rideable_type", "member_casual")
+LABEL_COLS = ("rideable_type", "member_casual")
+# the labels LABEL_COLS are known to hold after normalization, the values the enum types of the v2 schema are created with. Old layout files mark some riders "Unknown". Enums sort in declaration order, so these are kept alphabetical to sort the same as TEXT.
+LABELS = {
+    "rideable_type": ("classic_bike", "docked_bike", "electric_bike"),
+    "member_casual": ("casual", "member", "unknown"),
+}
+
+def detect_bikeshare_schema(csv_path, sample_rows=1000):
+    """Detect a raw bikeshare csv's layout generation ("old" Start date / Member type columns or "new" started_at / rideable_type columns) and its timestamp format from the first rows."""
+    sample = pd.read_csv(csv_path, nrows=sample_rows, dtype=str)
+    layout = "old" if "Start date" in sample.columns else "new"
+    mapping = MAP_OLD if layout == "old" else MAP_NEW
+    started = next(src for src, dst in mapping.items() if dst == "started_at")
+    return {
+        "layout": layout,
+        "timestamp_format": _guess_timestamp_format(sample[started]),
+        "columns": [c for c in sample.columns if c in mapping],
+    }
+
+def read_bikeshare_csv(csv_path, chunksize=None, schema=None):
+    """Read a raw bikeshare csv, keeping only the columns that normalize_bikeshare_df uses and reading text columns straight into the string dtype. Whole files are parsed with the multi-threaded pyarrow engine, chunked reads with the C engine, which is the only one that supports chunksize. Pass the schema's timestamp_format on to normalize_bikeshare_df so each file's format is detected once."""
+    schema = schema or detect_bikeshare_schema(csv_path)
+    mapping = MAP_OLD if schema["layout"] == "old" else MAP_NEW
+    options = {
+        "usecols": schema["columns"],
+        "dtype": {src: "string" for src, dst in mapping.items() if dst in STRING_COLS},
+    }
+    if chunksize is None:
+        with stage("read_csv", source=os.path.basename(csv_path), bytes=os.path.getsize(csv_path)) as m:
+            df = pd.read_csv(csv_path, engine="pyarrow", **options)
+            m["rows"] = len(df)
+        return df
+    return _timed_chunks(pd.read_csv(csv_path, chunksize=chunksize, low_memory=False, **options), os.path.basename(csv_path))
+
+def _timed_chunks(reader, source):
+    """Iterate a chunked csv reader, timing the parsing of each chunk as a read_csv stage."""
+    with reader:
+        while True:
+            with stage("read_csv", source=source) as m:
+                chunk = next(reader, None)
+                m["rows"] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            yield chunk
+
+@instrumented("normalize", rows=len)
+def normalize_bikeshare_df(df: pd.DataFrame, timestamp_format=None, stations=None, labels=None) -> pd.DataFrame:
+    """Map either csv layout onto CANONICAL_COLS with canonical types. timestamp_format skips per-call format detection, e.g. the one found by detect_bikeshare_schema. Given a station index from stations.load_station_index(), missing coordinates are filled in from it (see backfill_coordinates). Given labels ({column: labels}, e.g. from schema_v2.enum_labels()), LABEL_COLS values outside them become NA, so the rows fit the enum types of a v2 rides_raw (see restrict_labels)."""
     # rename to canonical
     if "Start date" in df.columns:
         df = df.rename(columns=MAP_OLD)
@@ -99,9 +152,10 @@ def normalize_bikeshare_df(df: pd.DataFrame) -> pd.DataFrame:
     # enforce column order
     df = df.reindex(columns=CANONICAL_COLS)
 
-    # timestamps
-    df["started_at"] = pd.to_datetime(df["started_at"], errors="coerce")
-    df["ended_at"] = pd.to_datetime(df["ended_at"], errors="coerce")
+    # timestamps, both columns always share a format
+    timestamp_format = timestamp_format or _guess_timestamp_format(df["started_at"])
+    df["started_at"] = parse_timestamps(df["started_at"], timestamp_format)
+    df["ended_at"] = parse_timestamps(df["ended_at"], timestamp_format)
 
     # ids
     for col in ("start_station_id", "end_station_id"):
@@ -112,16 +166,85 @@ def normalize_bikeshare_df(df: pd.DataFrame) -> pd.DataFrame:
         df[col] = pd.to_numeric(df[col], errors="coerce").round(6)
 
     # strings
-    for col in (
-        "start_station_name",
-        "end_station_name",
-        "rideable_type",
-        "member_casual",
-    ):
+    for col in STRING_COLS:
         df[col] = df[col].astype("string")
-    
-    # Noticed some 'Member' and 'member' entries thus, normalize text fields: trim whitespace and lowercase. 
-    for col in ("rideable_type", "member_casual"):
-        df[col] = df[col].str.strip().str.lower()
+
+    # Noticed some 'Member' and 'member' entries thus, normalize text fields: trim whitespace and lowercase. These columns only hold a handful of distinct values, so it's done once per distinct value and mapped back.
+    for col in LABEL_COLS:
+        df[col] = normalize_labels(df[col], None if labels is None else labels[col])
+
+    if stations is not None:
+        df = backfill_coordinates(df, stations)
 
     return df
+
+def backfill_coordinates(df: pd.DataFrame, stations: pd.DataFrame) -> pd.DataFrame:
+    """Fill the missing coordinates of trips that have a station id, as old layout rows do, with the station's location in the month of the index nearest to the month the trip started in: one merge_asof per trip end over the index's station_id, month, lat and lng columns, which must be sorted by month."""
+    if not len(stations):
+        return df
+    for side in ("start", "end"):
+        lat, lng = f"{side}_lat", f"{side}_lng"
+        missing = (df[lat].isna() | df[lng].isna()) & df[f"{side}_station_id"].notna() & df["started_at"].notna()
+        if not missing.any():
+            continue
+        trips = pd.DataFrame({
+            "row": np.flatnonzero(missing.to_numpy()),
+            "station_id": df.loc[missing, f"{side}_station_id"].to_numpy(dtype="int64"),
+            # the trip's own month, not its timestamp: mid-month trips would otherwise be nearer to the next month's location
+            "month": df.loc[missing, "started_at"].dt.to_period("M").dt.to_timestamp().to_numpy(dtype="datetime64[ns]"),
+        }).sort_values("month", kind="stable")
+        located = pd.merge_asof(
+            trips,
+            stations[["station_id", "month", "lat", "lng"]].astype({"station_id": "int64", "month": "datetime64[ns]"}),
+            on="month",
+            by="station_id",
+            direction="nearest",
+        ).dropna(subset=["lat"])
+        if not len(located):
+            continue
+        rows = located["row"].to_numpy()
+        df.iloc[rows, df.columns.get_loc(lat)] = located["lat"].to_numpy()
+        df.iloc[rows, df.columns.get_loc(lng)] = located["lng"].to_numpy()
+    return df
+
+def parse_timestamps(col: pd.Series, timestamp_format=None) -> pd.Series:
+    """pd.to_datetime(col, errors="coerce") with a known format. Non ISO formats such as 1/31/2016 23:59 go through strptime, so each distinct value is parsed once and mapped back."""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        # the pyarrow csv engine already parses ISO timestamps, at second resolution
+        return col.astype("datetime64[ns]")
+    if timestamp_format is None or timestamp_format.startswith("%Y-%m-%d"):
+        return pd.to_datetime(col, errors="coerce", format=timestamp_format)
+
+    codes, uniques = pd.factorize(col)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), errors="coerce", format=timestamp_format).to_numpy()
+    # code -1 (missing) picks the trailing NaT
+    lookup = np.append(parsed, np.datetime64("NaT", "ns"))
+    return pd.Series(lookup[codes], index=col.index, name=col.name)
+
+def restrict_labels(df: pd.DataFrame, labels) -> pd.DataFrame:
+    """Set LABEL_COLS values outside labels ({column: labels}) to NA with a warning, for already normalized trips such as parquet files going into a v2 rides_raw."""
+    for col in LABEL_COLS:
+        df[col] = normalize_labels(df[col], labels[col])
+    return df
+
+def normalize_labels(col: pd.Series, allowed=None) -> pd.Series:
+    """Strip and lowercase a low-cardinality string column through a lookup table built from its distinct values. Given allowed, blank labels become NA, and so do labels not in allowed, with a warning, so every value fits the v2 enum types."""
+    codes, uniques = pd.factorize(col)
+    labels = pd.Series(uniques, dtype="string").str.strip().str.lower()
+    if allowed is not None:
+        # blank labels are stored as NULL by both COPY formats anyway
+        labels[(labels == "").fillna(False)] = pd.NA
+        unknown = labels.notna() & ~labels.isin(allowed)
+        if unknown.any():
+            print(f"WARNING: unknown {col.name} labels {sorted(labels[unknown])} stored as NULL ({int(np.isin(codes, np.flatnonzero(unknown)).sum()):,} rows)")
+            labels[unknown] = pd.NA
+    # code -1 (missing) picks the trailing NA
+    lookup = pd.array(list(labels) + [pd.NA], dtype="string")
+    return pd.Series(lookup[codes], index=col.index, name=col.name)
+
+def _guess_timestamp_format(col: pd.Series):
+    """The format pandas itself would infer, from the first non-null value."""
+    first = col.dropna()
+    if not len(first) or not isinstance(first.iloc[0], str):
+        return None
+    return guess_datetime_format(first.iloc[0])
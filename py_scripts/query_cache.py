@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+
+CACHE_MAX_BYTES = 512 * 1024**2
+
+# Cheap probes whose combined result changes whenever the loaded data does. They only read committed rows and catalog entries, so a write that rolls back doesn't move the watermark and a server restart or failover can't move it back to an earlier value. The ingest ledger moves with every file committed, rides_hourly's newest hour is read off its unique index, the weather tables' newest rows move with every append, and a table's relfilenode changes whenever it is rewritten or replaced, e.g. by a rides_hourly rebuild or a partition swap. Rows written outside the ledger into hours rides_hourly already has, e.g. by calling copy_df_bikeshare() directly, don't move it; use QueryCache.clear() after those.
+WATERMARK_QUERIES = {
+    "last_load": "SELECT CASE WHEN to_regclass('ingest_ledger') IS NOT NULL THEN (SELECT MAX(batch_id) || '/' || MAX(loaded_at) || '/' || COUNT(*) FROM ingest_ledger WHERE status = 'loaded') END",
+    "last_hour": "SELECT CASE WHEN to_regclass('rides_hourly') IS NOT NULL THEN (SELECT MAX(hour) FROM rides_hourly)::text END",
+    "last_weather": "SELECT CASE WHEN to_regclass('hourly_weather') IS NOT NULL AND to_regclass('daily_weather') IS NOT NULL THEN (SELECT MAX(time) FROM hourly_weather)::text || '/' || (SELECT MAX(time) FROM daily_weather)::text END",
+    "table_files": "SELECT md5(string_agg(oid || ':' || relfilenode, ',' ORDER BY oid)) FROM pg_class WHERE relnamespace = current_schema()::regnamespace AND relkind IN ('r', 'm')",
+}
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and drop trailing semicolons so formatting differences don't produce separate cache entries."""
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+def data_watermark(con) -> dict:
+    """Run the WATERMARK_QUERIES and return their values as strings."""
+    return {name: str(pd.read_sql_query(sql, con).iloc[0, 0]) for name, sql in WATERMARK_QUERIES.items()}
+
+class QueryCache:
+    """Local cache of analytics query results, one parquet file per result, keyed by the normalized SQL, its parameters and the data watermark at query time. New loads move the watermark, so stale results are never served and simply age out. Files are evicted least recently used first once the cache grows past max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def read_sql(self, sql, con, params=None, bypass=False) -> pd.DataFrame:
+        """Drop-in for pd.read_sql_query(sql, con, params=params). bypass=True always runs the query and leaves the cache untouched."""
+        if bypass:
+            return pd.read_sql_query(sql, con, params=params)
+
+        path = self.cache_dir / f"{self.key(sql, params, data_watermark(con))}.parquet"
+        if path.exists():
+            # a hit refreshes the file's mtime, which is what eviction orders by
+            os.utime(path)
+            return pd.read_parquet(path)
+
+        df = pd.read_sql_query(sql, con, params=params)
+        self._store(df, path)
+        return df
+
+    @staticmethod
+    def key(sql, params, watermark) -> str:
+        payload = json.dumps(
+            {"sql": normalize_sql(sql), "params": params, "watermark": watermark},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def clear(self):
+        for path in self.cache_dir.glob("*.parquet"):
+            path.unlink(missing_ok=True)
+
+    def _store(self, df, path):
+        tmp_path = path.with_suffix(".parquet.tmp")
+        try:
+            df.to_parquet(tmp_path, index=False)
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            # results with columns arrow can't represent are just not cached
+            print(f"Not caching query result: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
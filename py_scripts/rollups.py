@@ -0,0 +1,156 @@
+from io import BytesIO
+import pandas as pd
+
+from py_scripts.pg_binary import encode_binary_copy, get_column_types
+
+# Hourly ride counts and trip durations, kept up to date by the loaders batch by batch so analytics at hour grain or coarser never has to scan rides_raw. Rows without a started_at are kept under a NULL hour so totals match rides_raw exactly.
+create_rides_hourly = """
+CREATE TABLE IF NOT EXISTS rides_hourly (
+    hour            TIMESTAMP,
+    member_casual   TEXT,
+    rideable_type   TEXT,
+    ride_count      BIGINT NOT NULL,
+    duration_sum_s  DOUBLE PRECISION NOT NULL,
+    duration_count  BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS rides_hourly_key
+    ON rides_hourly (hour, member_casual, rideable_type) NULLS NOT DISTINCT;
+"""
+
+ROLLUP_KEYS = ["hour", "member_casual", "rideable_type"]
+ROLLUP_COLS = ROLLUP_KEYS + ["ride_count", "duration_sum_s", "duration_count"]
+
+# grains the rollup can answer, with the date parts each one groups by
+GRAINS = {
+    "year": ["year"],
+    "month": ["year", "month"],
+    "day": ["year", "month", "day"],
+    "hour": ["year", "month", "day", "hour"],
+}
+
+def hourly_rollup(df: pd.DataFrame) -> pd.DataFrame:
+    """Aggregate normalized rides into rides_hourly rows."""
+    duration = (df["ended_at"] - df["started_at"]).dt.total_seconds()
+    return (
+        pd.DataFrame({
+            "hour": df["started_at"].dt.floor("h"),
+            "member_casual": df["member_casual"],
+            "rideable_type": df["rideable_type"],
+            "duration": duration,
+        })
+        .groupby(ROLLUP_KEYS, dropna=False)
+        .agg(
+            ride_count=("duration", "size"),
+            duration_sum_s=("duration", "sum"),
+            duration_count=("duration", "count"),
+        )
+        .reset_index()
+    )
+
+def merge_rollups(rollups) -> pd.DataFrame:
+    """Combine partial rollups, e.g. one per chunk of a file, into one."""
+    rollups = [r for r in rollups if len(r)]
+    if not rollups:
+        return pd.DataFrame(columns=ROLLUP_COLS)
+    return pd.concat(rollups).groupby(ROLLUP_KEYS, dropna=False, as_index=False).sum()
+
+def upsert_rides_hourly(cur, rollup: pd.DataFrame):
+    """Add a batch's rollup to rides_hourly: counts and sums for hours already present are incremented, new hours are inserted."""
+    if not len(rollup):
+        return
+
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS rides_hourly_batch (LIKE rides_hourly)")
+    cur.execute("TRUNCATE rides_hourly_batch")
+
+    buf = BytesIO(encode_binary_copy(rollup[ROLLUP_COLS], get_column_types(cur, "rides_hourly", ROLLUP_COLS)))
+    cur.copy_expert(f"COPY rides_hourly_batch ({', '.join(ROLLUP_COLS)}) FROM STDIN WITH (FORMAT BINARY)", buf)
+
+    cur.execute(
+        """
+        INSERT INTO rides_hourly
+        SELECT * FROM rides_hourly_batch
+        -- a fixed order keeps concurrent loaders locking shared hours in the same sequence
+        ORDER BY hour, member_casual, rideable_type
+        ON CONFLICT (hour, member_casual, rideable_type) DO UPDATE SET
+            ride_count     = rides_hourly.ride_count + EXCLUDED.ride_count,
+            duration_sum_s = rides_hourly.duration_sum_s + EXCLUDED.duration_sum_s,
+            duration_count = rides_hourly.duration_count + EXCLUDED.duration_count
+        """
+    )
+
+_rides_hourly_select = """
+SELECT
+    date_trunc('hour', started_at),
+    member_casual,
+    rideable_type,
+    COUNT(*),
+    COALESCE(SUM(EXTRACT(EPOCH FROM ended_at - started_at)), 0),
+    COUNT(ended_at - started_at)
+FROM {source}
+{where}
+GROUP BY 1, 2, 3
+"""
+
+def rebuild_rides_hourly(cur):
+    """Recompute rides_hourly from scratch with one scan of rides_raw, e.g. for a database loaded before the rollup existed."""
+    print("Rebuilding rides_hourly from rides_raw...")
+    cur.execute("TRUNCATE rides_hourly")
+    cur.execute("INSERT INTO rides_hourly " + _rides_hourly_select.format(source="rides_raw", where=""))
+
+def recompute_rides_hourly(cur, start, end, source="rides_raw"):
+    """Replace the rides_hourly rows of the hours from start up to (not including) end with counts from source, e.g. after the rides of a month were swapped out. Runs in the caller's transaction."""
+    params = {"start": start, "end": end}
+    cur.execute("DELETE FROM rides_hourly WHERE hour >= %(start)s AND hour < %(end)s", params)
+    cur.execute(
+        "INSERT INTO rides_hourly " + _rides_hourly_select.format(source=source, where="WHERE started_at >= %(start)s AND started_at < %(end)s"),
+        params,
+    )
+
+def ride_counts(con, grain="hour", by=("member_casual",), source=None, cache=None):
+    """Ride counts per year, month, day or hour, split by member_casual and/or rideable_type, in the shape of the analytics.py sample query (date part columns, the by columns and cnt).
+
+    The query runs against rides_hourly whenever it is populated, since every supported grain is hour or coarser, and falls back to scanning rides_raw otherwise. source="rides_raw" or "rides_hourly" forces one. con is anything pandas.read_sql_query accepts. Passing a QueryCache serves repeated calls from disk until new data is loaded.
+    """
+    if source is None:
+        source = "rides_hourly" if rollup_available(con) else "rides_raw"
+
+    sql = ride_counts_sql(grain, by, source)
+    if cache is not None:
+        return cache.read_sql(sql, con)
+    return pd.read_sql_query(sql, con)
+
+def ride_counts_sql(grain="hour", by=("member_casual",), source="rides_raw"):
+    """The SQL behind ride_counts(), for running it elsewhere, e.g. on the local DuckDB backend."""
+    if grain not in GRAINS:
+        raise ValueError(f"grain must be one of {list(GRAINS)}, got {grain!r}")
+    by = list(by)
+    unknown = set(by) - {"member_casual", "rideable_type"}
+    if unknown:
+        raise ValueError(f"Can't split ride counts by {sorted(unknown)}")
+
+    ts, count = ("hour", "SUM(ride_count)::bigint") if source == "rides_hourly" else ("started_at", "COUNT(*)")
+    parts = GRAINS[grain]
+    group = parts + by
+    select = [f"EXTRACT({p.upper()} FROM {ts}) AS {p}" for p in parts] + by
+
+    return f"""
+    SELECT
+        {", ".join(select)},
+        {count} AS cnt
+    FROM {source}
+    GROUP BY {", ".join(group)}
+    ORDER BY {", ".join(group)};
+    """
+
+def rollup_available(con):
+    """True if rides_hourly exists and has rows."""
+    df = pd.read_sql_query(
+        """
+        SELECT to_regclass('rides_hourly') IS NOT NULL AS exists
+        """,
+        con,
+    )
+    if not df["exists"].iloc[0]:
+        return False
+    return bool(pd.read_sql_query("SELECT EXISTS (SELECT 1 FROM rides_hourly) AS populated", con)["populated"].iloc[0])
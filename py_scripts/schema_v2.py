@@ -0,0 +1,205 @@
+import psycopg2.extensions
+
+from py_scripts.prep_data import LABELS
+
+# Version 2 of the physical layout of rides_raw, daily_weather and hourly_weather: same column names and meaning, fixed-width types instead of NUMERIC and TEXT.
+#
+#   coordinates       NUMERIC(9,6) -> double precision   8 bytes, 15 significant digits keep every 6th decimal exact
+#   weather measures  NUMERIC      -> real               4 bytes, 7 significant digits for values published with 1 or 2 decimals
+#   whole numbers     INTEGER      -> smallint           2 bytes, codes, percentages, degrees
+#   rideable_type     TEXT         -> rideable_type_enum 4 bytes, labels in prep_data.LABELS
+#   member_casual     TEXT         -> member_type_enum   4 bytes
+#
+# Arithmetic on these runs in native float and integer instructions instead of NUMERIC's digit-by-digit code. Columns are ordered by alignment, 8-byte types first and variable-length ones last, so no row carries padding between fields. Queries name columns, so the order is invisible to them; the COPY paths list their columns too.
+
+RIDES_RAW_V2 = [
+    ("started_at", "TIMESTAMP"),
+    ("ended_at", "TIMESTAMP"),
+    ("start_lat", "DOUBLE PRECISION"),
+    ("start_lng", "DOUBLE PRECISION"),
+    ("end_lat", "DOUBLE PRECISION"),
+    ("end_lng", "DOUBLE PRECISION"),
+    ("start_station_id", "INTEGER"),
+    ("end_station_id", "INTEGER"),
+    ("rideable_type", "rideable_type_enum"),
+    ("member_casual", "member_type_enum"),
+    ("start_station_name", "TEXT"),
+    ("end_station_name", "TEXT"),
+]
+
+DAILY_WEATHER_V2 = [
+    ("sunrise", "TIMESTAMP"),
+    ("sunset", "TIMESTAMP"),
+    ("time", "DATE"),
+    ("temperature_2m_mean", "REAL"),
+    ("temperature_2m_max", "REAL"),
+    ("temperature_2m_min", "REAL"),
+    ("apparent_temperature_mean", "REAL"),
+    ("apparent_temperature_max", "REAL"),
+    ("apparent_temperature_min", "REAL"),
+    ("daylight_duration", "REAL"),
+    ("sunshine_duration", "REAL"),
+    ("precipitation_sum", "REAL"),
+    ("rain_sum", "REAL"),
+    ("snowfall_sum", "REAL"),
+    ("precipitation_hours", "REAL"),
+    ("wind_speed_10m_max", "REAL"),
+    ("wind_gusts_10m_max", "REAL"),
+    ("wind_gusts_10m_mean", "REAL"),
+    ("wind_speed_10m_mean", "REAL"),
+    ("wind_gusts_10m_min", "REAL"),
+    ("wind_speed_10m_min", "REAL"),
+    ("dew_point_2m_mean", "REAL"),
+    ("pressure_msl_mean", "REAL"),
+    ("surface_pressure_mean", "REAL"),
+    ("weather_code", "SMALLINT"),
+    ("wind_direction_10m_dominant", "SMALLINT"),
+    ("winddirection_10m_dominant", "SMALLINT"),
+    ("cloud_cover_mean", "SMALLINT"),
+    ("cloud_cover_max", "SMALLINT"),
+    ("cloud_cover_min", "SMALLINT"),
+    ("relative_humidity_2m_mean", "SMALLINT"),
+    ("relative_humidity_2m_max", "SMALLINT"),
+    ("relative_humidity_2m_min", "SMALLINT"),
+]
+
+HOURLY_WEATHER_V2 = [
+    ("time", "TIMESTAMP"),
+    ("temperature_2m", "REAL"),
+    ("apparent_temperature", "REAL"),
+    ("precipitation", "REAL"),
+    ("rain", "REAL"),
+    ("snowfall", "REAL"),
+    ("snow_depth", "REAL"),
+    ("pressure_msl", "REAL"),
+    ("surface_pressure", "REAL"),
+    ("wind_speed_10m", "REAL"),
+    ("wind_gusts_10m", "REAL"),
+    ("wind_speed_100m", "REAL"),
+    ("dew_point_2m", "REAL"),
+    ("sunshine_duration", "REAL"),
+    ("weather_code", "SMALLINT"),
+    ("relative_humidity_2m", "SMALLINT"),
+    ("cloud_cover", "SMALLINT"),
+    ("wind_direction_10m", "SMALLINT"),
+    ("wind_direction_100m", "SMALLINT"),
+    ("is_day", "SMALLINT"),
+    ("cloud_cover_low", "SMALLINT"),
+    ("cloud_cover_mid", "SMALLINT"),
+    ("cloud_cover_high", "SMALLINT"),
+]
+
+V2_TABLES = {"rides_raw": RIDES_RAW_V2, "daily_weather": DAILY_WEATHER_V2, "hourly_weather": HOURLY_WEATHER_V2}
+ENUM_TYPES = {"rideable_type": "rideable_type_enum", "member_casual": "member_type_enum"}
+
+def table_ddl(table, columns, partition_clause=""):
+    body = ",\n    ".join(f"{name:<28}{pg_type}" for name, pg_type in columns)
+    return f"CREATE TABLE IF NOT EXISTS {table} (\n    {body}\n) {partition_clause};"
+
+def create_enum_types(cur, extra_labels=None):
+    """Create the enum types for LABEL_COLS with the labels in LABELS, and add any labels in extra_labels ({column: labels}) that an existing type lacks, each at its alphabetical place. New labels are committed right away: PostgreSQL doesn't let a transaction use an enum label it added itself."""
+    for col, type_name in ENUM_TYPES.items():
+        labels = ", ".join(f"'{label}'" for label in LABELS[col])
+        cur.execute(
+            f"""
+            DO $$
+            BEGIN
+                CREATE TYPE {type_name} AS ENUM ({labels});
+            EXCEPTION WHEN duplicate_object THEN NULL;
+            END
+            $$;
+            """
+        )
+        cur.execute("SELECT enumlabel FROM pg_enum WHERE enumtypid = %s::regtype ORDER BY enumsortorder", (type_name,))
+        existing = [label for (label,) in cur.fetchall()]
+        for label in sorted((set(LABELS[col]) | set((extra_labels or {}).get(col, ()))) - set(existing)):
+            # ADD VALUE appends, so each label goes in before the first one that sorts after it to keep the type alphabetical
+            following = next((other for other in existing if other > label), None)
+            if following is None:
+                cur.execute(f"ALTER TYPE {type_name} ADD VALUE IF NOT EXISTS %s", (label,))
+            else:
+                cur.execute(f"ALTER TYPE {type_name} ADD VALUE IF NOT EXISTS %s BEFORE %s", (label, following))
+            existing.insert(existing.index(following) if following is not None else len(existing), label)
+
+def enum_labels(cur):
+    """The labels of the enum types rides_raw's LABEL_COLS have, as {column: labels} for normalize_bikeshare_df(labels=...), or None when rides_raw stores them as text. A migrated database can hold labels LABELS doesn't list."""
+    cur.execute(
+        """
+        SELECT a.attname, e.enumlabel
+        FROM pg_attribute a
+        JOIN pg_enum e ON e.enumtypid = a.atttypid
+        WHERE a.attrelid = to_regclass('rides_raw') AND a.attname = ANY(%s)
+        ORDER BY e.enumsortorder
+        """,
+        (list(ENUM_TYPES),)
+    )
+    labels = {}
+    for col, label in cur.fetchall():
+        labels.setdefault(col, []).append(label)
+    return labels or None
+
+def create_v2_tables(cur, partitioned=False):
+    """Create rides_raw, daily_weather and hourly_weather in the v2 layout, for create_db_tables(cur, v2=True)."""
+    create_enum_types(cur)
+    cur.execute(table_ddl("rides_raw", RIDES_RAW_V2, "PARTITION BY RANGE (started_at)" if partitioned else ""))
+    cur.execute(table_ddl("daily_weather", DAILY_WEATHER_V2))
+    cur.execute(table_ddl("hourly_weather", HOURLY_WEATHER_V2))
+
+def schema_version(cur):
+    """1 or 2 depending on how rides_raw stores coordinates, None without a rides_raw table."""
+    cur.execute(
+        """
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'rides_raw' AND column_name = 'start_lat'
+        """
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return 2 if row[0] == "double precision" else 1
+
+def migrate_to_v2(cur):
+    """Convert rides_raw, daily_weather and hourly_weather from the original layout to v2 in one transaction. Each table is copied into a new one in v2 column order, which needs free space for a second copy of the table, and swapped in; a partitioned rides_raw keeps its partitions and column order and has its column types changed in place instead. Labels in rides_raw that LABELS doesn't list are added to the enum types first, so no row is lost. Use an autocommit connection, such as get_conn(); inside a transaction of the caller's the tables are converted as part of it, but labels added to the enum types can't be used before they are committed, so create_enum_types() has to run beforehand."""
+
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rides_raw')")
+    row = cur.fetchone()
+    if row is None or row[0] not in ("r", "p"):
+        raise RuntimeError("migrate_to_v2() needs rides_raw as a table; the compact layout (a rides_raw view over rides_fact) is not migrated.")
+    partitioned = row[0] == "p"
+
+    extra_labels = {}
+    for col in ENUM_TYPES:
+        cur.execute(f"SELECT DISTINCT {col}::text FROM rides_raw WHERE {col} IS NOT NULL")
+        extra_labels[col] = [label for (label,) in cur.fetchall()]
+    create_enum_types(cur, extra_labels)
+
+    # db_operations imports this module, so transaction() is imported when it's needed
+    from py_scripts.db_operations import transaction
+
+    with transaction(cur):
+        for table, columns in V2_TABLES.items():
+            print(f"Migrating {table} to the v2 column types...")
+            if table == "rides_raw" and partitioned:
+                # only the columns whose type changes; started_at is the partition key and can't be altered at all
+                changes = ", ".join(f"ALTER COLUMN {name} TYPE {pg_type} USING {_cast(name, pg_type)}" for name, pg_type in columns if pg_type not in ("TIMESTAMP", "INTEGER", "TEXT"))
+                cur.execute(f"ALTER TABLE rides_raw {changes}")
+                continue
+            names = ", ".join(name for name, _ in columns)
+            cur.execute(table_ddl(f"{table}_v2", columns))
+            cur.execute(f"INSERT INTO {table}_v2 ({names}) SELECT {', '.join(_cast(name, pg_type) for name, pg_type in columns)} FROM {table}")
+            cur.execute(f"DROP TABLE {table}")
+            cur.execute(f"ALTER TABLE {table}_v2 RENAME TO {table}")
+    # VACUUM can't run inside the caller's transaction, ANALYZE can
+    idle = cur.connection.autocommit and cur.connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    for table in V2_TABLES:
+        cur.execute(f"{'VACUUM ANALYZE' if idle else 'ANALYZE'} {table}")
+    print("Migrated rides_raw, daily_weather and hourly_weather to v2.")
+
+def _cast(name, pg_type):
+    # enums only cast from text, and whole numbers are rounded rather than truncated
+    if pg_type.endswith("_enum"):
+        return f"{name}::text::{pg_type}"
+    if pg_type == "SMALLINT":
+        return f"round({name})::smallint"
+    return f"{name}::{pg_type}"
@@ -0,0 +1,115 @@
+import json
+import os
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from py_scripts.prep_data import detect_bikeshare_schema, normalize_bikeshare_df, read_bikeshare_csv
+
+STATION_INDEX = "station_index.parquet"
+STATION_INDEX_COLS = ["station_id", "month", "lat", "lng", "trips"]
+STATION_FILE_COLS = ["source", *STATION_INDEX_COLS]
+STATION_SOURCE_COLS = ["started_at", "start_station_id", "start_lat", "start_lng", "end_station_id", "end_lat", "end_lng"]
+SOURCES_KEY = b"bikeshare.sources"
+
+# Where every station was, month by month, learned from the new-layout files, which carry coordinates. Old-layout files (2010-2019) only have station numbers, and normalize_bikeshare_df(stations=...) fills in their coordinates from this index: each trip gets its station's location in the nearest month on record.
+#
+# The file keeps one row per source file, station and month: the median of the start and end coordinates of that month's trips at the station in that file. The files that went into it are listed in the parquet metadata with their sizes, so update_station_index() only reads files it hasn't seen, and a file whose size changed replaces its own rows rather than being counted twice. The index handed to normalize_bikeshare_df has one row per station and month, a month that arrives in more than one file being the trip-weighted mean of the per-file medians.
+
+def load_station_index(path) -> pd.DataFrame:
+    """The index at path merged over its source files and sorted by month, as normalize_bikeshare_df(stations=...) expects, or an empty one."""
+    return merge_station_months([_read_rows(Path(path))])
+
+def update_station_index(path, source_files) -> pd.DataFrame:
+    """Add the raw csv or normalized parquet files among source_files that the index at path hasn't seen yet, and return the updated index. Old-layout csv files are skipped, they have no coordinates to contribute."""
+    path = Path(path)
+    rows = _read_rows(path)
+    sources = _read_sources(path)
+
+    added = []
+    for source in sorted(map(Path, source_files)):
+        size = source.stat().st_size
+        if sources.get(source.name) == size:
+            continue
+        if source.suffix == ".parquet":
+            # rows from old-layout files have no coordinates and drop out in station_months()
+            months = station_months(pd.read_parquet(source, columns=STATION_SOURCE_COLS))
+        else:
+            schema = detect_bikeshare_schema(source)
+            months = station_months(normalize_bikeshare_df(read_bikeshare_csv(source, schema=schema), schema["timestamp_format"])) if schema["layout"] == "new" else _empty_index()
+        # a file seen before with another size replaces what it contributed then
+        rows = rows[rows["source"] != source.name]
+        added.append(months.assign(source=source.name)[STATION_FILE_COLS])
+        sources[source.name] = size
+
+    if not added:
+        return merge_station_months([rows])
+
+    rows = pd.concat([rows, *added], ignore_index=True).astype({"station_id": "int32", "trips": "int64"})
+    _write(path, rows, sources)
+    index = merge_station_months([rows])
+    print(f"Station index: {len(added)} new or changed files, {index['station_id'].nunique():,} stations over {index['month'].nunique()} months.")
+    return index
+
+def station_months(df: pd.DataFrame) -> pd.DataFrame:
+    """Median location of every station per month from normalized trips, using both the start and the end of each trip."""
+    sides = [
+        pd.DataFrame({
+            "station_id": df[f"{side}_station_id"],
+            "month": df["started_at"].dt.to_period("M").dt.to_timestamp(),
+            "lat": df[f"{side}_lat"],
+            "lng": df[f"{side}_lng"],
+        })
+        for side in ("start", "end")
+    ]
+    points = pd.concat(sides, ignore_index=True).dropna()
+    return (
+        points.groupby(["station_id", "month"])
+        .agg(lat=("lat", "median"), lng=("lng", "median"), trips=("lat", "size"))
+        .reset_index()
+        .astype({"station_id": "int32", "trips": "int64"})
+    )
+
+def merge_station_months(parts) -> pd.DataFrame:
+    """Combine station_months() results, averaging months that appear more than once by trip count."""
+    df = pd.concat([p for p in parts if len(p)], ignore_index=True)
+    if df.empty:
+        return _empty_index()
+    df["lat_w"] = df["lat"] * df["trips"]
+    df["lng_w"] = df["lng"] * df["trips"]
+    merged = df.groupby(["station_id", "month"], as_index=False)[["lat_w", "lng_w", "trips"]].sum()
+    merged["lat"] = (merged["lat_w"] / merged["trips"]).round(6)
+    merged["lng"] = (merged["lng_w"] / merged["trips"]).round(6)
+    return merged[STATION_INDEX_COLS].sort_values("month", ignore_index=True)
+
+def _empty_index():
+    return pd.DataFrame({
+        "station_id": pd.Series(dtype="int32"),
+        "month": pd.Series(dtype="datetime64[ns]"),
+        "lat": pd.Series(dtype="float64"),
+        "lng": pd.Series(dtype="float64"),
+        "trips": pd.Series(dtype="int64"),
+    })
+
+def _read_rows(path):
+    if _per_file(path):
+        return pd.read_parquet(path, columns=STATION_FILE_COLS)
+    return _empty_index().assign(source=pd.Series(dtype="object"))[STATION_FILE_COLS]
+
+def _per_file(path):
+    # an index written before rows were kept per file is rebuilt from its sources
+    return path.exists() and "source" in pq.read_schema(path).names
+
+def _read_sources(path):
+    if not _per_file(path):
+        return {}
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata.get(SOURCES_KEY, b"{}"))
+
+def _write(path, rows, sources):
+    table = pa.Table.from_pandas(rows, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, SOURCES_KEY: json.dumps(sources, sort_keys=True).encode()})
+    tmp_path = path.with_suffix(".tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
@@ -0,0 +1,227 @@
+import argparse
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+import pandas as pd
+
+TELEMETRY_ENV = "BIKESHARE_TELEMETRY"
+PROFILE_ENV = "BIKESHARE_PROFILE"
+RSS_SAMPLE_S = 0.05
+
+# Per-stage pipeline telemetry. Every instrumented stage (S3 download, zip extraction, csv parsing, normalization, csv rendering or binary encoding, COPY...) appends one JSON line to the file named by BIKESHARE_TELEMETRY, with its wall time, rows and bytes processed, throughput and the peak RSS while it ran. Stages are tagged with the source file being worked on, which nested stages inherit, so a slow file can be traced down to the step it spent its time in. Without BIKESHARE_TELEMETRY set, stage() only yields its metrics dict.
+#
+# BIKESHARE_PROFILE names stages (comma separated) to run under cProfile; each run dumps a .prof file next to the log, readable with python -m pstats or snakeviz.
+#
+# Settings live in environment variables so worker processes of the parallel ingest pick them up too.
+
+_source = contextvars.ContextVar("telemetry_source", default=None)
+_parent = contextvars.ContextVar("telemetry_parent", default=None)
+_write_lock = threading.Lock()
+_profiling = threading.local()
+_rss_windows = set()
+_rss_lock = threading.Lock()
+_rss_sampler_pid = None
+
+def configure(log_path=None, profile=None):
+    """Turn telemetry on for this process and the processes it starts, writing to log_path. profile is a stage name or a list of them to profile. log_path=None turns it off."""
+    if log_path is None:
+        os.environ.pop(TELEMETRY_ENV, None)
+    else:
+        os.environ[TELEMETRY_ENV] = str(log_path)
+    if profile:
+        os.environ[PROFILE_ENV] = profile if isinstance(profile, str) else ",".join(profile)
+    else:
+        os.environ.pop(PROFILE_ENV, None)
+
+def log_path():
+    path = os.environ.get(TELEMETRY_ENV)
+    return Path(path) if path else None
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def current_rss_mb():
+    """Resident set size of this process right now, in MB, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * resource.getpagesize() / 1024**2
+
+class RssPeak:
+    """The highest resident set size seen while a track_peak_rss() block runs, in MB."""
+
+    def __init__(self, rss):
+        self.mb = rss
+
+    def sample(self, rss):
+        self.mb = max(self.mb, rss)
+
+@contextmanager
+def track_peak_rss():
+    """Measure the peak RSS of the enclosed block rather than of the whole process: a single sampler thread per process reads the current RSS every RSS_SAMPLE_S seconds for all open blocks, so the peak of one file or stage isn't hidden by an earlier, larger one. Where current RSS can't be read, falls back to the process peak from peak_rss_mb()."""
+    peak = _open_rss_window()
+    try:
+        yield peak
+    finally:
+        _close_rss_window(peak)
+
+def _open_rss_window():
+    global _rss_sampler_pid
+    rss = current_rss_mb()
+    peak = RssPeak(peak_rss_mb() if rss is None else rss)
+    if rss is None:
+        return peak
+    with _rss_lock:
+        _rss_windows.add(peak)
+        # after a fork the child has no sampler thread of its own
+        if _rss_sampler_pid != os.getpid():
+            _rss_sampler_pid = os.getpid()
+            threading.Thread(target=_sample_rss, name="rss-sampler", daemon=True).start()
+    return peak
+
+def _close_rss_window(peak):
+    with _rss_lock:
+        _rss_windows.discard(peak)
+    rss = current_rss_mb()
+    peak.sample(peak_rss_mb() if rss is None else rss)
+
+def _sample_rss():
+    while True:
+        time.sleep(RSS_SAMPLE_S)
+        rss = current_rss_mb()
+        with _rss_lock:
+            for peak in _rss_windows:
+                peak.sample(rss)
+
+@contextmanager
+def stage(name, source=None, **metrics):
+    """Time the enclosed block as one pipeline stage. Yields a dict of metrics for the block to fill in: rows and bytes are used for throughput, any other key is logged as is. Keyword arguments are initial metrics. source tags the record and every stage nested in it; without one the enclosing stage's source is used."""
+    metrics = {"rows": None, "bytes": None, **metrics}
+    path = log_path()
+    if path is None:
+        yield metrics
+        return
+
+    source = source if source is not None else _source.get()
+    parent = _parent.get()
+    tokens = (_source.set(source), _parent.set(name))
+    profiler = _start_profiler(name)
+    peak = _open_rss_window()
+    rss_before = peak.mb
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield metrics
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _close_rss_window(peak)
+        seconds = time.perf_counter() - start
+        _source.reset(tokens[0])
+        _parent.reset(tokens[1])
+        profile_path = _stop_profiler(profiler, path, name)
+        rss = peak.mb
+        rows, nbytes = metrics["rows"], metrics["bytes"]
+        _write(path, {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "stage": name,
+            "parent": parent,
+            "source": None if source is None else str(source),
+            "status": status,
+            "seconds": round(seconds, 6),
+            "rows": rows,
+            "bytes": nbytes,
+            "rows_per_s": round(rows / seconds) if rows is not None and seconds else None,
+            "mb_per_s": round(nbytes / 1024**2 / seconds, 2) if nbytes is not None and seconds else None,
+            "peak_rss_mb": round(rss, 1),
+            "rss_growth_mb": round(rss - rss_before, 1),
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "profile": profile_path,
+            **{k: v for k, v in metrics.items() if k not in ("rows", "bytes")},
+        })
+
+def instrumented(name, rows=None):
+    """Decorator running every call of a function as stage name. rows, e.g. len, computes the row count from the return value."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name) as m:
+                result = fn(*args, **kwargs)
+                if rows is not None:
+                    m["rows"] = rows(result)
+                return result
+        return wrapper
+    return decorate
+
+def _start_profiler(name):
+    if name not in os.environ.get(PROFILE_ENV, "").split(","):
+        return None
+    # only one profiler can run per thread, so stages nested in a profiled one are covered by it
+    if getattr(_profiling, "active", False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is already running in this thread
+        return None
+    _profiling.active = True
+    return profiler
+
+def _stop_profiler(profiler, path, name):
+    if profiler is None:
+        return None
+    profiler.disable()
+    _profiling.active = False
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    profile_path = path.parent / f"profile-{name}-{os.getpid()}-{stamp}.prof"
+    profiler.dump_stats(profile_path)
+    return str(profile_path)
+
+def _write(path, record):
+    line = json.dumps(record, default=str) + "\n"
+    # one write per record on a file opened for appending, so lines from threads and worker processes never interleave
+    with _write_lock, open(path, "a") as f:
+        f.write(line)
+
+def read_log(path) -> pd.DataFrame:
+    return pd.read_json(path, lines=True)
+
+def summarize(path, by="stage") -> pd.DataFrame:
+    """Totals per stage (or per source, or any other logged column) from a telemetry log: runs, total seconds, rows and bytes, overall throughput and the highest peak RSS. A stage's time also counts towards the stages it ran in (its parent column), so totals are only additive across stages at the same level."""
+    df = read_log(path)
+    total = lambda col: col.sum(min_count=1)
+    summary = df.groupby(by, dropna=False).agg(
+        runs=("seconds", "size"),
+        seconds=("seconds", "sum"),
+        rows=("rows", total),
+        bytes=("bytes", total),
+        peak_rss_mb=("peak_rss_mb", "max"),
+    )
+    summary["rows_per_s"] = (summary["rows"] / summary["seconds"]).round()
+    summary["mb_per_s"] = (summary["bytes"] / 1024**2 / summary["seconds"]).round(2)
+    return summary.sort_values("seconds", ascending=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a pipeline telemetry log.")
+    parser.add_argument("log", type=Path)
+    parser.add_argument("--by", default="stage", help="column to group by, e.g. stage or source")
+    args = parser.parse_args()
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(summarize(args.log, args.by))